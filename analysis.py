@@ -0,0 +1,174 @@
+import argparse
+import configparser
+import csv
+import json
+import re
+import numpy as np
+
+# A metrics-brief row, e.g. "stress-ng: info:  [1234] cpu  123456  60.00  239.90  0.05  2057.60  514.51";
+# newer stress-ng versions log it as "metrc" and append more columns, which are ignored
+METRICS_PATTERN = re.compile(r'^stress-ng: (?:info|metrc): +\[\d+\] ([A-Za-z][\w-]*) +(\d+) +([\d.]+) +'
+                             r'([\d.]+) +([\d.]+) +([\d.]+) +([\d.]+)', re.MULTILINE)
+FREQUENCY_PATTERN = re.compile(r'cpufreq-set\b.*?(?:-f|--freq)\s+(\d+)')
+SUMMARY_FIELDS = ('frequency', 'client_id', 'stressor', 'runs', 'bogo_ops_s_mean', 'bogo_ops_s_var',
+                  'bogo_ops_s_p50', 'bogo_ops_s_p95', 'bogo_ops_s_cpu_mean', 'duration_mean', 'duration_p95')
+ALL_CLIENTS = 'all'
+
+
+def _codes(values, table):
+    return [table.setdefault(value, len(table)) for value in values]
+
+
+def extract_metrics(entries) -> dict:
+    # One pass over the entries collecting plain lists; everything after this works on whole arrays
+    clients = {}
+    stressors = {}
+    event_client, event_start, event_frequency = [], [], []
+    row_client, row_start, row_end, row_stressor, row_values = [], [], [], [], []
+    for entry in entries:
+        command = entry.get('command') or ''
+        try:
+            start = float(entry.get('start_time'))
+            end = float(entry.get('end_time'))
+        except (TypeError, ValueError):
+            continue
+        frequency = FREQUENCY_PATTERN.search(command)
+        if frequency:
+            event_client.append(entry.get('client_id'))
+            event_start.append(start)
+            event_frequency.append(float(frequency.group(1)))
+            continue
+        if 'stress-ng' not in command:
+            continue
+        text = f"{entry.get('output') or ''}\n{entry.get('error') or ''}"
+        for match in METRICS_PATTERN.finditer(text):
+            row_client.append(entry.get('client_id'))
+            row_start.append(start)
+            row_end.append(end)
+            row_stressor.append(match.group(1))
+            row_values.append(match.groups()[1:])
+    values = np.array(row_values, dtype=np.float64).reshape(-1, 6)
+    metrics = {
+        "client": np.array(_codes(row_client, clients), dtype=np.int64),
+        "start": np.array(row_start, dtype=np.float64),
+        "duration": np.array(row_end, dtype=np.float64) - np.array(row_start, dtype=np.float64),
+        "stressor": np.array(_codes(row_stressor, stressors), dtype=np.int64),
+        "bogo_ops": values[:, 0],
+        "real_time": values[:, 1],
+        "bogo_ops_s": values[:, 4],
+        "bogo_ops_s_cpu": values[:, 5],
+    }
+    event_codes = np.array(_codes(event_client, clients), dtype=np.int64)
+    metrics["frequency"] = _frequency_at(metrics["client"], metrics["start"], event_codes,
+                                         np.array(event_start, dtype=np.float64),
+                                         np.array(event_frequency, dtype=np.float64))
+    metrics["client_names"] = np.array(list(clients), dtype=object)
+    metrics["stressor_names"] = np.array(list(stressors), dtype=object)
+    return metrics
+
+
+def _frequency_at(client, start, event_client, event_start, event_frequency):
+    # The frequency of a run is the last cpufreq-set issued on the same client before it started
+    count = len(client)
+    if not count:
+        return np.empty(0, dtype=np.float64)
+    all_client = np.concatenate([event_client, client])
+    all_start = np.concatenate([event_start, start])
+    is_event = np.concatenate([np.ones(len(event_client), dtype=bool), np.zeros(count, dtype=bool)])
+    values = np.concatenate([event_frequency, np.full(count, np.nan)])
+    # Sort by client, then time, with frequency changes ahead of runs starting at the same moment
+    order = np.lexsort((~is_event, all_start, all_client))
+    sorted_client = all_client[order]
+    group_start = np.ones(len(order), dtype=bool)
+    group_start[1:] = sorted_client[1:] != sorted_client[:-1]
+    positions = np.arange(len(order))
+    source = np.maximum.accumulate(np.where(is_event[order] | group_start, positions, 0))
+    filled = np.empty(len(order), dtype=np.float64)
+    filled[order] = values[order][source]
+    return filled[len(event_client):]
+
+
+def summarize(metrics: dict, per_client: bool = True) -> list:
+    frequency = np.nan_to_num(metrics["frequency"], nan=0.0)
+    client = metrics["client"] if per_client else np.full(len(frequency), -1, dtype=np.int64)
+    order = np.lexsort((metrics["stressor"], client, frequency))
+    keys = np.stack([frequency[order], client[order], metrics["stressor"][order]], axis=1)
+    if not len(keys):
+        return []
+    boundaries = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(keys)]])
+    bogo_ops_s = metrics["bogo_ops_s"][order]
+    bogo_ops_s_cpu = metrics["bogo_ops_s_cpu"][order]
+    duration = metrics["duration"][order]
+    runs = ends - starts
+    bogo_sum = np.add.reduceat(bogo_ops_s, starts)
+    bogo_mean = bogo_sum / runs
+    bogo_var = np.add.reduceat(bogo_ops_s ** 2, starts) / runs - bogo_mean ** 2
+    cpu_mean = np.add.reduceat(bogo_ops_s_cpu, starts) / runs
+    duration_mean = np.add.reduceat(duration, starts) / runs
+    rows = []
+    for index, (start, end) in enumerate(zip(starts, ends)):
+        group_frequency = keys[start, 0]
+        group_client, group_stressor = int(keys[start, 1]), int(keys[start, 2])
+        bogo_p50, bogo_p95 = np.percentile(bogo_ops_s[start:end], [50, 95])
+        rows.append({
+            "frequency": int(group_frequency) if group_frequency else 'unknown',
+            "client_id": metrics["client_names"][group_client] if group_client >= 0 else ALL_CLIENTS,
+            "stressor": metrics["stressor_names"][group_stressor],
+            "runs": int(runs[index]),
+            "bogo_ops_s_mean": float(bogo_mean[index]),
+            "bogo_ops_s_var": float(max(bogo_var[index], 0.0)),
+            "bogo_ops_s_p50": float(bogo_p50),
+            "bogo_ops_s_p95": float(bogo_p95),
+            "bogo_ops_s_cpu_mean": float(cpu_mean[index]),
+            "duration_mean": float(duration_mean[index]),
+            "duration_p95": float(np.percentile(duration[start:end], 95)),
+        })
+    return rows
+
+
+def load_entries(file_path: str):
+    # Only lines that can hold a frequency change or stress-ng metrics are decoded
+    with open(file_path, 'rb') as f:
+        for line in f:
+            if b'stress-ng' not in line and b'cpufreq-set' not in line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def write_csv(rows, file_path: str):
+    with open(file_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_summary(rows):
+    print(f"{'frequency':>10} {'client':<12}{'stressor':<10}{'runs':>6}{'bogo ops/s':>14}{'std':>10}"
+          f"{'p50':>12}{'p95':>12}{'duration':>10}")
+    for row in rows:
+        print(f"{row['frequency']:>10} {row['client_id']:<12}{row['stressor']:<10}{row['runs']:>6}"
+              f"{row['bogo_ops_s_mean']:>14.2f}{row['bogo_ops_s_var'] ** 0.5:>10.2f}{row['bogo_ops_s_p50']:>12.2f}"
+              f"{row['bogo_ops_s_p95']:>12.2f}{row['duration_mean']:>10.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarize stress-ng metrics from saved feedback.")
+    parser.add_argument('--config', type=str, default='config.ini', help='Path to the configuration file.')
+    parser.add_argument('--file', type=str, help='Feedback file, defaults to feedback_file from the configuration.')
+    parser.add_argument('--csv', type=str, help='Write the summary to this CSV file.')
+    parser.add_argument('--all-clients', action='store_true', help='Aggregate across clients per frequency.')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    feedback_file_path = args.file or config['operator']['feedback_file']
+
+    summary = summarize(extract_metrics(load_entries(feedback_file_path)), per_client=not args.all_clients)
+    print_summary(summary)
+    if args.csv:
+        write_csv(summary, args.csv)
@@ -0,0 +1,281 @@
+import asyncio
+import os
+import random
+import signal
+import subprocess
+import threading
+from collections import deque
+import paho.mqtt.client as mqtt
+import color_log
+
+# The operator, the SUT and the commander run their MQTT connections on one asyncio event loop per process instead
+# of a network thread per client. The blocking APIs of those classes are thin wrappers that hand work to the loop.
+
+
+def backoff_delays(initial: float, maximum: float, factor: float = 2, jitter: float = 0):
+    # Delays between attempts of something that keeps failing, e.g. a registration nobody acknowledges. Jitter
+    # spreads each delay over [delay * (1 - jitter), delay], so a fleet restarted together does not retry in step.
+    delay = initial
+    while True:
+        yield delay * (1 - jitter * random.random())
+        delay = min(delay * factor, maximum)
+
+
+async def run_shell(command: str, timeout: float = None) -> subprocess.CompletedProcess:
+    # The asyncio counterpart of subprocess.run(command, shell=True, capture_output=True, text=True)
+    # In its own session, so a timeout kills the commands the shell started too; they would keep the pipes open
+    process = await asyncio.create_subprocess_shell(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                    start_new_session=True)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+        raise subprocess.TimeoutExpired(command, timeout)
+    return subprocess.CompletedProcess(command, process.returncode, stdout.decode(errors='replace'),
+                                       stderr.decode(errors='replace'))
+
+
+class EventLoopThread:
+    def __init__(self, name: str = 'asyncio-core'):
+        self._name = name
+        self._loop = None
+        self._thread_id = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None or self._pid != os.getpid():
+            self._start()
+        return self._loop
+
+    def in_loop(self) -> bool:
+        return threading.get_ident() == self._thread_id and self._pid == os.getpid()
+
+    def submit(self, coroutine):
+        # Returns a concurrent.futures.Future, cancelling it cancels the task
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine, timeout: float = None):
+        if self.in_loop():
+            coroutine.close()
+            raise RuntimeError("A blocking call cannot wait for the event loop it runs on")
+        return self.submit(coroutine).result(timeout)
+
+    def call_soon(self, function, *args):
+        if self.in_loop():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def _start(self):
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return
+            # A forked child inherits the loop object but not the thread running it
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self._thread_id = threading.get_ident()
+                ready.set()
+                loop.run_forever()
+
+            threading.Thread(target=run, name=self._name, daemon=True).start()
+            ready.wait()
+            self._loop = loop
+            self._pid = os.getpid()
+
+
+_shared_loop = EventLoopThread()
+
+
+def shared_loop() -> EventLoopThread:
+    return _shared_loop
+
+
+class AsyncMQTTClient:
+    # A paho client without a network thread: the event loop it connects on watches its socket. publish() and
+    # subscribe() may be called from any thread, every paho call itself happens on the loop.
+    def __init__(self, client_id: str = '', clean_session: bool = True, reconnect_min: float = 1,
+                 reconnect_max: float = 120, reconnect_jitter: float = 0.5):
+        self._client = mqtt.Client(client_id=client_id, clean_session=clean_session)
+        self._client.on_socket_open = self._on_socket_open
+        self._client.on_socket_close = self._on_socket_close
+        self._client.on_socket_register_write = self._on_socket_register_write
+        self._client.on_socket_unregister_write = self._on_socket_unregister_write
+        self._client.on_connect = self._on_connect
+        self._reconnect_min = reconnect_min
+        self._reconnect_max = reconnect_max
+        self._reconnect_jitter = reconnect_jitter
+        self._loop = None
+        self._loop_thread = None
+        self._connected = None
+        self._misc_task = None
+        self._stopping = False
+        # Publishes from other threads wait here and are handed to the loop in batches
+        self._pending = deque()
+        self._drain_scheduled = False
+        self.on_connect = None
+
+    @property
+    def paho(self) -> mqtt.Client:
+        # For settings made before connecting, e.g. TLS, credentials or a will
+        return self._client
+
+    @property
+    def on_message(self):
+        return self._client.on_message
+
+    @on_message.setter
+    def on_message(self, callback):
+        self._client.on_message = callback
+
+    async def connect(self, host: str, port: int = 1883, keepalive: int = 60):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._connected = asyncio.Event()
+        self._stopping = False
+        try:
+            # The TCP connect blocks, so it runs on an executor thread while the loop keeps serving other clients
+            await self._loop.run_in_executor(None, self._client.connect, host, port, keepalive)
+        finally:
+            # Started even if the broker is unreachable, it keeps trying to reconnect
+            if self._misc_task is None:
+                self._misc_task = self._loop.create_task(self._misc_loop())
+
+    async def wait_connected(self, timeout: float = None) -> bool:
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def disconnect(self):
+        self._stopping = True
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+        self._client.disconnect()
+        # Sends the DISCONNECT packet now, paho closes the socket right after it
+        self._client.loop_write()
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        if self._loop is None or threading.get_ident() == self._loop_thread:
+            self._client.publish(topic, payload, qos, retain)
+            return
+        self._pending.append((topic, payload, qos, retain))
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self._loop.call_soon_threadsafe(self._drain)
+
+    def subscribe(self, topic: str, qos: int = 0):
+        self._call(self._client.subscribe, topic, qos)
+
+    def _call(self, function, *args):
+        if self._loop is None or threading.get_ident() == self._loop_thread:
+            function(*args)
+        else:
+            self._loop.call_soon_threadsafe(function, *args)
+
+    def _drain(self):
+        # The flag is cleared first, so a publish racing with the drain either lands in it or schedules another one
+        self._drain_scheduled = False
+        while self._pending:
+            self._client.publish(*self._pending.popleft())
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self._connected.set()
+        if self.on_connect is not None:
+            self.on_connect(client, userdata, flags, rc)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._loop.add_reader, sock, self._client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self._connected.clear)
+        self._call(self._loop.remove_reader, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self._loop.add_writer, sock, self._client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self._loop.remove_writer, sock)
+
+    async def _misc_loop(self):
+        # Keepalive pings, and reconnecting after the connection was lost
+        delays = None
+        while not self._stopping:
+            await asyncio.sleep(1)
+            if self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                delays = None
+                continue
+            if self._stopping:
+                return
+            delays = delays or backoff_delays(self._reconnect_min, self._reconnect_max, jitter=self._reconnect_jitter)
+            await asyncio.sleep(next(delays))
+            try:
+                await self._loop.run_in_executor(None, self._client.reconnect)
+            except OSError as e:
+                color_log.log_warning("Reconnecting to the broker failed: %s", e)
+
+
+class MQTTClient:
+    # The paho style blocking interface on top of AsyncMQTTClient. Callbacks run on the shared event loop thread,
+    # so they must not block; loop_start() and loop_stop() are kept for compatibility and do nothing.
+    def __init__(self, client_id: str = '', clean_session: bool = True, runner: EventLoopThread = None,
+                 reconnect_min: float = 1, reconnect_max: float = 120):
+        # clean_session=False keeps the subscriptions and queued QoS 1 messages on the broker across reconnects
+        self._runner = runner or shared_loop()
+        self._async = AsyncMQTTClient(client_id, clean_session, reconnect_min, reconnect_max)
+
+    @property
+    def paho(self) -> mqtt.Client:
+        return self._async.paho
+
+    @property
+    def async_client(self) -> AsyncMQTTClient:
+        return self._async
+
+    @property
+    def on_connect(self):
+        return self._async.on_connect
+
+    @on_connect.setter
+    def on_connect(self, callback):
+        self._async.on_connect = callback
+
+    @property
+    def on_message(self):
+        return self._async.on_message
+
+    @on_message.setter
+    def on_message(self, callback):
+        self._async.on_message = callback
+
+    def connect(self, host: str, port: int = 1883, keepalive: int = 60):
+        self._runner.run(self._async.connect(host, port, keepalive))
+
+    def wait_connected(self, timeout: float = None) -> bool:
+        return self._runner.run(self._async.wait_connected(timeout))
+
+    def disconnect(self):
+        self._runner.run(self._async.disconnect())
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self._async.publish(topic, payload, qos, retain)
+
+    def subscribe(self, topic: str, qos: int = 0):
+        self._async.subscribe(topic, qos)
@@ -0,0 +1,511 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+import paho.mqtt.client as mqtt
+import topics
+from sut import SUT
+from feedback_writer import FeedbackWriter
+import json_feedback
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_operator_module():
+    # operator.py shadows the standard library module of the same name, so it is loaded by path
+    spec = importlib.util.spec_from_file_location('governor_operator', os.path.join(REPO_DIR, 'operator.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def loop_stop(self):
+        pass
+
+
+def sut_subscriptions(client_id, command_topic, routing):
+    if routing == topics.ROUTING_SHARED:
+        return [command_topic]
+    return [topics.client_command_topic(command_topic, client_id), topics.broadcast_command_topic(command_topic),
+            topics.batch_command_topic(command_topic)]
+
+
+def count_deliveries(published, subscriptions):
+    deliveries = 0
+    for topic, _ in published:
+        for subs in subscriptions:
+            if any(mqtt.topic_matches_sub(sub, topic) for sub in subs):
+                deliveries += 1
+    return deliveries
+
+
+def make_operator(operator_module, client_ids, routing):
+    operator = operator_module.Operator('localhost', 1883, 'bench/commands', 'bench/responses', 'bench/registration',
+                                        'bench/ack', 'bench/command_loader', 0, {}, False, False, True, False, False,
+                                        'bench_feedback.txt', False, command_routing=routing)
+    for client_id in client_ids:
+        operator._registry.register(client_id, {"batch": True})
+    operator._client = RecordingClient()
+    return operator
+
+
+def bench_topics(args):
+    import color_log
+    # Logging runs on a background writer that redirect_stdout does not reach
+    color_log.configure(log_level='error')
+    operator_module = load_operator_module()
+    client_ids = [f"client{i}" for i in range(args.clients)]
+    print(f"Broker deliveries for {args.clients} SUTs (SUTs use the operator's layout, 'both' assumes new SUTs)")
+    print(f"{'routing':<12}{'scenario':<16}{'publishes':>12}{'deliveries':>14}{'per command':>14}{'seconds':>10}")
+    for routing in topics.ROUTING_MODES:
+        sut_routing = topics.ROUTING_SHARED if routing == topics.ROUTING_SHARED else topics.ROUTING_PER_CLIENT
+        subscriptions = [sut_subscriptions(client_id, 'bench/commands', sut_routing) for client_id in client_ids]
+        scenarios = (
+            ('broadcast', lambda op: op.send_command_to_all_clients('true'), 1),
+            ('one per client', lambda op: [op.send_command_to_client(c, 'true') for c in client_ids], len(client_ids)),
+            ('half, batched', lambda op: op.send_command_to_clients(client_ids[::2], 'true'), len(client_ids[::2])),
+        )
+        for name, dispatch, commands in scenarios:
+            operator = make_operator(operator_module, client_ids, routing)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                dispatch(operator)
+            elapsed = time.perf_counter() - start
+            published = operator._client.published
+            deliveries = count_deliveries(published, subscriptions)
+            print(f"{routing:<12}{name:<16}{len(published):>12}{deliveries:>14}{deliveries / commands:>14.1f}"
+                  f"{elapsed:>10.4f}")
+
+
+def run_sut_commands(commands, max_workers, parallel_commands, timeout=120):
+    sut = SUT('bench1', 'localhost', 1883, 'bench/commands', 'bench/responses', 'bench/registration', 'bench/ack',
+              True, False, max_workers=max_workers, parallel_commands=parallel_commands)
+    recorder = RecordingClient()
+    sut._client = recorder
+    sut._ack_received.set()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for command in commands:
+            payload = json.dumps({"client_id": 'bench1', "command": command}).encode()
+            sut.on_message(None, None, SimpleNamespace(topic=topics.client_command_topic('bench/commands', 'bench1'),
+                                                       payload=payload))
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            feedback = [json.loads(p) for t, p in recorder.published if t == 'bench/responses']
+            if len(feedback) >= len(commands):
+                break
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - start
+        sut.stop()
+    return feedback, elapsed
+
+
+def bench_sut(args):
+    probes = [args.probe] * args.commands
+    scenarios = (
+        ('serial only', 1, []),
+        (f'{args.workers} parallel', args.workers, [args.probe]),
+    )
+    print(f"SUT throughput for {args.commands} x '{args.probe}' queued behind '{args.blocker}'")
+    print(f"{'engine':<16}{'seconds':>10}{'probes/s':>12}{'probe wait p50':>16}{'probe wait max':>16}")
+    for name, workers, parallel_commands in scenarios:
+        feedback, elapsed = run_sut_commands([args.blocker] + probes, workers, parallel_commands)
+        waits = sorted(float(f['queue_wait']) for f in feedback if f['command'] == args.probe)
+        probe_done = max(float(f['end_time']) for f in feedback if f['command'] == args.probe)
+        probe_start = min(float(f['start_time']) - float(f['queue_wait']) for f in feedback)
+        print(f"{name:<16}{elapsed:>10.2f}{len(waits) / (probe_done - probe_start):>12.1f}"
+              f"{waits[len(waits) // 2]:>16.4f}{waits[-1]:>16.4f}")
+
+
+def bench_feedback(args):
+    line = json.dumps({"client_id": 'client1', "command": 'true', "start_time": '0', "end_time": '0',
+                       "output": 'x' * args.size, "error": 'None'})
+    print(f"Feedback ingest of {args.messages} messages of {len(line)} bytes")
+    print(f"{'writer':<28}{'ingest msg/s':>14}{'ingest max ms':>15}{'durable s':>11}{'dropped':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        def legacy(path):
+            # The operator used to reopen the feedback file for every message on the network thread
+            def write(feedback):
+                with open(path, 'a') as f:
+                    f.write(feedback + '\n')
+            return write, None
+
+        def buffered(path, fsync_policy, overflow):
+            writer = FeedbackWriter(path, queue_size=args.queue_size, fsync_policy=fsync_policy, overflow=overflow)
+            writer.start()
+            return lambda feedback: writer.write(feedback + '\n'), writer
+
+        scenarios = (
+            ('open per message', legacy),
+            ('writer, block', lambda path: buffered(path, 'never', 'block')),
+            ('writer, block, fsync batch', lambda path: buffered(path, 'batch', 'block')),
+            ('writer, drop', lambda path: buffered(path, 'never', 'drop')),
+        )
+        for index, (name, make_writer) in enumerate(scenarios):
+            write, writer = make_writer(os.path.join(directory, f"feedback{index}.txt"))
+            slowest = 0
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(args.messages):
+                    before = time.perf_counter()
+                    write(line)
+                    slowest = max(slowest, time.perf_counter() - before)
+            ingest = time.perf_counter() - start
+            dropped = 0
+            if writer is not None:
+                writer.close()
+                dropped = writer.stats()['dropped']
+            durable = time.perf_counter() - start
+            print(f"{name:<28}{args.messages / ingest:>14.0f}{slowest * 1000:>15.3f}{durable:>11.2f}{dropped:>9}")
+
+
+def write_synthetic_feedback(path, size_mb, clients, pipelines, start_time):
+    target = size_mb * 1024 * 1024
+    output = 'stress-ng: info:  [1234] cpu 12345 60.00 240.00 0.01 205.75 51.44\n' * 8
+    written = 0
+    index = 0
+    with open(path, 'w') as f:
+        while written < target:
+            pipeline = index % pipelines + 1
+            start = start_time + index * 0.01
+            line = json.dumps({"client_id": f"client{index % clients}", "command": 'stress-ng --cpu 0 --timeout 60s',
+                               "start_time": f"{start}", "end_time": f"{start + 60}", "queue_wait": '0.001',
+                               "output": output, "error": 'None', "pipeline": f"pipeline{pipeline}", "step": 1})
+            f.write(line + '\n')
+            written += len(line) + 1
+            index += 1
+    return index
+
+
+def measure_in_child(function, *args):
+    # Runs in a forked process so peak memory is measured per approach
+    def child(queue):
+        start = time.perf_counter()
+        result = function(*args)
+        queue.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, result))
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=child, args=(queue,))
+    process.start()
+    elapsed, max_rss, result = queue.get()
+    process.join()
+    return elapsed, max_rss / 1024, result
+
+
+def bench_store(args):
+    from feedback_store import FeedbackStore
+
+    def legacy_query(path, client_id, pipeline, since):
+        entries = json_feedback.parse_feedback(path)
+        return sum(1 for e in entries if e['client_id'] == client_id and e.get('pipeline') == pipeline
+                   and float(e['start_time']) >= since)
+
+    def build_index(path):
+        return FeedbackStore(path).update()
+
+    def store_query(path, client_id, pipeline, since):
+        store = FeedbackStore(path)
+        store.update()
+        return sum(1 for _ in store.query(client_id=client_id, pipeline=pipeline, since=since))
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        path = os.path.join(directory, 'feedback.txt')
+        start_time = time.time() - 86400
+        entries = write_synthetic_feedback(path, args.size_mb, args.clients, 13, start_time)
+        since = start_time + entries * 0.01 - 3600
+        print(f"Feedback store on {os.path.getsize(path) / 1024 / 1024:.0f} MB, {entries} entries, "
+              f"query: pipeline7 on client12 in the last hour")
+        print(f"{'approach':<24}{'seconds':>10}{'peak RSS MB':>14}{'matches':>10}")
+        scenarios = (
+            ('parse_feedback + filter', legacy_query, (path, 'client12', 'pipeline7', since)),
+            ('index build', build_index, (path,)),
+            ('indexed query', store_query, (path, 'client12', 'pipeline7', since)),
+        )
+        for name, function, function_args in scenarios:
+            elapsed, max_rss, result = measure_in_child(function, *function_args)
+            print(f"{name:<24}{elapsed:>10.2f}{max_rss:>14.0f}{result:>10}")
+
+
+def bench_codec(args):
+    import codec
+    output = ''.join(f"stress-ng: info:  [{i}] cpu {i * 997} 60.00 239.90 0.05 2057.60 514.51\n"
+                     for i in range(args.size // 64 + 1))[:args.size]
+    feedback = {"client_id": "client12", "command": "stress-ng --cpu 0 --timeout 60s --metrics-brief",
+                "start_time": 1718000000.123456, "end_time": 1718000060.654321, "queue_wait": 0.000812,
+                "output": output, "error": None, "pipeline": "pipeline7", "step": 1}
+    print(f"Feedback codec, {args.size} bytes of output, {args.messages} messages")
+    print(f"{'format':<16}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    scenarios = (
+        ('json', codec.FORMAT_JSON, 0),
+        ('text', codec.FORMAT_TEXT, 0),
+        ('binary', codec.FORMAT_BINARY, 0),
+        ('binary + zlib', codec.FORMAT_BINARY, 1),
+    )
+    for name, wire_format, compress_threshold in scenarios:
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            payload = codec.encode_feedback(wire_format, feedback, compress_threshold)
+        encode = (time.perf_counter() - start) / args.messages * 1e6
+        if isinstance(payload, str):
+            payload = payload.encode()
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            codec.decode_feedback(payload)
+        decode = (time.perf_counter() - start) / args.messages * 1e6
+        print(f"{name:<16}{len(payload):>8}{encode:>12.2f}{decode:>12.2f}")
+
+
+class FakeSUT(SUT):
+    # Skips the shell: every command "prints" output_size bytes
+    def __init__(self, *args, output_size=64, **kwargs):
+        self._fake_output = 'x' * output_size
+        super().__init__(*args, **kwargs)
+
+    def _run_process(self, command):
+        return SimpleNamespace(stdout=self._fake_output, stderr='')
+
+    async def _run_process_async(self, command):
+        return self._run_process(command)
+
+
+def _usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+
+
+def _measure_window(measuring, done):
+    # CPU seconds spent between the two events and peak RSS in MB of the calling process
+    measuring.wait()
+    cpu_start, _ = _usage()
+    done.wait()
+    cpu_end, max_rss = _usage()
+    return cpu_end - cpu_start, max_rss
+
+
+def _load_broker(ready, measuring, done, stop, results):
+    from mini_broker import MiniBroker
+    broker = MiniBroker('127.0.0.1', 0)
+    broker.start()
+    ready.put(('broker', broker.port))
+    cpu, max_rss = _measure_window(measuring, done)
+    results.put(('broker', cpu, max_rss))
+    # Outlives the clients, so none of them loses its connection while shutting down
+    stop.wait()
+    broker.stop()
+
+
+def _load_operator(host, port, clients, qos, ready, measuring, done, results):
+    import color_log
+    color_log.configure(log_level='error')
+    operator_module = load_operator_module()
+    operator = operator_module.Operator(host, port, 'bench/commands', 'bench/responses', 'bench/registration',
+                                        'bench/ack', 'bench/command_loader', 0, {}, False, False, True, False, False,
+                                        'bench_feedback.txt', True, qos=qos)
+    operator._client.connect(host, port, keepalive=60)
+    operator._client.loop_start()
+    registered = operator._registry.wait_for_clients(0.5, clients, 120)
+    ready.put(('operator', len(registered)))
+    cpu, max_rss = _measure_window(measuring, done)
+    results.put(('operator', cpu, max_rss))
+    operator._client.disconnect()
+
+
+def _load_suts(host, port, clients, size, qos, executor, ready, measuring, done, results):
+    import color_log
+    color_log.configure(log_level='error')
+    suts = [FakeSUT(f"sut{i}", host, port, 'bench/commands', 'bench/responses', 'bench/registration', 'bench/ack',
+                    True, False, qos=qos, delivery_receipts=True, executor=executor, output_size=size)
+            for i in range(clients)]
+    for sut in suts:
+        sut.run()
+    ready.put(('suts', clients))
+    cpu, max_rss = _measure_window(measuring, done)
+    results.put(('suts', cpu, max_rss))
+    for sut in suts:
+        sut.stop()
+        sut._client.disconnect()
+
+
+def run_load(host, port, clients, size, rate, duration, qos, broker=True, executor='threads', window=1000,
+             drain_idle=5.0):
+    # rate 0 sends as fast as the system completes commands, with at most window commands outstanding. After the
+    # sending phase, feedback is awaited until it stops arriving for drain_idle seconds.
+    from commander import BaseCommander
+    context = multiprocessing.get_context('fork')
+    ready, results = context.Queue(), context.Queue()
+    measuring, done, stop_broker = context.Event(), context.Event(), context.Event()
+    processes = []
+    if broker:
+        processes.append(context.Process(target=_load_broker, args=(ready, measuring, done, stop_broker, results)))
+        processes[-1].start()
+        _, port = ready.get()
+    processes.append(context.Process(target=_load_operator,
+                                     args=(host, port, clients, qos, ready, measuring, done, results)))
+    processes.append(context.Process(target=_load_suts,
+                                     args=(host, port, clients, size, qos, executor, ready, measuring, done,
+                                           results)))
+    for process in processes[-2:]:
+        process.start()
+    for _ in range(2):
+        ready.get()
+
+    sent_at = {}
+    latencies = []
+    received_at = []
+    outstanding = threading.Semaphore(window)
+
+    class LoadCommander(BaseCommander):
+        def on_message(self, client, userdata, msg):
+            feedback = json.loads(msg.payload)
+            sent = sent_at.pop(feedback.get('command'), None)
+            if sent is not None and 'output' in feedback:
+                now = time.perf_counter()
+                latencies.append(now - sent)
+                received_at.append(now)
+                outstanding.release()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        commander = LoadCommander(host, port, 'bench/command_loader', 'bench/responses', True, qos=qos)
+        commander.connect()
+        time.sleep(0.5)
+        measuring.set()
+        cpu_start, _ = _usage()
+        start = time.perf_counter()
+        sent = 0
+        while True:
+            remaining = start + duration - time.perf_counter()
+            if remaining <= 0:
+                break
+            if rate:
+                delay = start + sent / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            elif not outstanding.acquire(timeout=remaining):
+                break
+            command = f"true #{sent}"
+            sent_at[command] = time.perf_counter()
+            commander.send_command(f"sut{sent % clients}", command)
+            sent += 1
+        # Drains the commands still under way; whatever has not arrived once feedback stops coming is lost
+        last_count, last_progress = len(latencies), time.perf_counter()
+        while len(latencies) < sent and time.perf_counter() - last_progress < drain_idle:
+            time.sleep(0.05)
+            if len(latencies) != last_count:
+                last_count, last_progress = len(latencies), time.perf_counter()
+        wall = time.perf_counter() - start
+        cpu_end, commander_rss = _usage()
+        done.set()
+        commander.disconnect()
+    usage = {'commander': (cpu_end - cpu_start, commander_rss)}
+    for _ in processes:
+        name, cpu, max_rss = results.get()
+        usage[name] = (cpu, max_rss)
+    # The clients exit before the broker stops, so none of them loses its connection on the way out
+    for process in processes[int(broker):]:
+        process.join()
+    stop_broker.set()
+    for process in processes[:int(broker)]:
+        process.join()
+    latencies.sort()
+    elapsed = (received_at[-1] - start) if received_at else wall
+    return {
+        "sent": sent,
+        "received": len(latencies),
+        "lost": sent - len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": latencies[len(latencies) // 2] if latencies else float('nan'),
+        "p99": latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] if latencies else float('nan'),
+        "usage": {name: (cpu / wall * 100, max_rss) for name, (cpu, max_rss) in usage.items()},
+    }
+
+
+def bench_load(args):
+    host, port, broker = '127.0.0.1', 0, True
+    if args.broker:
+        host, _, port = args.broker.partition(':')
+        port, broker = int(port or 1883), False
+    components = ('broker', 'operator', 'suts', 'commander') if broker else ('operator', 'suts', 'commander')
+    print(f"Load test against {'the embedded mini broker' if broker else args.broker}, {args.duration}s per run, "
+          f"QoS {args.qos}, {args.executor} SUT executor; CPU in % of one core, peak RSS in MB")
+    header = (f"{'clients':>8}{'size':>7}{'rate':>7}{'sent':>8}{'recv':>8}{'lost':>7}{'cmd/s':>9}{'p50 ms':>9}"
+              f"{'p99 ms':>9}")
+    print(header + ''.join(f"{name + ' cpu/MB':>18}" for name in components))
+    for clients in args.clients:
+        for size in args.sizes:
+            for rate in args.rates:
+                result = run_load(host, port, clients, size, rate, args.duration, args.qos, broker, args.executor,
+                                  args.window)
+                line = (f"{clients:>8}{size:>7}{rate or 'max':>7}{result['sent']:>8}{result['received']:>8}"
+                        f"{result['lost']:>7}{result['throughput']:>9.0f}{result['p50'] * 1000:>9.1f}"
+                        f"{result['p99'] * 1000:>9.1f}")
+                for name in components:
+                    cpu, max_rss = result['usage'][name]
+                    line += f"{cpu:>11.0f}/{max_rss:<6.0f}"
+                print(line)
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the MQTT system governor.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    topics_parser = subparsers.add_parser('topics', help='Count broker deliveries per dispatched command.')
+    topics_parser.add_argument('--clients', type=int, default=200, help='Number of simulated SUTs.')
+    topics_parser.set_defaults(func=bench_topics)
+    sut_parser = subparsers.add_parser('sut', help='Measure SUT throughput on short commands behind a long one.')
+    sut_parser.add_argument('--commands', type=int, default=200, help='Number of short probe commands.')
+    sut_parser.add_argument('--workers', type=int, default=4, help='Parallel lane workers.')
+    sut_parser.add_argument('--probe', type=str, default='cat /proc/stat', help='Short probe command.')
+    sut_parser.add_argument('--blocker', type=str, default='sleep 2', help='Long command queued first.')
+    sut_parser.set_defaults(func=bench_sut)
+    feedback_parser = subparsers.add_parser('feedback', help='Measure sustained feedback ingest rate of the operator.')
+    feedback_parser.add_argument('--messages', type=int, default=100000, help='Number of feedback messages.')
+    feedback_parser.add_argument('--size', type=int, default=512, help='Size of the command output in bytes.')
+    feedback_parser.add_argument('--queue-size', type=int, default=10000, help='Feedback writer queue size.')
+    feedback_parser.set_defaults(func=bench_feedback)
+    store_parser = subparsers.add_parser('store', help='Compare indexed feedback queries with parse_feedback.')
+    store_parser.add_argument('--size-mb', type=int, default=2048, help='Size of the synthetic feedback file.')
+    store_parser.add_argument('--clients', type=int, default=50, help='Number of clients in the synthetic file.')
+    store_parser.add_argument('--dir', type=str, default=None, help='Directory for the synthetic file.')
+    store_parser.set_defaults(func=bench_store)
+    codec_parser = subparsers.add_parser('codec', help='Compare feedback size and encode/decode cost per wire format.')
+    codec_parser.add_argument('--messages', type=int, default=20000, help='Number of messages per format.')
+    codec_parser.add_argument('--size', type=int, default=2048, help='Size of the command output in bytes.')
+    codec_parser.set_defaults(func=bench_codec)
+    load_parser = subparsers.add_parser('load', help='Run operator, simulated SUTs and a commander against a broker.')
+    load_parser.add_argument('--clients', type=_int_list, default=[10, 50], help='Comma separated client counts.')
+    load_parser.add_argument('--sizes', type=_int_list, default=[64, 4096], help='Comma separated output sizes.')
+    load_parser.add_argument('--rates', type=_int_list, default=[200, 0],
+                             help='Comma separated commands per second, 0 sends as fast as possible.')
+    load_parser.add_argument('--duration', type=float, default=5, help='Seconds of load per run.')
+    load_parser.add_argument('--qos', type=int, default=0, help='MQTT QoS for all messages.')
+    load_parser.add_argument('--window', type=int, default=1000,
+                             help='Commands outstanding at once in runs at the maximum rate.')
+    load_parser.add_argument('--broker', type=str, default=None,
+                             help='host:port of an external broker such as mosquitto instead of the embedded one.')
+    load_parser.add_argument('--executor', type=str, default='threads', choices=('threads', 'asyncio'),
+                             help='How the simulated SUTs run commands.')
+    load_parser.set_defaults(func=bench_load)
+    args = parser.parse_args()
+    args.func(args)
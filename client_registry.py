@@ -0,0 +1,214 @@
+import fnmatch
+import re
+import time
+from threading import Condition
+
+# Targets of a batched command: client IDs, glob patterns such as 'rack2-*', group:<name> entries and tag
+# selectors such as 'arch=arm64,cores>=8' whose conditions must all hold
+GROUP_PREFIX = 'group:'
+_GLOB_CHARACTERS = ('*', '?', '[')
+_TAG_OPERATORS = ('=', '<', '>')
+_CONDITION = re.compile(r'\s*([\w.\-]+)\s*(>=|<=|!=|=|>|<)\s*(.*?)\s*')
+_COMPARISONS = {
+    '>=': lambda value, limit: value >= limit,
+    '<=': lambda value, limit: value <= limit,
+    '>': lambda value, limit: value > limit,
+    '<': lambda value, limit: value < limit,
+}
+
+
+def is_selector(target: str) -> bool:
+    # True for targets that may match several clients
+    return target.startswith(GROUP_PREFIX) or _is_pattern(target) or _is_tag_selector(target)
+
+
+def parse_group(value: str) -> list:
+    # A [groups] option: entries separated by ';', each either a tag selector, whose own commas join its
+    # conditions, or a comma separated list of client IDs and glob patterns, e.g. 'arch=arm64,cores>=8; pi-*, jetson1'
+    targets = []
+    for entry in value.split(';'):
+        entry = entry.strip()
+        if _is_tag_selector(entry):
+            for condition in entry.split(','):
+                if _CONDITION.fullmatch(condition) is None:
+                    raise ValueError(f"Invalid tag condition '{condition.strip()}' in group entry '{entry}', "
+                                     f"separate selectors from client IDs with ';'")
+            targets.append(entry)
+        else:
+            targets.extend(target.strip() for target in entry.split(',') if target.strip())
+    return targets
+
+
+def _is_pattern(target: str) -> bool:
+    return any(character in target for character in _GLOB_CHARACTERS)
+
+
+def _is_tag_selector(target: str) -> bool:
+    return any(character in target for character in _TAG_OPERATORS)
+
+
+def _tag_values(info) -> list:
+    # (key, value) pairs of a client's tags; list values such as the cpufreq governors count as several values
+    pairs = []
+    for key, values in ((info or {}).get('tags') or {}).items():
+        for value in values if isinstance(values, list) else [values]:
+            pairs.append((key, str(value).lower() if isinstance(value, bool) else str(value)))
+    return list(dict.fromkeys(pairs))
+
+
+class ClientRegistry:
+    def __init__(self):
+        self._condition = Condition()
+        self._clients = {}
+        # Inverted tag index: key -> value -> client IDs, so selectors never scan the fleet
+        self._tags = {}
+        self._last_registration = None
+        self._listeners = []
+
+    def register(self, client_id, info: dict = None) -> bool:
+        with self._condition:
+            if client_id in self._clients:
+                # A re-registration may announce changed details, e.g. after the client restarted
+                if info is not None:
+                    self._unindex(client_id)
+                    self._clients[client_id] = info
+                    self._index(client_id)
+                return False
+            self._clients[client_id] = info or {}
+            self._index(client_id)
+            self._last_registration = time.monotonic()
+            listeners = list(self._listeners)
+            self._condition.notify_all()
+        # Listeners may publish, so they run outside the registry lock
+        for listener in listeners:
+            listener(client_id)
+        return True
+
+    def unregister(self, client_id) -> bool:
+        with self._condition:
+            if client_id not in self._clients:
+                return False
+            self._unindex(client_id)
+            del self._clients[client_id]
+            return True
+
+    def _index(self, client_id):
+        for key, value in _tag_values(self._clients[client_id]):
+            self._tags.setdefault(key, {}).setdefault(value, set()).add(client_id)
+
+    def _unindex(self, client_id):
+        for key, value in _tag_values(self._clients[client_id]):
+            values = self._tags[key]
+            values[value].discard(client_id)
+            if not values[value]:
+                del values[value]
+            if not values:
+                del self._tags[key]
+
+    def match_tags(self, selector: str) -> set:
+        # Clients satisfying every comma separated condition, e.g. 'arch=arm64,cores>=8,governors=performance'
+        matched = None
+        with self._condition:
+            for condition in selector.split(','):
+                parsed = _CONDITION.fullmatch(condition)
+                if parsed is None:
+                    raise ValueError(f"Invalid tag condition '{condition.strip()}' in '{selector}'")
+                clients = self._match_condition(*parsed.groups())
+                matched = clients if matched is None else matched & clients
+                if not matched:
+                    break
+        return matched or set()
+
+    def _match_condition(self, key, operator, wanted) -> set:
+        values = self._tags.get(key, {})
+        if operator == '=':
+            return set(values.get(wanted, ()))
+        if operator == '!=':
+            return set(self._clients) - values.get(wanted, set())
+        try:
+            limit = float(wanted)
+        except ValueError:
+            raise ValueError(f"Tag condition '{key}{operator}{wanted}' needs a number") from None
+        compare = _COMPARISONS[operator]
+        # Distinct values of a tag are few, e.g. a handful of core counts across the fleet
+        matched = set()
+        for value, clients in values.items():
+            try:
+                if compare(float(value), limit):
+                    matched |= clients
+            except ValueError:
+                continue
+        return matched
+
+    def add_listener(self, listener):
+        with self._condition:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._condition:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def info(self, client_id) -> dict:
+        with self._condition:
+            return self._clients.get(client_id)
+
+    def snapshot(self) -> list:
+        with self._condition:
+            return list(self._clients)
+
+    def clients(self) -> dict:
+        # client_id -> info copied under one lock acquisition, so dispatching never holds the lock
+        with self._condition:
+            return dict(self._clients)
+
+    def select(self, targets, groups: dict = None) -> list:
+        # Resolves targets against the registered clients; plain IDs are kept even if they did not register
+        registered = self.snapshot()
+        selected = {}
+        for target in targets:
+            if target.startswith(GROUP_PREFIX):
+                name = target[len(GROUP_PREFIX):]
+                if not groups or name not in groups:
+                    raise ValueError(f"Unknown client group '{name}'")
+                patterns = groups[name]
+            else:
+                patterns = (target,)
+            for pattern in patterns:
+                if _is_tag_selector(pattern):
+                    selected.update(dict.fromkeys(sorted(self.match_tags(pattern))))
+                elif _is_pattern(pattern):
+                    selected.update(dict.fromkeys(client_id for client_id in registered
+                                                  if fnmatch.fnmatchcase(client_id, pattern)))
+                else:
+                    selected[pattern] = None
+        return list(selected)
+
+    def wait_for_clients(self, quiet_period: float, min_clients: int = 1, deadline: float = None) -> list:
+        # Returns once at least min_clients registered and nobody else registered for quiet_period seconds,
+        # or once the overall deadline passes, whichever comes first
+        end = time.monotonic() + deadline if deadline else None
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if end is not None and now >= end:
+                    break
+                if len(self._clients) >= max(min_clients, 1):
+                    quiet_until = self._last_registration + quiet_period
+                    if now >= quiet_until:
+                        break
+                    timeout = quiet_until - now
+                else:
+                    timeout = None
+                if end is not None:
+                    timeout = end - now if timeout is None else min(timeout, end - now)
+                self._condition.wait(timeout)
+            return list(self._clients)
+
+    def __contains__(self, client_id):
+        with self._condition:
+            return client_id in self._clients
+
+    def __len__(self):
+        with self._condition:
+            return len(self._clients)
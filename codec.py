@@ -0,0 +1,411 @@
+import json
+import struct
+import zlib
+from feedback_stream import FEEDBACK_CHUNK, FEEDBACK_FINAL, FEEDBACK_RECEIVED
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMAT_JSON = 'json'
+FORMAT_TEXT = 'text'
+FORMAT_BINARY = 'binary'
+FORMATS = (FORMAT_BINARY, FORMAT_JSON, FORMAT_TEXT)
+
+# Binary frames: magic, version, flags, then the body; JSON always starts with '{' and text never with the magic byte
+BINARY_MAGIC = 0xB7
+BINARY_VERSION = 1
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+FRAME_HEADER = struct.Struct('<BBB')
+
+# Keys are sent as a one byte index into this table; append only, the index is part of the wire format
+KNOWN_KEYS = ('client_id', 'command', 'start_time', 'end_time', 'queue_wait', 'output', 'error', 'pipeline', 'step',
+              'stream', 'lane', 'type', 'run_id', 'channel', 'seq', 'data', 'exit_code', 'chunks', 'formats',
+              'format', 'telemetry', 'command_id', 'features', 'trace', 'targets', 'output_spill')
+KEY_IDS = {key: key_id for key_id, key in enumerate(KNOWN_KEYS)}
+INLINE_KEY = 0xFF
+
+# Compression of binary frames; zstd needs the optional zstandard package on both ends
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSIONS = (COMPRESSION_ZLIB, COMPRESSION_ZSTD)
+
+# JSON and text feedback keep timestamps as strings for older readers, binary sends them as doubles
+TIMESTAMP_FIELDS = ('start_time', 'end_time', 'queue_wait')
+
+# The text format carries a command_id as a trailing shell comment on the command: clients of any version run it
+# harmlessly and echo it back in the Command line of their feedback
+COMMAND_ID_TAG = ' #command_id='
+
+
+class CodecError(ValueError):
+    pass
+
+
+# Types of the fields code reading a decoded message relies on; None means the field is optional
+_COMMAND_FIELDS = {'client_id': (str, list), 'command': str, 'command_id': (str, None), 'lane': (str, None),
+                   'targets': (list, None), 'trace': (dict, None)}
+_FEEDBACK_FIELDS = {'client_id': str, 'command_id': (str, None)}
+_FEEDBACK_TYPE_FIELDS = {
+    FEEDBACK_RECEIVED: {'command_id': str},
+    FEEDBACK_CHUNK: {'run_id': str, 'seq': int, 'channel': str, 'data': str},
+    FEEDBACK_FINAL: {'run_id': str, 'chunks': (int, None)},
+}
+
+
+T_NONE, T_FALSE, T_TRUE, T_INT, T_FLOAT, T_STR, T_BYTES, T_LIST, T_DICT = range(9)
+_DOUBLE = struct.Struct('<d')
+_INT = struct.Struct('<q')
+_LENGTH = struct.Struct('<I')
+_INT_MIN, _INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def validate_format(wire_format: str) -> str:
+    wire_format = wire_format.strip().lower()
+    if wire_format not in FORMATS:
+        raise ValueError(f"Unknown wire format '{wire_format}', expected one of: {', '.join(FORMATS)}")
+    return wire_format
+
+
+def validate_compression(compression: str) -> str:
+    compression = compression.strip().lower()
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression '{compression}', expected one of: {', '.join(COMPRESSIONS)}")
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package")
+    return compression
+
+
+def available_compressions() -> list:
+    return [COMPRESSION_ZSTD, COMPRESSION_ZLIB] if zstandard is not None else [COMPRESSION_ZLIB]
+
+
+def default_format(jsonify: bool) -> str:
+    return FORMAT_JSON if jsonify else FORMAT_TEXT
+
+
+def detect_format(payload) -> str:
+    if isinstance(payload, str):
+        return FORMAT_JSON if payload.startswith('{') else FORMAT_TEXT
+    if payload[:1] == bytes((BINARY_MAGIC,)):
+        return FORMAT_BINARY
+    return FORMAT_JSON if payload[:1] == b'{' else FORMAT_TEXT
+
+
+def encode_command(wire_format: str, message: dict):
+    if wire_format == FORMAT_BINARY:
+        return encode_binary(message)
+    if wire_format == FORMAT_JSON:
+        return json.dumps(message)
+    return f"{message['client_id']}|{tag_command(message['command'], message.get('command_id'))}"
+
+
+def tag_command(command: str, command_id: str = None) -> str:
+    return f"{command}{COMMAND_ID_TAG}{command_id}" if command_id else command
+
+
+def split_command_tag(command: str):
+    # Returns the command without its tag and the command_id, or None if the command carries none
+    untagged, tag, command_id = command.rpartition(COMMAND_ID_TAG)
+    if not tag or not command_id or not all(c in '0123456789abcdef' for c in command_id):
+        return command, None
+    return untagged, command_id
+
+
+def decode_command(payload) -> dict:
+    try:
+        return _decode_command(payload)
+    except (ValueError, IndexError, KeyError, struct.error, zlib.error) as e:
+        raise CodecError(f"Failed to decode command: {e}") from e
+
+
+def _decode_command(payload) -> dict:
+    wire_format = detect_format(payload)
+    if wire_format == FORMAT_BINARY:
+        return _check_fields(decode_binary(payload), _COMMAND_FIELDS, 'Command')
+    text = payload if isinstance(payload, str) else payload.decode()
+    if wire_format == FORMAT_JSON:
+        return _check_fields(json.loads(text), _COMMAND_FIELDS, 'Command')
+    client_id, command = text.split('|', 1)
+    command, command_id = split_command_tag(command)
+    message = {"client_id": client_id, "command": command}
+    if command_id is not None:
+        message["command_id"] = command_id
+    return message
+
+
+def encode_feedback(wire_format: str, feedback: dict, compress_threshold: int = 0,
+                    compression: str = COMPRESSION_ZLIB):
+    if wire_format == FORMAT_BINARY:
+        return encode_binary(feedback, compress_threshold, compression)
+    feedback = {key: f"{value}" if key in TIMESTAMP_FIELDS and value is not None else value
+                for key, value in feedback.items()}
+    if wire_format == FORMAT_JSON:
+        return json.dumps(feedback)
+    lines = [f"Client: {feedback.get('client_id')}",
+             f"Command: {tag_command(str(feedback.get('command')), feedback.get('command_id'))}"]
+    if 'start_time' in feedback:
+        lines.append(f"Start Time: {feedback['start_time']}")
+    if 'end_time' in feedback:
+        lines.append(f"End Time: {feedback['end_time']}")
+    if 'queue_wait' in feedback:
+        lines.append(f"Queue Wait: {feedback['queue_wait']}")
+    if 'output' in feedback:
+        lines.append(f"Output: {feedback['output']}")
+    lines.append(f"Error: {feedback.get('error', 'None')}")
+    return '\n'.join(lines)
+
+
+_TEXT_FIELDS = (('Client: ', 'client_id'), ('Command: ', 'command'), ('Start Time: ', 'start_time'),
+                ('End Time: ', 'end_time'), ('Queue Wait: ', 'queue_wait'))
+
+
+def decode_feedback(payload) -> dict:
+    try:
+        return _decode_feedback(payload)
+    except (ValueError, IndexError, KeyError, struct.error, zlib.error) as e:
+        raise CodecError(f"Failed to decode feedback: {e}") from e
+
+
+def _decode_feedback(payload) -> dict:
+    wire_format = detect_format(payload)
+    if wire_format == FORMAT_BINARY:
+        return _check_feedback(decode_binary(payload))
+    text = payload if isinstance(payload, str) else payload.decode()
+    if wire_format == FORMAT_JSON:
+        return _check_feedback(json.loads(text))
+    feedback = {}
+    rest = text
+    for prefix, key in _TEXT_FIELDS:
+        if rest.startswith(prefix):
+            value, _, rest = rest[len(prefix):].partition('\n')
+            feedback[key] = value
+    # Output may span several lines, the error always comes last
+    if rest.startswith('Output: '):
+        output, _, error = rest[len('Output: '):].rpartition('\nError: ')
+        feedback['output'] = output
+        feedback['error'] = error
+    elif rest.startswith('Error: '):
+        feedback['error'] = rest[len('Error: '):]
+    if 'command' in feedback:
+        feedback['command'], command_id = split_command_tag(feedback['command'])
+        if command_id is not None:
+            feedback['command_id'] = command_id
+    return _check_feedback(feedback)
+
+
+def _check_feedback(feedback) -> dict:
+    _check_fields(feedback, _FEEDBACK_FIELDS, 'Feedback')
+    return _check_fields(feedback, _FEEDBACK_TYPE_FIELDS.get(feedback.get('type'), {}), 'Feedback')
+
+
+def _check_fields(message, fields: dict, what: str) -> dict:
+    # Malformed messages fail here rather than in the MQTT callbacks using them
+    if not isinstance(message, dict):
+        raise ValueError(f"{what} is not an object")
+    for key, types in fields.items():
+        types = types if isinstance(types, tuple) else (types,)
+        value = message.get(key)
+        if value is None and None in types:
+            continue
+        if not isinstance(value, tuple(t for t in types if t is not None)):
+            raise ValueError(f"{what} has no valid {key}" if value is None else
+                             f"{what} field {key} has the wrong type {type(value).__name__}")
+    for key in ('client_id', 'targets'):
+        if isinstance(message.get(key), list) and not all(isinstance(item, str) for item in message[key]):
+            raise ValueError(f"{what} field {key} must list strings")
+    return message
+
+
+def encode_registration(client_id: str, formats=None, features=None, tags: dict = None) -> str:
+    registration = {"client_id": client_id}
+    if formats:
+        registration["formats"] = list(formats)
+    if features:
+        registration["features"] = list(features)
+    if tags:
+        registration["tags"] = tags
+    return json.dumps(registration)
+
+
+def decode_registration(payload: str) -> dict:
+    # Older clients register with their bare client_id
+    if not payload.startswith('{'):
+        return {"client_id": payload}
+    try:
+        registration = json.loads(payload)
+    except json.JSONDecodeError as e:
+        raise CodecError(f"Failed to decode registration: {e}") from e
+    if not isinstance(registration, dict) or not registration.get('client_id'):
+        raise CodecError("Registration must be a JSON object with a client_id")
+    return registration
+
+
+def negotiate_format(formats, fallback: str) -> str:
+    for wire_format in formats:
+        if wire_format in FORMATS:
+            return wire_format
+    return fallback
+
+
+def encode_ack(client_id: str, wire_format: str, response_topic: str = None, compressions=None) -> str:
+    ack = {"client_id": client_id, "format": wire_format}
+    if response_topic:
+        ack["response_topic"] = response_topic
+    if compressions:
+        # Binary frame compressions the operator can decode
+        ack["compression"] = list(compressions)
+    return json.dumps(ack)
+
+
+def decode_ack(payload: str) -> dict:
+    if not payload.startswith('{'):
+        return {"client_id": payload}
+    try:
+        ack = json.loads(payload)
+    except json.JSONDecodeError as e:
+        raise CodecError(f"Failed to decode acknowledgment: {e}") from e
+    return ack if isinstance(ack, dict) else {}
+
+
+def encode_hello(epoch: str) -> str:
+    return json.dumps({"epoch": epoch})
+
+
+def decode_hello(payload: str) -> dict:
+    try:
+        hello = json.loads(payload)
+    except json.JSONDecodeError as e:
+        raise CodecError(f"Failed to decode operator hello: {e}") from e
+    return hello if isinstance(hello, dict) else {}
+
+
+def encode_binary(message: dict, compress_threshold: int = 0, compression: str = COMPRESSION_ZLIB) -> bytes:
+    parts = []
+    _encode_value(message, parts)
+    body = b''.join(parts)
+    flags = 0
+    if compress_threshold and len(body) >= compress_threshold:
+        if compression == COMPRESSION_ZSTD:
+            compressed, flag = zstandard.ZstdCompressor(level=3).compress(body), FLAG_ZSTD
+        else:
+            compressed, flag = zlib.compress(body, 1), FLAG_ZLIB
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= flag
+    return FRAME_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, flags) + body
+
+
+def decode_binary(payload: bytes) -> dict:
+    magic, version, flags = FRAME_HEADER.unpack_from(payload)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary frame version {version}")
+    body = memoryview(payload)[FRAME_HEADER.size:]
+    if flags & FLAG_ZLIB:
+        body = memoryview(zlib.decompress(body))
+    elif flags & FLAG_ZSTD:
+        if zstandard is None:
+            raise ValueError("Frame is zstd compressed but the zstandard package is not installed")
+        try:
+            body = memoryview(zstandard.ZstdDecompressor().decompress(body))
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Invalid zstd frame: {e}") from e
+    value, _ = _decode_value(body, 0)
+    if not isinstance(value, dict):
+        raise ValueError("Binary frame does not hold a message")
+    return value
+
+
+def _encode_value(value, parts):
+    if value is None:
+        parts.append(bytes((T_NONE,)))
+    elif value is True:
+        parts.append(bytes((T_TRUE,)))
+    elif value is False:
+        parts.append(bytes((T_FALSE,)))
+    elif isinstance(value, int):
+        if _INT_MIN <= value <= _INT_MAX:
+            parts.append(bytes((T_INT,)) + _INT.pack(value))
+        else:
+            # Sent as its decimal digits rather than rounded to a double
+            _encode_value(str(value), parts)
+    elif isinstance(value, float):
+        parts.append(bytes((T_FLOAT,)) + _DOUBLE.pack(value))
+    elif isinstance(value, str):
+        data = value.encode('utf-8', 'surrogatepass')
+        parts.append(bytes((T_STR,)) + _LENGTH.pack(len(data)))
+        parts.append(data)
+    elif isinstance(value, (bytes, bytearray)):
+        parts.append(bytes((T_BYTES,)) + _LENGTH.pack(len(value)))
+        parts.append(bytes(value))
+    elif isinstance(value, (list, tuple)):
+        parts.append(bytes((T_LIST,)) + _LENGTH.pack(len(value)))
+        for item in value:
+            _encode_value(item, parts)
+    elif isinstance(value, dict):
+        parts.append(bytes((T_DICT,)) + _LENGTH.pack(len(value)))
+        for key, item in value.items():
+            key_id = KEY_IDS.get(key)
+            if key_id is None:
+                data = str(key).encode()
+                parts.append(bytes((INLINE_KEY,)) + _LENGTH.pack(len(data)))
+                parts.append(data)
+            else:
+                parts.append(bytes((key_id,)))
+            _encode_value(item, parts)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__} in a binary frame")
+
+
+def _decode_value(body, position):
+    kind = body[position]
+    position += 1
+    if kind == T_NONE:
+        return None, position
+    if kind == T_FALSE:
+        return False, position
+    if kind == T_TRUE:
+        return True, position
+    if kind == T_INT:
+        return _INT.unpack_from(body, position)[0], position + _INT.size
+    if kind == T_FLOAT:
+        return _DOUBLE.unpack_from(body, position)[0], position + _DOUBLE.size
+    if kind in (T_STR, T_BYTES):
+        length, position = _read_length(body, position)
+        data = bytes(body[position:position + length])
+        return (data.decode('utf-8', 'surrogatepass') if kind == T_STR else data), position + length
+    if kind == T_LIST:
+        count = _LENGTH.unpack_from(body, position)[0]
+        position += _LENGTH.size
+        items = []
+        for _ in range(count):
+            item, position = _decode_value(body, position)
+            items.append(item)
+        return items, position
+    if kind == T_DICT:
+        count = _LENGTH.unpack_from(body, position)[0]
+        position += _LENGTH.size
+        items = {}
+        for _ in range(count):
+            key_id = body[position]
+            position += 1
+            if key_id == INLINE_KEY:
+                length, position = _read_length(body, position)
+                key = bytes(body[position:position + length]).decode()
+                position += length
+            else:
+                key = KNOWN_KEYS[key_id]
+            items[key], position = _decode_value(body, position)
+        return items, position
+    raise ValueError(f"Unknown value type {kind} in binary frame")
+
+
+def _read_length(body, position):
+    # Length of a string, bytes or inline key field, which must fit in what is left of the frame
+    length = _LENGTH.unpack_from(body, position)[0]
+    position += _LENGTH.size
+    if position + length > len(body):
+        raise ValueError(f"Binary frame truncated: field of {length} bytes at offset {position} "
+                         f"runs past the end of the frame ({len(body)} bytes)")
+    return length, position
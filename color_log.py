@@ -1,10 +1,39 @@
+import atexit
+import json
+import os
+import sys
+import time
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
 from colorama import Fore, Style, init
 
 # Initialize colorama
-init(autoreset=True)
+init()
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+COLORS = {DEBUG: Fore.CYAN, INFO: Fore.GREEN, WARNING: Fore.YELLOW, ERROR: Fore.RED}
 
 # Variable to control color logging
 use_color = True
+# Records below this level are discarded before any formatting happens
+level = INFO
+json_lines = False
+max_length = 4096
+stream = None
+
+_STOP = object()
+_queue = Queue(maxsize=10000)
+_writer = None
+_writer_pid = None
+_writer_lock = Lock()
+# Counted by every thread that finds the queue full, reset by the writer
+_dropped_lock = Lock()
+_dropped = 0
 
 
 def enable_color_logging(enable: bool):
@@ -12,22 +41,144 @@ def enable_color_logging(enable: bool):
     use_color = enable
 
 
-def log_info(message: str):
-    if use_color:
-        print(Fore.GREEN + message)
-    else:
-        print(message)
+def configure(log_level=None, color: bool = None, json_output: bool = None, truncate: int = None,
+              queue_size: int = None, output=None):
+    global level, use_color, json_lines, max_length, stream, _queue
+    if log_level is not None:
+        level = LEVELS[log_level.strip().lower()] if isinstance(log_level, str) else log_level
+    if color is not None:
+        use_color = color
+    if json_output is not None:
+        json_lines = json_output
+    if truncate is not None:
+        max_length = truncate
+    if output is not None:
+        stream = output
+    if queue_size is not None and queue_size != _queue.maxsize:
+        # The writer drains the queue it started with, so it is restarted on the new one by the next record
+        shutdown()
+        _queue = Queue(maxsize=queue_size)
 
 
-def log_warning(message: str):
-    if use_color:
-        print(Fore.YELLOW + message)
-    else:
-        print(message)
+def is_enabled(record_level: int) -> bool:
+    return record_level >= level
+
+
+def log_debug(message: str, *args):
+    if DEBUG >= level:
+        _enqueue(DEBUG, message, args)
+
+
+def log_info(message: str, *args):
+    if INFO >= level:
+        _enqueue(INFO, message, args)
+
+
+def log_warning(message: str, *args):
+    if WARNING >= level:
+        _enqueue(WARNING, message, args)
+
+
+def log_error(message: str, *args):
+    if ERROR >= level:
+        _enqueue(ERROR, message, args)
 
 
-def log_error(message: str):
+def flush(timeout: float = 5.0):
+    # Waits until everything logged so far has been written
+    if _writer is None or _writer_pid != os.getpid():
+        return
+    deadline = time.monotonic() + timeout
+    while _queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def shutdown(timeout: float = 5.0):
+    global _writer
+    with _writer_lock:
+        writer = _writer if _writer_pid == os.getpid() else None
+        _writer = None
+    if writer is None:
+        return
+    try:
+        _queue.put(_STOP, timeout=timeout)
+    except Full:
+        return
+    writer.join(timeout)
+
+
+def _enqueue(record_level, message, args):
+    # Called from network threads: formatting and console I/O happen on the writer thread
+    global _dropped
+    if _writer is None or _writer_pid != os.getpid():
+        _start_writer()
+    try:
+        _queue.put_nowait((time.time(), record_level, message, args))
+    except Full:
+        with _dropped_lock:
+            _dropped += 1
+
+
+def _start_writer():
+    global _writer, _writer_pid, _queue
+    with _writer_lock:
+        if _writer is not None and _writer_pid == os.getpid():
+            return
+        if _writer_pid is not None and _writer_pid != os.getpid():
+            # A forked child inherits the queue but not the thread draining it
+            _queue = Queue(maxsize=_queue.maxsize)
+        _writer_pid = os.getpid()
+        _writer = Thread(target=_run, args=(_queue,), name='color-log', daemon=True)
+        _writer.start()
+
+
+def _run(records):
+    global _dropped
+    while True:
+        record = records.get()
+        batch = [record]
+        while len(batch) < 256:
+            try:
+                batch.append(records.get_nowait())
+            except Empty:
+                break
+        lines = []
+        stop = False
+        for record in batch:
+            if record is _STOP:
+                stop = True
+                continue
+            lines.append(_format(*record))
+        with _dropped_lock:
+            dropped, _dropped = _dropped, 0
+        if dropped:
+            lines.append(_format(time.time(), WARNING, "%d log messages dropped, the log queue was full", (dropped,)))
+        if lines:
+            output = stream or sys.stdout
+            try:
+                output.write(''.join(lines))
+                output.flush()
+            except (OSError, ValueError):
+                pass
+        for _ in batch:
+            records.task_done()
+        if stop:
+            return
+
+
+def _format(created, record_level, message, args):
+    if args:
+        try:
+            message = message % args
+        except (TypeError, ValueError) as e:
+            message = f"{message} {args!r} (log formatting failed: {e})"
+    if max_length and len(message) > max_length:
+        message = f"{message[:max_length]}... [{len(message) - max_length} more characters]"
+    if json_lines:
+        return json.dumps({"time": created, "level": LEVEL_NAMES[record_level], "message": message}) + '\n'
     if use_color:
-        print(Fore.RED + message)
-    else:
-        print(message)
+        return f"{COLORS[record_level]}{message}{Style.RESET_ALL}\n"
+    return f"{message}\n"
+
+
+atexit.register(shutdown)
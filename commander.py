@@ -1,9 +1,12 @@
 import argparse
-import paho.mqtt.client as mqtt
 import configparser
 import os
 import json
 import time
+import codec
+import topics
+from feedback_stream import StreamAssembler, FEEDBACK_CHUNK, FEEDBACK_FINAL, FEEDBACK_RECEIVED
+from async_core import MQTTClient
 
 
 class BaseCommander:
@@ -12,30 +15,52 @@ class BaseCommander:
                  port,
                  command_loader_topic,
                  response_topic,
-                 jsonify):
+                 jsonify,
+                 command_topic=None,
+                 command_routing=topics.ROUTING_PER_CLIENT,
+                 wire_format=None,
+                 qos=0):
         self._broker = broker
         self._port = port
         self._command_loader_topic = command_loader_topic
         self._response_topic = response_topic
         self._jsonify = jsonify
-        self._client = mqtt.Client()
+        self._command_topic = command_topic
+        self._command_routing = topics.validate_routing(command_routing)
+        self._wire_format = codec.validate_format(wire_format) if wire_format else codec.default_format(jsonify)
+        self._qos = qos
+        self._assembler = StreamAssembler()
+        self._client = MQTTClient()
         self._client.on_connect = self.on_connect
         self._client.on_message = self.on_message
 
     def on_connect(self, client, userdata, flags, rc):
         print(f"Connected with result code {rc}")
-        self._client.subscribe(self._response_topic)
+        # A sharded operator redirects feedback to <response_topic>/shard<N>
+        self._client.subscribe(topics.response_topics(self._response_topic), qos=self._qos)
 
     def on_message(self, client, userdata, msg):
-        feedback = msg.payload.decode()
-        if self._jsonify:
-            try:
-                feedback = json.loads(feedback)
-                print(f"Received feedback:\n{json.dumps(feedback, indent=2)}")
-            except json.JSONDecodeError as e:
-                print(f"Failed to decode JSON feedback: {e}\nRaw feedback: {feedback}")
-        else:
-            print(f"Received feedback:\n{feedback}")
+        try:
+            feedback = codec.decode_feedback(msg.payload)
+        except codec.CodecError as e:
+            print(f"{e}\nRaw feedback: {msg.payload!r}")
+            return
+        if codec.detect_format(msg.payload) == codec.FORMAT_TEXT:
+            print(f"Received feedback:\n{msg.payload.decode()}")
+            return
+        if feedback.get('type') == FEEDBACK_RECEIVED:
+            return
+        if feedback.get('type') == FEEDBACK_CHUNK:
+            self._assembler.add_chunk(feedback)
+            self.on_output_chunk(feedback)
+            return
+        if feedback.get('type') == FEEDBACK_FINAL:
+            feedback = self._assembler.complete(feedback)
+        print(f"Received feedback:\n{json.dumps(feedback, indent=2)}")
+
+    def on_output_chunk(self, chunk):
+        # Override to consume streamed output as it arrives; the full output is still printed on completion
+        pass
 
     def connect(self):
         self._client.connect(self._broker, self._port, keepalive=60)
@@ -45,16 +70,48 @@ class BaseCommander:
         self._client.loop_stop()
         self._client.disconnect()
 
-    def send_command(self, client_id, command):
-        if client_id.lower() == 'all':
+    def send_command(self, client_id, command, lane=None, stream=None):
+        # client_id may also be a glob pattern such as 'rack2-*', 'group:<name>', a tag selector such as
+        # 'arch=arm64,cores>=8' or a list of them, the operator then sends the command to all matching clients at once
+        if isinstance(client_id, (list, tuple)):
+            if self._wire_format == codec.FORMAT_TEXT:
+                raise ValueError("Sending to a list of clients needs the json or binary wire format")
+            client_id = list(client_id)
+        elif client_id.lower() == 'all':
             client_id = 'all'
-        if self._jsonify:
-            message = json.dumps({"client_id": client_id, "command": command})
-        else:
-            message = f"{client_id}|{command}"
-        self._client.publish(self._command_loader_topic, message)
+        message = {"client_id": client_id, "command": command}
+        if lane is not None:
+            message["lane"] = lane
+        if stream is not None:
+            # Overrides the client's stream_output for this command
+            message["stream"] = stream
+        if self._wire_format != codec.FORMAT_TEXT:
+            # Starts the per-hop trace; operators with tracing disabled ignore it
+            message["trace"] = {"commander_publish": time.time()}
+        message = codec.encode_command(self._wire_format, message)
+        self._client.publish(self._command_loader_topic, message, qos=self._qos)
         print(f"Sent command to {client_id}: {command}")
 
+    def send_direct_command(self, client_id, command):
+        # Publish straight to the SUT command topics, bypassing the operator's command loader
+        if self._command_topic is None:
+            raise ValueError("Direct commands require the commander to be created with a command_topic")
+        if client_id.lower() == topics.BROADCAST_ID:
+            # Legacy SUTs cannot receive broadcasts, the operator expands them per client instead
+            if self._command_routing == topics.ROUTING_SHARED:
+                raise ValueError("Direct broadcasts need per-client command routing, use send_command instead")
+            client_id = topics.BROADCAST_ID
+            topic = topics.broadcast_command_topic(self._command_topic)
+        elif self._command_routing == topics.ROUTING_SHARED:
+            topic = self._command_topic
+        else:
+            topic = topics.client_command_topic(self._command_topic, client_id)
+        message = codec.encode_command(self._wire_format, {"client_id": client_id, "command": command})
+        self._client.publish(topic, message, qos=self._qos)
+        if self._command_routing == topics.ROUTING_BOTH and client_id != topics.BROADCAST_ID:
+            self._client.publish(self._command_topic, message, qos=self._qos)
+        print(f"Sent direct command to {client_id}: {command}")
+
 
 def init_commander(config_path: os.path) -> BaseCommander:
     config = configparser.ConfigParser()
@@ -63,9 +120,15 @@ def init_commander(config_path: os.path) -> BaseCommander:
     port = int(config['mqtt']['port'])
     command_loader_topic = config['mqtt']['command_loader_topic']
     response_topic = config['mqtt']['response_topic']
+    command_topic = config['mqtt']['command_topic']
+    command_routing = config.get('mqtt', 'command_routing', fallback=topics.ROUTING_PER_CLIENT)
     jsonify = config.getboolean('commander', 'jsonify')
+    wire_format = config.get('commander', 'wire_format', fallback=None)
+    qos = config.getint('mqtt', 'qos', fallback=0)
 
-    return BaseCommander(broker, port, command_loader_topic, response_topic, jsonify)
+    return BaseCommander(broker, port, command_loader_topic, response_topic, jsonify,
+                         command_topic=command_topic, command_routing=command_routing, wire_format=wire_format,
+                         qos=qos)
 
 
 if __name__ == '__main__':
@@ -78,7 +141,8 @@ if __name__ == '__main__':
 
     try:
         while True:
-            client_id = input("Enter the client ID (or 'all' to send to all clients): ")
+            client_id = input("Enter the client ID, a pattern such as 'rack2-*', 'group:<name>' "
+                              "(or 'all' to send to all clients): ")
             command = input("Enter the command to send: ")
             commander.send_command(client_id, command)
             time.sleep(1)  # Add a small delay to ensure commands are processed
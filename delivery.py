@@ -0,0 +1,198 @@
+import time
+import uuid
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
+import color_log
+
+# Registration feature announced by clients that confirm receipt of commands carrying a command_id
+FEATURE_RECEIPTS = 'receipts'
+
+
+def new_command_id() -> str:
+    return uuid.uuid4().hex
+
+
+class _InFlight:
+    __slots__ = ('publishes', 'sent_at', 'attempts', 'next_retry', 'received')
+
+    def __init__(self, publishes, sent_at, next_retry):
+        self.publishes = publishes
+        self.sent_at = sent_at
+        self.attempts = 1
+        self.next_retry = next_retry
+        self.received = False
+
+
+class InFlightTracker:
+    def __init__(self, publish, retry_interval: float = 10, max_retries: int = 3, remember: int = 10000,
+                 completion_timeout: float = 3600):
+        # publish(topic, payload) re-sends a command; commands are retried until the client confirms receipt.
+        # A confirmed command whose feedback does not arrive within completion_timeout is given up as lost, 0 waits
+        # forever.
+        self._publish = publish
+        self._retry_interval = retry_interval
+        self._max_retries = max_retries
+        self._completion_timeout = completion_timeout
+        self._condition = Condition()
+        self._in_flight = {}
+        # Recently completed commands, so feedback replayed after a retry is recognised
+        self._done = OrderedDict()
+        # Commands nobody confirmed; their feedback may still arrive late
+        self._given_up = OrderedDict()
+        self._remember = remember
+        self._stopped = False
+        self._thread = None
+        self._stats_lock = Lock()
+        self._sent = 0
+        self._retried = 0
+        self._expired = 0
+        self._lost = 0
+        self._completed = 0
+        self._duplicates = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = Thread(target=self._run, name='delivery-retry', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def track(self, command_id: str, client_ids, publishes, resend=None):
+        # publishes is the list of (topic, payload) that delivered the command to these clients. For a command that
+        # reached many clients with one publish, resend(client_id) returns the publishes retrying a single client,
+        # so the clients that already confirmed it do not get it again.
+        now = time.monotonic()
+        retry = resend or publishes
+        with self._condition:
+            for client_id in client_ids:
+                self._in_flight[(command_id, client_id)] = _InFlight(retry, now, now + self._retry_interval)
+            self._condition.notify_all()
+        with self._stats_lock:
+            self._sent += len(client_ids)
+
+    def acknowledge(self, command_id: str, client_id: str):
+        with self._condition:
+            entry = self._in_flight.get((command_id, client_id))
+            if entry is not None and not entry.received:
+                entry.received = True
+                # From now on the deadline for the feedback
+                entry.next_retry = time.monotonic() + self._completion_timeout
+
+    def is_repeated(self, command_id: str, client_id: str) -> bool:
+        with self._condition:
+            repeated = (command_id, client_id) in self._done
+        if repeated:
+            with self._stats_lock:
+                self._duplicates += 1
+        return repeated
+
+    def complete(self, command_id: str, client_id: str):
+        # Returns the time from the first dispatch to the feedback, or None for commands that were not tracked
+        key = (command_id, client_id)
+        with self._condition:
+            entry = self._in_flight.pop(key, None) or self._given_up.pop(key, None)
+            if entry is None:
+                return None
+            self._done[key] = True
+            while len(self._done) > self._remember:
+                self._done.popitem(last=False)
+        with self._stats_lock:
+            self._completed += 1
+        return time.monotonic() - entry.sent_at
+
+    def stats(self) -> dict:
+        with self._condition:
+            in_flight = len(self._in_flight)
+        with self._stats_lock:
+            return {"sent": self._sent, "retried": self._retried, "expired": self._expired, "lost": self._lost,
+                    "completed": self._completed, "duplicates": self._duplicates, "in_flight": in_flight}
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                due = []
+                expired = []
+                lost = []
+                next_retry = None
+                for key, entry in self._in_flight.items():
+                    if entry.received:
+                        if not self._completion_timeout:
+                            continue
+                        if entry.next_retry <= now:
+                            lost.append(key)
+                            continue
+                    elif entry.next_retry <= now:
+                        if entry.attempts > self._max_retries:
+                            expired.append(key)
+                            continue
+                        entry.attempts += 1
+                        entry.next_retry = now + self._retry_interval
+                        due.append((key, entry))
+                    if next_retry is None or entry.next_retry < next_retry:
+                        next_retry = entry.next_retry
+                for key in expired + lost:
+                    self._given_up[key] = self._in_flight.pop(key)
+                while len(self._given_up) > self._remember:
+                    self._given_up.popitem(last=False)
+                if not due and not expired and not lost:
+                    self._condition.wait(None if next_retry is None else next_retry - now)
+                    continue
+            # Clients sharing a publish, e.g. on the shared legacy topic, get it re-sent once
+            publishes = OrderedDict()
+            for key, entry in due:
+                retry = entry.publishes(key[1]) if callable(entry.publishes) else entry.publishes
+                for publish in retry:
+                    publishes.setdefault(publish, []).append(key[1])
+            for (topic, payload), client_ids in publishes.items():
+                if color_log.is_enabled(color_log.WARNING):
+                    color_log.log_warning("Retrying command to %s", ', '.join(client_ids))
+                self._publish(topic, payload)
+            for command_id, client_id in expired:
+                color_log.log_error("Command %s was not acknowledged by %s after %d attempts", command_id, client_id,
+                                    self._max_retries + 1)
+            for command_id, client_id in lost:
+                color_log.log_error("Command %s was received by %s but no feedback arrived within %ss", command_id,
+                                    client_id, self._completion_timeout)
+            with self._stats_lock:
+                self._retried += len(due)
+                self._expired += len(expired)
+                self._lost += len(lost)
+
+
+class ReplayCache:
+    def __init__(self, capacity: int = 256):
+        # command_id -> None while the command runs, then the feedback payloads it published
+        self._entries = OrderedDict()
+        self._capacity = capacity
+        self._lock = Lock()
+
+    def begin(self, command_id: str) -> bool:
+        # True if the command is new and should run, False for a repeated delivery
+        with self._lock:
+            if command_id in self._entries:
+                self._entries.move_to_end(command_id)
+                return False
+            self._entries[command_id] = None
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+            return True
+
+    def complete(self, command_id: str, payloads: list):
+        with self._lock:
+            if command_id in self._entries:
+                self._entries[command_id] = payloads
+
+    def payloads(self, command_id: str):
+        # None while the command is still running
+        with self._lock:
+            return self._entries.get(command_id)
@@ -0,0 +1,209 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+import numpy as np
+
+INDEX_MAGIC = b'FBIX'
+INDEX_VERSION = 2
+# magic, version, inode of the feedback file, crc32 of its first line, number of feedback file bytes covered by the
+# index, number of records
+INDEX_HEADER = struct.Struct('<4sIQIQQ')
+# A first line longer than this is identified by its beginning
+IDENTITY_BYTES = 4096
+# One record per feedback line; string fields are ids into the key tables of the .keys file
+RECORD_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('client', '<u4'),
+    ('command', '<u4'),
+    ('pipeline', '<u4'),
+    ('start', '<f8'),
+    ('end', '<f8'),
+])
+NO_KEY = 0xFFFFFFFF
+KEY_FIELDS = (('clients', 'client_id'), ('commands', 'command'), ('pipelines', 'pipeline'))
+
+
+def _as_time(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class FeedbackStore:
+    def __init__(self, file_path: str):
+        # The index lives next to the feedback file as <file>.idx (records) and <file>.idx.keys (string tables)
+        self._file_path = file_path
+        self._index_path = f"{file_path}.idx"
+        self._keys_path = f"{file_path}.idx.keys"
+        self._keys = {name: [] for name, _ in KEY_FIELDS}
+        self._key_ids = {name: {} for name, _ in KEY_FIELDS}
+        self._records = np.empty(0, dtype=RECORD_DTYPE)
+        self._mmap = None
+        self._identity = (0, 0)
+
+    def update(self) -> int:
+        # Indexes feedback appended since the last update and returns the number of new entries
+        indexed_bytes = self._load()
+        size = os.path.getsize(self._file_path)
+        identity = self._file_identity()
+        if size < indexed_bytes or (indexed_bytes and identity != self._identity):
+            # The feedback file was truncated, rotated or replaced, a rotated file may already have grown past
+            # the indexed size, so it is recognised by its inode and first line; start over
+            self._reset()
+            indexed_bytes = 0
+        self._identity = identity
+        if size == indexed_bytes:
+            return 0
+        batches = []
+        batch = []
+        with open(self._file_path, 'rb') as f:
+            f.seek(indexed_bytes)
+            offset = indexed_bytes
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Partially written entry, picked up by the next update
+                record = self._record(offset, line)
+                if record is not None:
+                    batch.append(record)
+                    if len(batch) >= 100000:
+                        batches.append(np.array(batch, dtype=RECORD_DTYPE))
+                        batch = []
+                offset += len(line)
+        batches.append(np.array(batch, dtype=RECORD_DTYPE))
+        new_records = np.concatenate(batches)
+        self._append(offset, new_records)
+        return len(new_records)
+
+    def query(self, client_id=None, command=None, command_contains=None, pipeline=None, since=None, until=None):
+        records = self._select(client_id, command, command_contains, pipeline, since, until)
+        with open(self._file_path, 'rb') as f:
+            for offset, length in zip(records['offset'].tolist(), records['length'].tolist()):
+                f.seek(offset)
+                yield json.loads(f.read(length))
+
+    def numeric(self, client_id=None, command=None, command_contains=None, pipeline=None, since=None, until=None):
+        # Columns of the matching entries without touching the feedback file
+        records = self._select(client_id, command, command_contains, pipeline, since, until)
+        client_ids = records['client'].astype(np.int64)
+        client_ids[client_ids == NO_KEY] = -1
+        return {"start_time": records['start'], "end_time": records['end'],
+                "duration": records['end'] - records['start'],
+                "client_id": np.array(self._keys['clients'] + [None], dtype=object)[client_ids]}
+
+    def clients(self) -> list:
+        self._ensure_loaded()
+        return list(self._keys['clients'])
+
+    def commands(self) -> list:
+        self._ensure_loaded()
+        return list(self._keys['commands'])
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._records)
+
+    def close(self):
+        self._records = np.empty(0, dtype=RECORD_DTYPE)
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _select(self, client_id, command, command_contains, pipeline, since, until):
+        self._ensure_loaded()
+        records = self._records
+        mask = np.ones(len(records), dtype=bool)
+        if client_id is not None:
+            mask &= records['client'] == self._key_ids['clients'].get(client_id, NO_KEY - 1)
+        if command is not None:
+            mask &= records['command'] == self._key_ids['commands'].get(command, NO_KEY - 1)
+        if command_contains is not None:
+            ids = [key_id for key, key_id in self._key_ids['commands'].items() if command_contains in key]
+            mask &= np.isin(records['command'], ids)
+        if pipeline is not None:
+            mask &= records['pipeline'] == self._key_ids['pipelines'].get(pipeline, NO_KEY - 1)
+        if since is not None:
+            mask &= records['start'] >= since
+        if until is not None:
+            mask &= records['start'] < until
+        return records[mask]
+
+    def _file_identity(self):
+        with open(self._file_path, 'rb') as f:
+            return os.fstat(f.fileno()).st_ino, zlib.crc32(f.readline(IDENTITY_BYTES))
+
+    def _record(self, offset, line):
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(entry, dict):
+            return None
+        keys = [self._key_id(name, entry.get(field)) for name, field in KEY_FIELDS]
+        return (offset, len(line), *keys, _as_time(entry.get('start_time')), _as_time(entry.get('end_time')))
+
+    def _key_id(self, name, value):
+        if value is None:
+            return NO_KEY
+        value = str(value)
+        key_id = self._key_ids[name].get(value)
+        if key_id is None:
+            key_id = self._key_ids[name][value] = len(self._keys[name])
+            self._keys[name].append(value)
+        return key_id
+
+    def _ensure_loaded(self):
+        if self._mmap is None and not len(self._records):
+            self.update()
+
+    def _load(self) -> int:
+        self.close()
+        if not os.path.exists(self._index_path) or not os.path.exists(self._keys_path):
+            self._reset()
+            return 0
+        with open(self._keys_path, 'r') as f:
+            self._keys = json.load(f)
+        self._key_ids = {name: {key: key_id for key_id, key in enumerate(keys)} for name, keys in self._keys.items()}
+        with open(self._index_path, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size:
+                self._reset()
+                return 0
+            magic, version, inode, first_line_crc, indexed_bytes, count = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                self._reset()
+                return 0
+            self._identity = (inode, first_line_crc)
+            if count:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap is not None:
+            self._records = np.frombuffer(self._mmap, dtype=RECORD_DTYPE, count=count, offset=INDEX_HEADER.size)
+        return indexed_bytes
+
+    def _append(self, indexed_bytes, new_records):
+        count = len(self._records) + len(new_records)
+        self.close()
+        with open(self._keys_path + '.tmp', 'w') as f:
+            json.dump(self._keys, f)
+        os.replace(self._keys_path + '.tmp', self._keys_path)
+        with open(self._index_path, 'r+b') as f:
+            # Records past the header's count are leftovers of an interrupted update
+            f.seek(INDEX_HEADER.size + (count - len(new_records)) * RECORD_DTYPE.itemsize)
+            f.truncate()
+            f.write(new_records.tobytes())
+            f.seek(0)
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, *self._identity, indexed_bytes, count))
+        self._load()
+
+    def _reset(self):
+        self.close()
+        self._keys = {name: [] for name, _ in KEY_FIELDS}
+        self._key_ids = {name: {} for name, _ in KEY_FIELDS}
+        self._identity = (0, 0)
+        with open(self._index_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, 0, 0, 0))
+        with open(self._keys_path, 'w') as f:
+            json.dump(self._keys, f)
@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+# Values of the "type" field of streamed feedback; buffered feedback carries no type
+FEEDBACK_CHUNK = 'chunk'
+FEEDBACK_FINAL = 'final'
+# Sent by the SUT as soon as a command carrying a command_id arrives, before it runs
+FEEDBACK_RECEIVED = 'received'
+
+
+class StreamAssembler:
+    def __init__(self, max_pending: int = 1024):
+        # run_id -> {seq: (channel, data)}, oldest runs are dropped once max_pending is exceeded
+        self._pending = OrderedDict()
+        self._max_pending = max_pending
+
+    def add_chunk(self, chunk: dict):
+        run_id = chunk['run_id']
+        chunks = self._pending.get(run_id)
+        if chunks is None:
+            chunks = self._pending[run_id] = {}
+            while len(self._pending) > self._max_pending:
+                self._pending.popitem(last=False)
+        chunks[chunk['seq']] = (chunk['channel'], chunk['data'])
+
+    def complete(self, final: dict) -> dict:
+        chunks = self._pending.pop(final['run_id'], {})
+        output = []
+        error = []
+        for seq in sorted(chunks):
+            channel, data = chunks[seq]
+            (error if channel == 'stderr' else output).append(data)
+        feedback = {key: value for key, value in final.items() if key != 'type'}
+        feedback['output'] = ''.join(output)
+        feedback['error'] = ''.join(error) or final.get('error', 'None')
+        missing = [seq for seq in range(final.get('chunks', 0)) if seq not in chunks]
+        if missing:
+            feedback['missing_chunks'] = missing
+        return feedback
+
+    def missing_chunks(self, final: dict) -> bool:
+        # True while fewer chunks of the run arrived than its final announces
+        return len(self._pending.get(final.get('run_id'), ())) < final.get('chunks', 0)
+
+    def pending_runs(self):
+        return len(self._pending)
@@ -0,0 +1,170 @@
+import os
+import time
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+import color_log
+
+FSYNC_NEVER = 'never'
+FSYNC_BATCH = 'batch'
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_BATCH)
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_BLOCK)
+
+_STOP = object()
+
+
+class FeedbackWriter:
+    def __init__(self,
+                 file_path: str,
+                 queue_size: int = 10000,
+                 flush_interval: float = 1.0,
+                 flush_size: int = 500,
+                 fsync_policy: str = FSYNC_NEVER,
+                 max_bytes: int = 0,
+                 rotate_interval: float = 0,
+                 backups: int = 5,
+                 overflow: str = OVERFLOW_DROP):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync_policy}', expected one of: {', '.join(FSYNC_POLICIES)}")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}', expected one of: {', '.join(OVERFLOW_POLICIES)}")
+        self._file_path = file_path
+        self._queue = Queue(maxsize=queue_size)
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._fsync_policy = fsync_policy
+        self._max_bytes = max_bytes
+        self._rotate_interval = rotate_interval
+        self._backups = backups
+        self._overflow = overflow
+        self._file = None
+        self._opened_at = 0
+        self._stats_lock = Lock()
+        self._written = 0
+        self._dropped = 0
+        self._batches = 0
+        self._rotations = 0
+        self._last_drop_log = 0
+        self._thread = None
+
+    def for_file(self, file_path: str):
+        # A writer with the same settings for another file, e.g. one per operator shard
+        return FeedbackWriter(file_path, self._queue.maxsize, self._flush_interval, self._flush_size, self._fsync_policy,
+                              self._max_bytes, self._rotate_interval, self._backups, self._overflow)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._open()
+        self._thread = Thread(target=self._run, name='feedback-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, line: str) -> bool:
+        # Called from the MQTT network thread, so it never touches the disk itself
+        if self._overflow == OVERFLOW_BLOCK:
+            self._queue.put(line)
+            return True
+        try:
+            self._queue.put_nowait(line)
+            return True
+        except Full:
+            with self._stats_lock:
+                self._dropped += 1
+                dropped = self._dropped
+                now = time.monotonic()
+                report = now - self._last_drop_log >= 5
+                if report:
+                    self._last_drop_log = now
+            if report:
+                color_log.log_error(f"Feedback queue full, dropped {dropped} feedback messages so far")
+            return False
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        self._file = None
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {"written": self._written, "dropped": self._dropped, "batches": self._batches,
+                    "rotations": self._rotations, "queued": self._queue.qsize()}
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self._flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except Empty:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                batch.append(item)
+                # Drain whatever else is already queued without waiting
+                while len(batch) < self._flush_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except Empty:
+                        break
+                    if item is _STOP:
+                        self._write_batch(batch)
+                        return
+                    batch.append(item)
+            if len(batch) >= self._flush_size or time.monotonic() >= deadline:
+                self._write_batch(batch)
+                batch = []
+                deadline = time.monotonic() + self._flush_interval
+        self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        data = ''.join(line if line.endswith('\n') else line + '\n' for line in batch)
+        try:
+            if self._should_rotate(len(data)):
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            if self._fsync_policy == FSYNC_BATCH:
+                os.fsync(self._file.fileno())
+        except OSError as e:
+            color_log.log_error(f"Failed to write {len(batch)} feedback messages to {self._file_path}: {e}")
+            with self._stats_lock:
+                self._dropped += len(batch)
+            return
+        with self._stats_lock:
+            self._written += len(batch)
+            self._batches += 1
+
+    def _should_rotate(self, pending_bytes):
+        size = self._file.tell()
+        if not size:
+            return False
+        if self._max_bytes and size + pending_bytes > self._max_bytes:
+            return True
+        return bool(self._rotate_interval) and time.monotonic() - self._opened_at >= self._rotate_interval
+
+    def _rotate(self):
+        self._file.close()
+        if self._backups > 0:
+            for index in range(self._backups - 1, 0, -1):
+                source = f"{self._file_path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self._file_path}.{index + 1}")
+            os.replace(self._file_path, f"{self._file_path}.1")
+        else:
+            os.remove(self._file_path)
+        self._open()
+        with self._stats_lock:
+            self._rotations += 1
+
+    def _open(self):
+        self._file = open(self._file_path, 'a', buffering=1024 * 1024)
+        self._opened_at = time.monotonic()
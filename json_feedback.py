@@ -1,17 +1,20 @@
+import argparse
 import json
 import configparser
+import time
 
 
-def parse_feedback(file_path: str):
-    feedback_entries = []
+def iter_feedback(file_path: str):
     with open(file_path, 'r') as f:
         for line in f:
             try:
-                feedback_entry = json.loads(line)
-                feedback_entries.append(feedback_entry)
+                yield json.loads(line)
             except json.JSONDecodeError as e:
                 print(f"Failed to parse line as JSON: {line}\nError: {e}")
-    return feedback_entries
+
+
+def parse_feedback(file_path: str):
+    return list(iter_feedback(file_path))
 
 
 def display_feedback(feedback_entries):
@@ -20,19 +23,32 @@ def display_feedback(feedback_entries):
         print(f"Command: {entry['command']}")
         print(f"Start Time: {entry['start_time']}")
         print(f"End Time: {entry['end_time']}")
-        print(f"Output: {entry['output']}")
+        print(f"Output: {entry.get('output', '')}")
         print(f"Error: {entry['error']}")
         print("-" * 40)
 
 
 if __name__ == '__main__':
-    config = configparser.ConfigParser()
-    config.read('config.ini')
-    feedback_file_path = config['operator']['feedback_file']  # Load feedback_file_path from config.ini
-
-    feedback_entries = parse_feedback(feedback_file_path)
-    display_feedback(feedback_entries)
+    parser = argparse.ArgumentParser(description="Display feedback saved by the operator.")
+    parser.add_argument('--config', type=str, default='config.ini', help='Path to the configuration file.')
+    parser.add_argument('--file', type=str, help='Feedback file, defaults to feedback_file from the configuration.')
+    parser.add_argument('--client', type=str, help='Only show feedback from this client.')
+    parser.add_argument('--command', type=str, help='Only show feedback of commands containing this text.')
+    parser.add_argument('--pipeline', type=str, help='Only show feedback of this pipeline.')
+    parser.add_argument('--since', type=float, help='Only show commands started in the last SINCE seconds.')
+    args = parser.parse_args()
 
-    # # Optionally, you can print the parsed feedback entries as a list of dictionaries
-    # print("\nParsed feedback entries (as list of dictionaries):")
-    # print(feedback_entries)
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    feedback_file_path = args.file or config['operator']['feedback_file']  # Load feedback_file_path from config.ini
+
+    if args.client or args.command or args.pipeline or args.since:
+        # Filtered queries go through the on-disk index instead of scanning the whole file
+        from feedback_store import FeedbackStore
+        store = FeedbackStore(feedback_file_path)
+        store.update()
+        since = time.time() - args.since if args.since else None
+        display_feedback(store.query(client_id=args.client, command_contains=args.command, pipeline=args.pipeline,
+                                     since=since))
+    else:
+        display_feedback(iter_feedback(feedback_file_path))
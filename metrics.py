@@ -0,0 +1,199 @@
+import bisect
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock, Event
+import color_log
+
+# Hops recorded in the "trace" field of a command and echoed back in its feedback, in the order they happen
+HOPS = ('commander_publish', 'operator_receive', 'operator_publish', 'sut_receive', 'sut_dequeue', 'process_start',
+        'process_end', 'feedback_publish', 'operator_feedback')
+# Each stage is the time between two consecutive hops
+STAGES = tuple(zip(('commander', 'operator', 'command_delivery', 'sut_queue', 'process_spawn', 'command',
+                    'feedback_encode', 'feedback_delivery'), HOPS[:-1], HOPS[1:]))
+STAGE_TOTAL = 'total'
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class LatencyHistogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        # counts[i] holds observations up to BUCKETS[i], the last slot everything above
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.total += other.total
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        # Interpolated linearly inside the bucket holding the quantile, like Prometheus' histogram_quantile
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index == len(BUCKETS):
+                    return BUCKETS[-1]
+                lower = BUCKETS[index - 1] if index else 0.0
+                return lower + (BUCKETS[index] - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+
+class LatencyMetrics:
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = {}
+        self._stats = {}
+
+    def observe(self, stage: str, client_id: str, seconds: float):
+        # Stages measured across hosts depend on their clocks being in sync, skew can make them negative
+        seconds = max(seconds, 0.0)
+        with self._lock:
+            histogram = self._histograms.get((stage, client_id))
+            if histogram is None:
+                histogram = self._histograms[(stage, client_id)] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def observe_trace(self, client_id: str, trace: dict, received_at: float = None):
+        trace = dict(trace)
+        trace['operator_feedback'] = received_at if received_at is not None else time.time()
+        for stage, start_hop, end_hop in STAGES:
+            start, end = trace.get(start_hop), trace.get(end_hop)
+            if start is not None and end is not None:
+                self.observe(stage, client_id, end - start)
+        first = next(trace[hop] for hop in HOPS if hop in trace)
+        self.observe(STAGE_TOTAL, client_id, trace['operator_feedback'] - first)
+
+    def add_stats(self, prefix: str, stats):
+        # stats() returns a dict of counters exported as <prefix>_<name>, adding a prefix again replaces it
+        self._stats[prefix] = stats
+
+    def take(self) -> dict:
+        # Hands over the histograms observed so far and starts afresh, shards ship them to the coordinator
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+        return histograms
+
+    def merge(self, histograms: dict):
+        with self._lock:
+            for key, histogram in histograms.items():
+                self._histograms.setdefault(key, LatencyHistogram()).merge(histogram)
+
+    def stage_summary(self) -> dict:
+        # Per stage across all clients: count, mean, p50 and p99
+        with self._lock:
+            merged = {}
+            for (stage, _), histogram in self._histograms.items():
+                merged.setdefault(stage, LatencyHistogram()).merge(histogram)
+        return {stage: {"count": histogram.count, "mean": histogram.total / histogram.count,
+                        "p50": histogram.quantile(0.5), "p99": histogram.quantile(0.99)}
+                for stage, histogram in merged.items()}
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = ["# HELP governor_stage_latency_seconds Time spent per command path stage.",
+                 "# TYPE governor_stage_latency_seconds histogram"]
+        with self._lock:
+            histograms = sorted((key, list(histogram.counts), histogram.total, histogram.count)
+                                for key, histogram in self._histograms.items())
+        for (stage, client_id), counts, total, count in histograms:
+            labels = f'client="{_escape(client_id)}",stage="{stage}"'
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, counts):
+                cumulative += bucket
+                lines.append(f'governor_stage_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'governor_stage_latency_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'governor_stage_latency_seconds_sum{{{labels}}} {total}')
+            lines.append(f'governor_stage_latency_seconds_count{{{labels}}} {count}')
+        for prefix, stats in self._stats.items():
+            for name, value in stats().items():
+                if isinstance(value, (int, float)):
+                    lines.append(f'# TYPE {prefix}_{name} gauge')
+                    lines.append(f'{prefix}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsServer:
+    def __init__(self, metrics: LatencyMetrics, host: str = '127.0.0.1', port: int = 9108):
+        self._metrics = metrics
+        self._host = host
+        self._port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        metrics = self._metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self._host, self._port), Handler)
+        self._server.daemon_threads = True
+        self._thread = Thread(target=self._server.serve_forever, name='metrics-server', daemon=True)
+        self._thread.start()
+        color_log.log_info("Serving metrics on http://%s:%d/metrics", self._host, self._server.server_address[1])
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class StatsDumper:
+    def __init__(self, metrics: LatencyMetrics, interval: float):
+        self._metrics = metrics
+        self._interval = interval
+        self._stop_event = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='metrics-dump', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval):
+            summary = self._metrics.stage_summary()
+            if summary:
+                color_log.log_info("Stage latency (count, mean, p50, p99):\n%s", _format_summary(summary))
+
+
+def _format_summary(summary: dict) -> str:
+    lines = []
+    for stage in [stage for stage, _, _ in STAGES] + [STAGE_TOTAL]:
+        row = summary.get(stage)
+        if row is not None:
+            lines.append(f"  {stage:<18}{row['count']:>8}{row['mean']:>10.4f}s{row['p50']:>10.4f}s{row['p99']:>10.4f}s")
+    return '\n'.join(lines)
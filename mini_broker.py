@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import itertools
+import struct
+from collections import deque
+from threading import Thread, Event
+import paho.mqtt.client as mqtt
+
+# A small MQTT 3.1.1 broker for benchmarks and local development: QoS 0 and 1 (QoS 2 publishes are accepted and
+# delivered at QoS 1), retained messages, persistent sessions, wills and $share/<group>/<filter> subscriptions.
+# It keeps everything in memory and does no authentication, so it is not meant for production fleets. QoS 1
+# messages to a connected client are sent once and never retransmitted; only messages for an offline persistent
+# session are queued.
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+SHARE_PREFIX = '$share/'
+MAX_QOS = 1
+# Bytes waiting to be sent to a client before the broker stops reading from the publishers feeding it
+WRITE_HIGH_WATER = 1 << 20
+# A client that does not read for this long no longer holds the publishers back
+DRAIN_TIMEOUT = 5.0
+
+
+def _is_wildcard(topic_filter: str) -> bool:
+    return '+' in topic_filter or '#' in topic_filter
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _string(value: str) -> bytes:
+    data = value.encode()
+    return struct.pack('!H', len(data)) + data
+
+
+def _read_string(data, position):
+    length = struct.unpack_from('!H', data, position)[0]
+    position += 2
+    return bytes(data[position:position + length]).decode(), position + length
+
+
+def _publish_packet(topic: str, payload: bytes, qos: int, retain: bool, packet_id: int = None) -> bytes:
+    body = _string(topic)
+    if qos:
+        body += struct.pack('!H', packet_id)
+    body += payload
+    return bytes(((PUBLISH << 4) | (qos << 1) | int(retain),)) + _encode_length(len(body)) + body
+
+
+class _Session:
+    def __init__(self, client_id: str, clean: bool):
+        self.client_id = client_id
+        self.clean = clean
+        self.subscriptions = {}
+        self.writer = None
+        self.pending = deque(maxlen=10000)
+        self.packet_ids = itertools.cycle(range(1, 65536))
+        self.will = None
+
+    def send(self, topic, payload, qos, retain=False):
+        if self.writer is None:
+            # Offline persistent session: QoS 1 messages wait for the client to come back
+            if qos:
+                self.pending.append((topic, payload, qos))
+            return
+        packet_id = next(self.packet_ids) if qos else None
+        self.writer.write(_publish_packet(topic, payload, qos, retain, packet_id))
+
+
+class MiniBroker:
+    def __init__(self, host: str = '127.0.0.1', port: int = 1883):
+        self._host = host
+        self._port = port
+        self._sessions = {}
+        self._exact = {}
+        self._wildcards = {}
+        self._shared = {}
+        self._retained = {}
+        self._connections = set()
+        self._congested = set()
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = Event()
+        self.published = 0
+        self.delivered = 0
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    def start(self):
+        # Runs the broker on its own event loop thread and returns once it accepts connections
+        self._thread = Thread(target=self._run, name='mini-broker', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def serve_forever(self):
+        self._run()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self._host, self._port))
+        self._port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            # Closing the connections lets their handlers finish, so the loop closes cleanly
+            for writer in list(self._connections):
+                writer.transport.abort()
+            self._loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(self._loop), return_exceptions=True))
+            self._loop.close()
+
+    async def _handle(self, reader, writer):
+        session = None
+        clean_exit = False
+        self._connections.add(writer)
+        try:
+            while True:
+                first = await reader.readexactly(1)
+                length = 0
+                multiplier = 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                data = await reader.readexactly(length) if length else b''
+                packet_type, flags = first[0] >> 4, first[0] & 0x0F
+                if session is None:
+                    if packet_type != CONNECT:
+                        break
+                    session = self._connect(data, writer)
+                    continue
+                if packet_type == PUBLISH:
+                    self._on_publish(session, flags, data, writer)
+                elif packet_type == PUBREL:
+                    writer.write(bytes((PUBCOMP << 4, 2)) + data[:2])
+                elif packet_type == SUBSCRIBE:
+                    self._on_subscribe(session, data, writer)
+                elif packet_type == UNSUBSCRIBE:
+                    self._on_unsubscribe(session, data, writer)
+                elif packet_type == PINGREQ:
+                    writer.write(bytes((PINGRESP << 4, 0)))
+                elif packet_type == DISCONNECT:
+                    clean_exit = True
+                    break
+                # PUBACK, PUBREC and PUBCOMP from clients need no action, nothing is resent
+                if writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+                    await writer.drain()
+                # The publisher waits for subscribers that fell behind instead of the broker buffering without bound
+                while self._congested:
+                    await self._drain(self._congested.pop())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if session is not None and session.writer is writer:
+                self._disconnect(session, clean_exit)
+            self._connections.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _drain(writer):
+        try:
+            await asyncio.wait_for(writer.drain(), DRAIN_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+    def _connect(self, data, writer):
+        _, position = _read_string(data, 0)
+        position += 1  # protocol level
+        flags = data[position]
+        position += 3  # flags and keep alive
+        client_id, position = _read_string(data, position)
+        clean = bool(flags & 0x02)
+        will = None
+        if flags & 0x04:
+            will_topic, position = _read_string(data, position)
+            will_length = struct.unpack_from('!H', data, position)[0]
+            will_payload = bytes(data[position + 2:position + 2 + will_length])
+            will = (will_topic, will_payload, min((flags >> 3) & 0x03, MAX_QOS), bool(flags & 0x20))
+        if not client_id:
+            client_id = f"anonymous-{id(writer)}"
+        session = self._sessions.get(client_id)
+        if session is not None and session.writer is not None:
+            # A client connecting with an id in use takes over the session
+            session.writer.close()
+            session.writer = None
+        present = session is not None and not clean
+        if session is None or clean:
+            if session is not None:
+                self._drop_subscriptions(session)
+            session = self._sessions[client_id] = _Session(client_id, clean)
+        session.clean = clean
+        session.will = will
+        session.writer = writer
+        writer.write(bytes((CONNACK << 4, 2, int(present), 0)))
+        while session.pending:
+            session.send(*session.pending.popleft())
+        return session
+
+    def _disconnect(self, session, clean_exit):
+        session.writer = None
+        if session.will is not None and not clean_exit:
+            self._route(*session.will)
+        session.will = None
+        if session.clean:
+            self._drop_subscriptions(session)
+            self._sessions.pop(session.client_id, None)
+
+    def _on_publish(self, session, flags, data, writer):
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        topic, position = _read_string(data, 0)
+        if qos:
+            packet_id = bytes(data[position:position + 2])
+            position += 2
+            writer.write(bytes(((PUBACK if qos == 1 else PUBREC) << 4, 2)) + packet_id)
+        self._route(topic, bytes(data[position:]), min(qos, MAX_QOS), retain)
+
+    def _route(self, topic, payload, qos, retain=False):
+        self.published += 1
+        if retain:
+            if payload:
+                self._retained[topic] = (payload, qos)
+            else:
+                self._retained.pop(topic, None)
+        targets = dict(self._exact.get(topic, {}))
+        if not topic.startswith('$'):
+            for topic_filter, subscribers in self._wildcards.items():
+                if mqtt.topic_matches_sub(topic_filter, topic):
+                    for client_id, granted in subscribers.items():
+                        targets[client_id] = max(granted, targets.get(client_id, 0))
+        for (group, topic_filter), members in self._shared.items():
+            if members and (topic_filter == topic or mqtt.topic_matches_sub(topic_filter, topic)):
+                # One member of each share group gets the message, in turn
+                members.rotate(-1)
+                client_id, granted = members[0]
+                targets[client_id] = max(granted, targets.get(client_id, 0))
+        for client_id, granted in targets.items():
+            session = self._sessions.get(client_id)
+            if session is not None:
+                session.send(topic, payload, min(qos, granted))
+                self.delivered += 1
+                if session.writer is not None and session.writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+                    self._congested.add(session.writer)
+
+    def _on_subscribe(self, session, data, writer):
+        packet_id = bytes(data[:2])
+        position = 2
+        granted = bytearray()
+        new_filters = []
+        while position < len(data):
+            topic_filter, position = _read_string(data, position)
+            qos = min(data[position], MAX_QOS)
+            position += 1
+            self._add_subscription(session, topic_filter, qos)
+            granted.append(qos)
+            new_filters.append((topic_filter, qos))
+        writer.write(bytes((SUBACK << 4,)) + _encode_length(2 + len(granted)) + packet_id + bytes(granted))
+        for topic_filter, qos in new_filters:
+            if topic_filter.startswith(SHARE_PREFIX):
+                continue
+            for topic, (payload, retained_qos) in self._retained.items():
+                if mqtt.topic_matches_sub(topic_filter, topic):
+                    session.send(topic, payload, min(qos, retained_qos), retain=True)
+
+    def _on_unsubscribe(self, session, data, writer):
+        packet_id = bytes(data[:2])
+        position = 2
+        while position < len(data):
+            topic_filter, position = _read_string(data, position)
+            self._remove_subscription(session, topic_filter)
+        writer.write(bytes((UNSUBACK << 4, 2)) + packet_id)
+
+    def _add_subscription(self, session, topic_filter, qos):
+        self._remove_subscription(session, topic_filter)
+        session.subscriptions[topic_filter] = qos
+        if topic_filter.startswith(SHARE_PREFIX):
+            group, _, shared_filter = topic_filter[len(SHARE_PREFIX):].partition('/')
+            self._shared.setdefault((group, shared_filter), deque()).append((session.client_id, qos))
+        elif _is_wildcard(topic_filter):
+            self._wildcards.setdefault(topic_filter, {})[session.client_id] = qos
+        else:
+            self._exact.setdefault(topic_filter, {})[session.client_id] = qos
+
+    def _remove_subscription(self, session, topic_filter):
+        if session.subscriptions.pop(topic_filter, None) is None:
+            return
+        if topic_filter.startswith(SHARE_PREFIX):
+            group, _, shared_filter = topic_filter[len(SHARE_PREFIX):].partition('/')
+            members = self._shared.get((group, shared_filter))
+            if members is not None:
+                for member in [member for member in members if member[0] == session.client_id]:
+                    members.remove(member)
+                if not members:
+                    del self._shared[(group, shared_filter)]
+            return
+        index = self._wildcards if _is_wildcard(topic_filter) else self._exact
+        subscribers = index.get(topic_filter)
+        if subscribers is not None:
+            subscribers.pop(session.client_id, None)
+            if not subscribers:
+                del index[topic_filter]
+
+    def _drop_subscriptions(self, session):
+        for topic_filter in list(session.subscriptions):
+            self._remove_subscription(session, topic_filter)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Minimal in-memory MQTT broker for benchmarks and local testing.")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=1883, help='Port to listen on.')
+    args = parser.parse_args()
+    broker = MiniBroker(args.host, args.port)
+    print(f"Mini broker listening on {args.host}:{args.port}")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,11 +1,27 @@
 import argparse
-import paho.mqtt.client as mqtt
 import configparser
 import os
 import json
+import multiprocessing
 import time
-from threading import Lock
+import uuid
+from threading import Thread, Lock, Event
 import color_log
+import codec
+import topics
+from pipeline_scheduler import PipelineScheduler
+from pipeline_journal import PipelineJournal
+from delivery import InFlightTracker, FEATURE_RECEIPTS, new_command_id
+from feedback_stream import StreamAssembler, FEEDBACK_CHUNK, FEEDBACK_FINAL, FEEDBACK_RECEIVED
+from feedback_writer import FeedbackWriter
+from client_registry import ClientRegistry, is_selector, parse_group
+from async_core import MQTTClient, shared_loop
+from metrics import LatencyMetrics, MetricsServer, StatsDumper
+
+# Seconds between two shipments of a shard's latency histograms and counters to the coordinator
+SHARD_METRICS_INTERVAL = 1.0
+# Seconds a shard holds a final whose chunks another shard may still be forwarding
+SHARD_FINAL_GRACE = 2.0
 
 
 class Operator:
@@ -26,6 +42,22 @@ class Operator:
                  save_feedback: bool,
                  feedback_file: str,
                  receive_commands: bool,
+                 command_routing: str = topics.ROUTING_PER_CLIENT,
+                 pipeline_step_timeout: float = 300,
+                 feedback_writer: FeedbackWriter = None,
+                 min_clients: int = 1,
+                 registration_deadline: float = 0,
+                 late_join_pipelines: bool = True,
+                 wire_format: str = None,
+                 qos: int = 0,
+                 command_retry_interval: float = 10,
+                 command_max_retries: int = 3,
+                 command_completion_timeout: float = 3600,
+                 trace_commands: bool = False,
+                 metrics: LatencyMetrics = None,
+                 groups: dict = None,
+                 pipeline_journal: PipelineJournal = None,
+                 resume_pipelines: bool = False,
                  *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._broker = broker
@@ -36,92 +68,324 @@ class Operator:
         self._ack_topic = ack_topic
         self._command_loader_topic = command_loader_topic
         self._registration_timeout = registration_timeout
+        self._min_clients = min_clients
+        self._registration_deadline = registration_deadline
+        self._late_join_pipelines = late_join_pipelines
         self._pipelines = pipelines
         self._pipeline_mode = pipeline_mode
         self._realtime_mode = realtime_mode
         self._jsonify = jsonify
+        self._wire_format = codec.validate_format(wire_format or codec.default_format(jsonify))
         self._colorlog = colorlog
         self._save_feedback = save_feedback
         self._feedback_file = feedback_file
         self._receive_commands = receive_commands
+        self._command_routing = topics.validate_routing(command_routing)
+        self._pipeline_step_timeout = pipeline_step_timeout
+        # Named client sets for batched commands, group name -> client IDs and glob patterns
+        self._groups = groups or {}
+        self._pipeline_journal = pipeline_journal
+        self._resume_pipelines = resume_pipelines
+        self._scheduler = None
+        self._assembler = StreamAssembler()
+        self._feedback_writer = None
+        if self._save_feedback:
+            self._feedback_writer = feedback_writer or FeedbackWriter(self._feedback_file)
         color_log.enable_color_logging(self._colorlog)
-        self._clients = set()
-        self._client = mqtt.Client()
+        self._registry = ClientRegistry()
+        self._qos = qos
+        # Commands to clients that confirm receipt are re-sent until the confirmation arrives
+        self._tracker = InFlightTracker(self._publish, command_retry_interval, command_max_retries,
+                                        completion_timeout=command_completion_timeout)
+        self._trace_commands = trace_commands
+        self._metrics = metrics
+        if self._metrics is not None:
+            self._metrics.add_stats('governor_delivery', self._tracker.stats)
+            if self._feedback_writer is not None:
+                self._metrics.add_stats('governor_feedback_writer', self._feedback_writer.stats)
+        # Announced to the fleet on connect, clients that registered with an earlier operator register again
+        self._epoch = uuid.uuid4().hex
+        self._client = MQTTClient()
         self._client.on_connect = self.on_connect
         self._client.on_message = self.on_message
-        self._lock = Lock()
 
     def on_connect(self, client, userdata, flags, rc):
         color_log.log_info(f"Connected with result code {rc}")
-        self._client.subscribe(self._registration_topic)
-        self._client.subscribe(self._response_topic)
+        self._client.subscribe(self._registration_topic, qos=self._qos)
+        self._client.subscribe(self._response_topic, qos=self._qos)
         if self._receive_commands:
-            self._client.subscribe(self._command_loader_topic)
+            self._client.subscribe(self._command_loader_topic, qos=self._qos)
+        # After the subscriptions, so the registrations it triggers are not missed
+        self._say_hello()
+
+    def _say_hello(self):
+        # Retained, so a client connecting later also learns the epoch it registered under
+        self._client.publish(topics.hello_topic(self._registration_topic), codec.encode_hello(self._epoch), qos=1,
+                             retain=True)
+        color_log.log_info("Announced operator epoch %s", self._epoch)
 
     def on_message(self, client, userdata, msg):
         topic = msg.topic
-        payload = msg.payload.decode()
 
         if topic == self._registration_topic:
-            with self._lock:
-                if payload not in self._clients:
-                    self._clients.add(payload)
-                    color_log.log_info(f"Registered client: {payload}")
-                    self._client.publish(self._ack_topic, payload)
+            self.handle_registration(msg.payload.decode())
         elif topic == self._response_topic:
-            color_log.log_info(f"Received feedback:\n{payload}")
-            if self._save_feedback:
-                self.save_feedback_to_file(payload)
+            self.handle_feedback(msg.payload)
         elif topic == self._command_loader_topic:
-            self.handle_command_loader(payload)
+            self.handle_command_loader(msg.payload)
+
+    def handle_registration(self, payload):
+        try:
+            registration = codec.decode_registration(payload)
+        except codec.CodecError as e:
+            color_log.log_error(str(e))
+            return
+        client_id = registration['client_id']
+        if not self._owns_client(client_id):
+            return
+        # Always acknowledge, the client keeps re-registering if an earlier ack got lost
+        if len(registration) > 1:
+            wire_format = codec.negotiate_format(registration.get('formats', ()), codec.default_format(self._jsonify))
+            self._publish(topics.client_ack_topic(self._ack_topic, client_id),
+                          codec.encode_ack(client_id, wire_format, self._client_response_topic(),
+                                           codec.available_compressions()))
+        else:
+            wire_format = codec.default_format(self._jsonify)
+            self._publish(self._ack_topic, client_id)
+        features = registration.get('features', ())
+        # Receipts are feedback messages of their own, which the text format cannot express
+        info = {"format": wire_format, "receipts": FEATURE_RECEIPTS in features and wire_format != codec.FORMAT_TEXT,
+                "batch": topics.FEATURE_BATCH in features}
+        if isinstance(registration.get('tags'), dict):
+            info["tags"] = registration['tags']
+        if self._registry.register(client_id, info):
+            color_log.log_info("Registered client: %s (%s)", client_id, wire_format)
+
+    def handle_feedback(self, payload):
+        received_at = time.time()
+        try:
+            feedback = codec.decode_feedback(payload)
+        except codec.CodecError as e:
+            color_log.log_error(str(e))
+            return
+        self._process_feedback(feedback, payload, received_at)
+
+    def _process_feedback(self, feedback, payload, received_at):
+        if feedback.get('type') == FEEDBACK_RECEIVED:
+            self._tracker.acknowledge(feedback.get('command_id'), feedback.get('client_id'))
+            return
+        if feedback.get('type') == FEEDBACK_CHUNK:
+            self._assembler.add_chunk(feedback)
+            color_log.log_info("Output from %s (%s, chunk %s):\n%s", feedback.get('client_id'),
+                               feedback.get('channel'), feedback.get('seq'), feedback.get('data'))
+            return
+        final = feedback.get('type') == FEEDBACK_FINAL
+        if final:
+            feedback = self._assembler.complete(feedback)
+            color_log.log_info("Command finished on %s with exit code %s: %s", feedback.get('client_id'),
+                               feedback.get('exit_code'), feedback.get('command'))
+        line = None
+        # Only serialised when it is saved or logged; JSON and text feedback is kept exactly as received,
+        # binary and assembled feedback is saved as JSON
+        if self._save_feedback or (not final and color_log.is_enabled(color_log.INFO)):
+            line = json.dumps(feedback) if final or codec.detect_format(payload) == codec.FORMAT_BINARY \
+                else payload.decode()
+        if not final:
+            color_log.log_info("Received feedback:\n%s", line)
+        command_id = feedback.get('command_id')
+        if command_id is not None:
+            if self._tracker.is_repeated(command_id, feedback.get('client_id')):
+                # Feedback replayed by the client after a retried command already arrived
+                color_log.log_info("Ignoring repeated feedback for command %s", command_id)
+                return
+            latency = self._tracker.complete(command_id, feedback.get('client_id'))
+            if latency is not None:
+                color_log.log_debug("Command %s finished on %s %.3fs after dispatch", command_id,
+                                    feedback.get('client_id'), latency)
+        if self._metrics is not None and isinstance(feedback.get('trace'), dict):
+            self._metrics.observe_trace(feedback.get('client_id'), feedback['trace'], received_at)
+        if self._save_feedback:
+            self.save_feedback_to_file(line)
+        self._notify_scheduler(feedback.get('client_id'), feedback.get('command'), feedback.get('pipeline'),
+                               feedback.get('step'), command_id)
+
+    def _owns_client(self, client_id) -> bool:
+        return True
+
+    def _client_response_topic(self):
+        # Topic the client should publish its feedback to, None keeps the configured response topic
+        return None
+
+    def _notify_scheduler(self, client_id, command, pipeline, step, command_id=None):
+        scheduler = self._scheduler
+        if scheduler is not None:
+            scheduler.on_feedback(client_id, command, pipeline, step, command_id)
+
+    def registered_clients(self) -> list:
+        return self._registry.snapshot()
+
+    def add_client_listener(self, listener):
+        self._registry.add_listener(listener)
+
+    def remove_client_listener(self, listener):
+        self._registry.remove_listener(listener)
 
     def handle_command_loader(self, payload):
         try:
-            command_data = json.loads(payload)
-            client_id = command_data.get('client_id')
-            command = command_data.get('command')
-            if client_id and command:
-                if client_id.lower() == 'all':
-                    self.send_command_to_all_clients(command)
-                else:
-                    self.send_command_to_client(client_id, command)
+            command_data = codec.decode_command(payload)
+        except codec.CodecError as e:
+            color_log.log_error(f"Invalid command format: {e}")
+            return
+        client_id = command_data.get('client_id')
+        command = command_data.get('command')
+        metadata = {field: command_data[field] for field in ('lane', 'stream') if field in command_data}
+        if self._trace_commands:
+            trace = command_data.get('trace')
+            metadata['trace'] = {**(trace if isinstance(trace, dict) else {}), 'operator_receive': time.time()}
+        if client_id and command:
+            if isinstance(client_id, list) or is_selector(client_id):
+                try:
+                    self.send_command_to_clients(client_id if isinstance(client_id, list) else [client_id], command,
+                                                 metadata)
+                except ValueError as e:
+                    color_log.log_error(str(e))
+            elif client_id.lower() == 'all':
+                self.send_command_to_all_clients(command, metadata)
             else:
-                color_log.log_error("Invalid command format")
-        except json.JSONDecodeError as e:
-            color_log.log_error(f"Failed to decode JSON: {e}")
-
-    def send_command_to_all_clients(self, command):
-        with self._lock:
-            for client_id in self._clients:
-                self.send_command_to_client(client_id, command)
-
-    def send_command_to_client(self, client_id, command):
-        color_log.log_warning(f"Published command to {client_id}: {command}")
-        if self._jsonify:
-            message = json.dumps({"client_id": client_id, "command": command})
+                self.send_command_to_client(client_id, command, metadata)
         else:
-            message = f"{client_id}|{command}"
-        self._client.publish(self._command_topic, message)
+            color_log.log_error("Invalid command format")
+
+    def send_command_to_all_clients(self, command, metadata=None) -> str:
+        command_id = new_command_id()
+        self._send_to_all(command_id, command, metadata)
+        return command_id
+
+    def _send_to_all(self, command_id, command, metadata, publish_broadcast=True):
+        metadata = self._command_metadata(command_id, metadata)
+        clients = self._registry.clients()
+        if self._command_routing != topics.ROUTING_SHARED:
+            message = self._encode_command(topics.BROADCAST_ID, command, metadata)
+            publishes = [(topics.broadcast_command_topic(self._command_topic), message)]
+            receivers = [client_id for client_id, info in clients.items() if info.get('receipts')]
+            resend = self._resend(command, metadata)
+            if publish_broadcast:
+                self._dispatch(command_id, receivers, publishes, resend)
+                color_log.log_warning("Published command to all clients: %s", command)
+            elif receivers:
+                # Another shard published the broadcast, this one only tracks receipts of its own clients
+                self._tracker.track(command_id, receivers, publishes, resend)
+        if self._command_routing != topics.ROUTING_PER_CLIENT:
+            # Legacy SUTs only accept commands addressed to their own client_id on the shared topic. With both
+            # routings the broadcast already tracks every client, and its retries cover both topics.
+            tracked = self._command_routing == topics.ROUTING_SHARED
+            for client_id, info in clients.items():
+                message = self._encode_command(client_id, command, metadata, info.get('format'))
+                self._dispatch(command_id, [client_id] if tracked and info.get('receipts') else [],
+                               [(self._command_topic, message)])
+            color_log.log_warning("Published command to %d clients (shared topic): %s", len(clients), command)
+
+    def send_command_to_clients(self, targets, command, metadata=None) -> str:
+        # One command for a set of clients given as IDs, glob patterns and group:<name> entries
+        command_id = new_command_id()
+        client_ids = self._registry.select(targets, self._groups)
+        if not client_ids:
+            color_log.log_warning("No registered client matches %s", ', '.join(targets))
+            return command_id
+        self._send_to_clients(command_id, client_ids, command, metadata)
+        return command_id
+
+    def _send_to_clients(self, command_id, client_ids, command, metadata):
+        metadata = self._command_metadata(command_id, metadata)
+        clients = self._registry.clients()
+        batched = []
+        if self._command_routing != topics.ROUTING_SHARED:
+            batched = [client_id for client_id in client_ids if (clients.get(client_id) or {}).get('batch')]
+        if batched:
+            # Clients announcing batch support share one publish and pick themselves out of its targets
+            message = {"client_id": topics.BROADCAST_ID, "command": command, "targets": batched, **metadata}
+            # Text commands cannot carry the targets, every batch client reads JSON
+            wire_format = codec.FORMAT_JSON if self._wire_format == codec.FORMAT_TEXT else self._wire_format
+            receivers = [client_id for client_id in batched if clients[client_id].get('receipts')]
+            self._dispatch(command_id, receivers, [(topics.batch_command_topic(self._command_topic),
+                                                    codec.encode_command(wire_format, message))],
+                           self._resend(command, metadata))
+        batched = set(batched)
+        for client_id in client_ids:
+            if client_id in batched:
+                continue
+            info = clients.get(client_id) or {}
+            message = self._encode_command(client_id, command, metadata, info.get('format'))
+            self._dispatch(command_id, [client_id] if info.get('receipts') else [],
+                           self._client_publishes(client_id, message))
+        color_log.log_warning("Published command to %d clients (%d in one batch): %s", len(client_ids), len(batched),
+                              command)
+
+    def send_command_to_client(self, client_id, command, metadata=None, command_id=None) -> str:
+        # A command sent again under its earlier command_id is not run twice by the client
+        command_id = command_id or new_command_id()
+        self._send_to_client(command_id, client_id, command, metadata)
+        return command_id
+
+    def _send_to_client(self, command_id, client_id, command, metadata):
+        metadata = self._command_metadata(command_id, metadata)
+        color_log.log_warning("Published command to %s: %s", client_id, command)
+        message = self._encode_command(client_id, command, metadata)
+        publishes = self._client_publishes(client_id, message)
+        self._dispatch(command_id, [client_id] if self._has_receipts(client_id) else [], publishes)
+
+    def _client_publishes(self, client_id, message):
+        publishes = []
+        if self._command_routing != topics.ROUTING_SHARED:
+            publishes.append((topics.client_command_topic(self._command_topic, client_id), message))
+        if self._command_routing != topics.ROUTING_PER_CLIENT:
+            publishes.append((self._command_topic, message))
+        return publishes
+
+    def _command_metadata(self, command_id, metadata):
+        metadata = {**(metadata or {}), "command_id": command_id}
+        if self._trace_commands:
+            metadata['trace'] = {**metadata.get('trace', {}), 'operator_publish': time.time()}
+        return metadata
+
+    def _resend(self, command, metadata):
+        # Retries of a broadcast or batch go to each client's own topics, not to every client of the first publish
+        return lambda client_id: self._client_publishes(client_id, self._encode_command(client_id, command, metadata))
+
+    def _dispatch(self, command_id, receivers, publishes, resend=None):
+        # Tracking starts before publishing so a fast receipt cannot arrive for an unknown command
+        if receivers:
+            self._tracker.track(command_id, receivers, publishes, resend)
+        for topic, message in publishes:
+            self._publish(topic, message)
+
+    def _has_receipts(self, client_id) -> bool:
+        return (self._registry.info(client_id) or {}).get('receipts', False)
+
+    def _publish(self, topic, payload):
+        self._client.publish(topic, payload, qos=self._qos)
+
+    def _encode_command(self, client_id, command, metadata=None, wire_format=None):
+        message = {"client_id": client_id, "command": command}
+        if metadata:
+            message.update(metadata)
+        if wire_format is None:
+            wire_format = (self._registry.info(client_id) or {}).get('format', self._wire_format)
+        return codec.encode_command(wire_format, message)
 
     def save_feedback_to_file(self, feedback: str):
-        with open(self._feedback_file, 'a') as f:
-            f.write(feedback + '\n')
+        self._feedback_writer.write(feedback + '\n')
 
     def run(self):
-        self._client.connect(self._broker, self._port, keepalive=60)
-        self._client.loop_start()
+        self._start()
 
-        last_registration_time = time.time()
         color_log.log_info("Waiting for clients to register...")
-        while True:
-            with self._lock:
-                if self._clients:
-                    if time.time() - last_registration_time > self._registration_timeout:
-                        break
-                else:
-                    last_registration_time = time.time()
-
-        color_log.log_info(f"Registered clients: {', '.join(self._clients)}")
+        clients = self._registry.wait_for_clients(self._registration_timeout, self._min_clients,
+                                                  self._registration_deadline)
+        if len(clients) < self._min_clients:
+            color_log.log_warning(f"Registration deadline passed with {len(clients)} of {self._min_clients} "
+                                  f"expected clients")
+        color_log.log_info(f"Registered clients: {', '.join(clients)}")
 
         if self._pipeline_mode:
             self.run_pipelines()
@@ -130,24 +394,40 @@ class Operator:
             self.run_realtime_mode()
 
         input("Press Enter to exit...\n")
+        self._stop()
 
+    def _start(self):
+        if self._feedback_writer is not None:
+            self._feedback_writer.start()
+        self._tracker.start()
+        self._client.connect(self._broker, self._port, keepalive=60)
+        self._client.loop_start()
+
+    def _stop(self):
         self._client.loop_stop()
         self._client.disconnect()
+        self._tracker.stop()
+        color_log.log_info(f"Delivery stats: {self._tracker.stats()}")
+        if self._feedback_writer is not None:
+            self._feedback_writer.close()
+            color_log.log_info(f"Feedback writer stats: {self._feedback_writer.stats()}")
 
     def run_pipelines(self):
         color_log.log_info("Running pipelines...")
-        with self._lock:
-            for pipeline_name, pipeline_commands in self._pipelines.items():
-                for client_id in self._clients:
-                    for command in pipeline_commands.split(';'):
-                        command_message = command.strip()
-                        if self._jsonify:
-                            message = json.dumps({"client_id": client_id, "command": command_message})
-                        else:
-                            message = f"{client_id}|{command_message}"
-                        self._client.publish(self._command_topic, message)
-                        color_log.log_warning(f"Published command to {client_id}: {command_message}")
-                        time.sleep(1)  # Add a delay to ensure commands are processed sequentially
+        scheduler = PipelineScheduler(self._pipelines, self.send_command_to_client, self._pipeline_step_timeout,
+                                      self._pipeline_journal, self._resume_pipelines)
+        self._scheduler = scheduler
+        if self._late_join_pipelines:
+            # Clients registering while the pipelines run start from the first step
+            self._registry.add_listener(scheduler.add_client)
+        try:
+            scheduler.run(self._registry.snapshot())
+        finally:
+            self._registry.remove_listener(scheduler.add_client)
+            self._scheduler = None
+            if self._pipeline_journal is not None:
+                self._pipeline_journal.close()
+                color_log.log_info(f"Pipeline journal stats: {self._pipeline_journal.stats()}")
 
     def run_realtime_mode(self):
         color_log.log_info("Entering real-time command mode...")
@@ -155,20 +435,276 @@ class Operator:
             command = input("Enter command to send to all clients (or 'exit' to quit): \n")
             if command.lower() == 'exit':
                 break
-            with self._lock:
-                for client_id in self._clients:
-                    command_message = command.strip()
-                    if self._jsonify:
-                        message = json.dumps({"client_id": client_id, "command": command_message})
-                    else:
-                        message = f"{client_id}|{command_message}"
-                    self._client.publish(self._command_topic, message)
-                    color_log.log_warning(f"Published command to {client_id}: {command_message}")
+            self.send_command_to_all_clients(command.strip())
+
+
+def shard_feedback_file(feedback_file: str, shard: int) -> str:
+    root, extension = os.path.splitext(feedback_file)
+    return f"{root}.shard{shard}{extension}"
+
+
+class ShardWorker(Operator):
+    # Runs in its own process and owns the clients whose id hashes to its shard: it acknowledges their
+    # registrations, publishes their commands, tracks receipts and decodes, logs and saves their feedback
+    def __init__(self, shard: int, shards: int, requests, events, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shard = shard
+        self._shards = shards
+        self._requests = requests
+        self._events = events
+        self._shard_topic = topics.shard_response_topic(self._response_topic, shard)
+        self._registry.add_listener(self._announce_client)
+        self._metrics_stop = Event()
+        self._metrics_thread = None
+        # run_id -> (final, payload, received_at) of finals waiting for their chunks
+        self._held_finals = {}
+
+    def on_connect(self, client, userdata, flags, rc):
+        color_log.log_info(f"Shard {self._shard} connected with result code {rc}")
+        # Every shard sees every registration and keeps those it owns, registrations are rare
+        self._client.subscribe(self._registration_topic, qos=self._qos)
+        self._client.subscribe(self._shard_topic, qos=self._qos)
+        # Clients that cannot be redirected publish to the response topic, the broker spreads it across shards
+        self._client.subscribe(topics.shared_subscription(self._response_topic), qos=self._qos)
+        # The coordinator announces the epoch once every shard listens for registrations
+        self._events.put(('ready', self._shard))
+
+    def on_message(self, client, userdata, msg):
+        if msg.topic == self._registration_topic:
+            self.handle_registration(msg.payload.decode())
+        elif msg.topic == self._shard_topic:
+            self.handle_feedback(msg.payload)
+        elif msg.topic == self._response_topic:
+            self._route_feedback(msg.payload)
+
+    def _route_feedback(self, payload):
+        # Stream chunks and receipts have to reach the shard that assembles and tracks them
+        try:
+            client_id = codec.decode_feedback(payload).get('client_id')
+        except codec.CodecError as e:
+            color_log.log_error(str(e))
+            return
+        owner = topics.shard_of(client_id, self._shards) if client_id else self._shard
+        if owner == self._shard:
+            self.handle_feedback(payload)
+        else:
+            self._events.put(('forward', owner, payload))
+
+    def _process_feedback(self, feedback, payload, received_at):
+        # Runs on the loop thread. Feedback on the shared response topic reaches the shards in any order, so a final
+        # may overtake chunks that another shard forwards.
+        kind = feedback.get('type')
+        run_id = feedback.get('run_id')
+        if kind == FEEDBACK_FINAL and run_id not in self._held_finals and self._assembler.missing_chunks(feedback):
+            self._held_finals[run_id] = (feedback, payload, received_at)
+            shared_loop().loop.call_later(SHARD_FINAL_GRACE, self._release_final, run_id)
+            return
+        super()._process_feedback(feedback, payload, received_at)
+        if kind == FEEDBACK_CHUNK:
+            held = self._held_finals.get(run_id)
+            if held is not None and not self._assembler.missing_chunks(held[0]):
+                self._release_final(run_id)
+
+    def _release_final(self, run_id):
+        held = self._held_finals.pop(run_id, None)
+        if held is not None:
+            super()._process_feedback(*held)
+
+    def _owns_client(self, client_id) -> bool:
+        return topics.shard_of(client_id, self._shards) == self._shard
+
+    def _client_response_topic(self):
+        return self._shard_topic
+
+    def _notify_scheduler(self, client_id, command, pipeline, step, command_id=None):
+        self._events.put(('feedback', client_id, command, pipeline, step, command_id))
+
+    def _announce_client(self, client_id):
+        self._events.put(('registered', client_id, self._registry.info(client_id)))
+
+    def serve(self):
+        self._start()
+        if self._metrics is not None:
+            self._metrics_thread = Thread(target=self._ship_metrics_loop, name='shard-metrics', daemon=True)
+            self._metrics_thread.start()
+        try:
+            while True:
+                request = self._requests.get()
+                if request is None:
+                    break
+                kind = request[0]
+                if kind == 'client':
+                    self._send_to_client(*request[1:])
+                elif kind == 'all':
+                    self._send_to_all(*request[1:])
+                elif kind == 'clients':
+                    self._send_to_clients(*request[1:])
+                elif kind == 'feedback':
+                    # Handled on the loop thread like the shard's own feedback, in the order it was forwarded
+                    shared_loop().call_soon(self.handle_feedback, request[1])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop()
+            if self._metrics_thread is not None:
+                self._metrics_stop.set()
+                self._metrics_thread.join()
+                self._ship_metrics()
+
+    def _ship_metrics_loop(self):
+        while not self._metrics_stop.wait(SHARD_METRICS_INTERVAL):
+            self._ship_metrics()
+
+    def _ship_metrics(self):
+        stats = {'delivery': self._tracker.stats()}
+        if self._feedback_writer is not None:
+            stats['feedback_writer'] = self._feedback_writer.stats()
+        self._events.put(('metrics', self._shard, self._metrics.take(), stats))
+
+
+def _run_shard(shard, shards, requests, events, args, kwargs):
+    ShardWorker(shard, shards, requests, events, *args, **kwargs).serve()
+
+
+class ShardedOperator(Operator):
+    # Coordinator of a multi-process operator: it keeps the global registry, runs the pipeline plan and the
+    # command loader, and hands every command to the shard process owning the client
+    def __init__(self, *args, shards: int = 2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shards = shards
+        self._shard_args = args
+        self._shard_kwargs = kwargs
+        self._shard_requests = []
+        self._shard_processes = []
+        self._events = None
+        self._events_thread = None
+        self._hello_lock = Lock()
+        self._ready_shards = set()
+        self._connected = False
+        self._announced = False
+        # Latest counters of every shard, the coordinator's own tracker and writer stay idle
+        self._shard_stats = {}
+        if self._metrics is not None:
+            self._metrics.add_stats('governor_delivery', lambda: self._summed_shard_stats('delivery'))
+            if self._feedback_writer is not None:
+                self._metrics.add_stats('governor_feedback_writer',
+                                        lambda: self._summed_shard_stats('feedback_writer'))
+
+    def on_connect(self, client, userdata, flags, rc):
+        color_log.log_info(f"Coordinator connected with result code {rc}")
+        if self._receive_commands:
+            self._client.subscribe(self._command_loader_topic, qos=self._qos)
+        self._connected = True
+        self._say_hello_when_ready()
+
+    def _say_hello_when_ready(self):
+        # Called from the event loop and the events thread, whichever completes the condition says hello
+        with self._hello_lock:
+            if self._announced or not self._connected or len(self._ready_shards) < self._shards:
+                return
+            self._announced = True
+        self._say_hello()
+
+    def on_message(self, client, userdata, msg):
+        if msg.topic == self._command_loader_topic:
+            self.handle_command_loader(msg.payload)
+
+    def send_command_to_all_clients(self, command, metadata=None) -> str:
+        command_id = new_command_id()
+        # Every shard tracks the receipts of its own clients, only the first one publishes the broadcast
+        for shard, requests in enumerate(self._shard_requests):
+            requests.put(('all', command_id, command, metadata, shard == 0))
+        return command_id
+
+    def send_command_to_client(self, client_id, command, metadata=None, command_id=None) -> str:
+        command_id = command_id or new_command_id()
+        self._shard_requests[topics.shard_of(client_id, self._shards)].put(
+            ('client', command_id, client_id, command, metadata))
+        return command_id
+
+    def send_command_to_clients(self, targets, command, metadata=None) -> str:
+        command_id = new_command_id()
+        # Targets resolve against the global registry, each shard then batches the clients it owns
+        by_shard = {}
+        for client_id in self._registry.select(targets, self._groups):
+            by_shard.setdefault(topics.shard_of(client_id, self._shards), []).append(client_id)
+        if not by_shard:
+            color_log.log_warning("No registered client matches %s", ', '.join(targets))
+        for shard, client_ids in by_shard.items():
+            self._shard_requests[shard].put(('clients', command_id, client_ids, command, metadata))
+        return command_id
+
+    def _worker_kwargs(self, shard):
+        # Every shard observes into its own histograms and ships them to the coordinator's
+        metrics = LatencyMetrics() if self._metrics is not None else None
+        kwargs = dict(self._shard_kwargs, metrics=metrics, pipeline_journal=None)
+        if self._feedback_writer is not None:
+            kwargs['feedback_writer'] = self._feedback_writer.for_file(shard_feedback_file(self._feedback_file, shard))
+        return kwargs
+
+    def _start(self):
+        # Forked before this object starts its own threads, but after the log writer, the shared event loop and the
+        # metrics server started. Those threads do not exist in a shard; color_log and async_core notice the new pid
+        # and start their own, and a shard uses nothing else of the parent's threads.
+        context = multiprocessing.get_context('fork')
+        self._events = context.Queue()
+        self._shard_requests = [context.Queue() for _ in range(self._shards)]
+        for shard in range(self._shards):
+            process = context.Process(target=_run_shard, name=f'operator-shard-{shard}',
+                                      args=(shard, self._shards, self._shard_requests[shard], self._events,
+                                            self._shard_args, self._worker_kwargs(shard)))
+            process.start()
+            self._shard_processes.append(process)
+        self._events_thread = Thread(target=self._handle_events, name='shard-events', daemon=True)
+        self._events_thread.start()
+        color_log.log_info("Started %d operator shards", self._shards)
+        self._client.connect(self._broker, self._port, keepalive=60)
+        self._client.loop_start()
+
+    def _stop(self):
+        self._client.loop_stop()
+        self._client.disconnect()
+        for requests in self._shard_requests:
+            requests.put(None)
+        for process in self._shard_processes:
+            process.join()
+        self._events.put(None)
+        self._events_thread.join()
+
+    def _summed_shard_stats(self, name) -> dict:
+        totals = {}
+        for stats in list(self._shard_stats.values()):
+            for key, value in stats.get(name, {}).items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def _handle_events(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            kind = event[0]
+            if kind == 'registered':
+                if self._registry.register(event[1], event[2]):
+                    color_log.log_debug("Client %s belongs to shard %d", event[1],
+                                        topics.shard_of(event[1], self._shards))
+            elif kind == 'feedback':
+                self._notify_scheduler(*event[1:])
+            elif kind == 'forward':
+                self._shard_requests[event[1]].put(('feedback', event[2]))
+            elif kind == 'metrics':
+                self._metrics.merge(event[2])
+                self._shard_stats[event[1]] = event[3]
+            elif kind == 'ready':
+                with self._hello_lock:
+                    self._ready_shards.add(event[1])
+                self._say_hello_when_ready()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Operator for managing commands and clients.")
     parser.add_argument('--config', type=str, default='config.ini', help='Path to the configuration file.')
+    parser.add_argument('--resume', action='store_true', help='Resume the pipelines recorded in the pipeline journal.')
     args = parser.parse_args()
 
     config = configparser.ConfigParser()
@@ -180,29 +716,94 @@ if __name__ == '__main__':
     registration_topic = config['mqtt']['registration_topic']
     ack_topic = config['mqtt']['ack_topic']
     command_loader_topic = config['mqtt']['command_loader_topic']
+    command_routing = config.get('mqtt', 'command_routing', fallback=topics.ROUTING_PER_CLIENT)
     registration_timeout = int(config['operator']['registration_timeout'])
+    min_clients = config.getint('operator', 'min_clients', fallback=1)
+    registration_deadline = config.getfloat('operator', 'registration_deadline', fallback=0)
+    late_join_pipelines = config.getboolean('operator', 'late_join_pipelines', fallback=True)
+    qos = config.getint('mqtt', 'qos', fallback=0)
+    trace_commands = config.getboolean('operator', 'trace_commands', fallback=False)
+    metrics_port = config.getint('operator', 'metrics_port', fallback=0)
+    metrics_host = config.get('operator', 'metrics_host', fallback='127.0.0.1')
+    metrics_dump_interval = config.getfloat('operator', 'metrics_dump_interval', fallback=0)
+    metrics = LatencyMetrics() if trace_commands else None
+    command_retry_interval = config.getfloat('operator', 'command_retry_interval', fallback=10)
+    command_max_retries = config.getint('operator', 'command_max_retries', fallback=3)
+    command_completion_timeout = config.getfloat('operator', 'command_completion_timeout', fallback=3600)
+    wire_format = config.get('operator', 'wire_format', fallback=None)
+    pipeline_step_timeout = config.getfloat('operator', 'pipeline_step_timeout', fallback=300)
     pipeline_mode = config.getboolean('operator', 'enable_pipeline_mode')
     realtime_mode = config.getboolean('operator', 'enable_realtime_mode')
     jsonify = config.getboolean('operator', 'jsonify')
     colorlog = config.getboolean('operator', 'colorlog')
+    color_log.configure(log_level=config.get('logging', 'level', fallback='info'),
+                        json_output=config.getboolean('logging', 'json', fallback=False),
+                        truncate=config.getint('logging', 'max_length', fallback=4096),
+                        queue_size=config.getint('logging', 'queue_size', fallback=10000))
     save_feedback = config.getboolean('operator', 'save_feedback')
     feedback_file = config['operator']['feedback_file']
+    feedback_writer = FeedbackWriter(feedback_file,
+                                     queue_size=config.getint('operator', 'feedback_queue_size', fallback=10000),
+                                     flush_interval=config.getfloat('operator', 'feedback_flush_interval', fallback=1.0),
+                                     flush_size=config.getint('operator', 'feedback_flush_size', fallback=500),
+                                     fsync_policy=config.get('operator', 'feedback_fsync', fallback='never'),
+                                     max_bytes=config.getint('operator', 'feedback_max_bytes', fallback=0),
+                                     rotate_interval=config.getfloat('operator', 'feedback_rotate_interval', fallback=0),
+                                     backups=config.getint('operator', 'feedback_backups', fallback=5),
+                                     overflow=config.get('operator', 'feedback_overflow', fallback='drop'))
     receive_commands = config.getboolean('operator', 'receive_commands')
-    pipelines = {k: v for k, v in config['operator'].items() if k.startswith('pipeline')}
-    operator = Operator(broker,
-                        port,
-                        command_topic,
-                        response_topic,
-                        registration_topic,
-                        ack_topic,
-                        command_loader_topic,
-                        registration_timeout,
-                        pipelines,
-                        pipeline_mode,
-                        realtime_mode,
-                        jsonify,
-                        colorlog,
-                        save_feedback,
-                        feedback_file,
-                        receive_commands)
-    operator.run()
+    pipelines = {k: v for k, v in config['operator'].items() if k.startswith('pipeline') and k[8:].isdigit()}
+    pipeline_journal_file = config.get('operator', 'pipeline_journal', fallback='')
+    journal_fsync_interval = config.getfloat('operator', 'journal_fsync_interval', fallback=1.0)
+    pipeline_journal = PipelineJournal(pipeline_journal_file, journal_fsync_interval) if pipeline_journal_file else None
+    resume_pipelines = args.resume or config.getboolean('operator', 'resume_pipelines', fallback=False)
+    shards = config.getint('operator', 'shards', fallback=1)
+    groups = {name: parse_group(targets)
+              for name, targets in config.items('groups')} if config.has_section('groups') else {}
+    operator_class, options = (ShardedOperator, {'shards': shards}) if shards > 1 else (Operator, {})
+    operator = operator_class(broker,
+                              port,
+                              command_topic,
+                              response_topic,
+                              registration_topic,
+                              ack_topic,
+                              command_loader_topic,
+                              registration_timeout,
+                              pipelines,
+                              pipeline_mode,
+                              realtime_mode,
+                              jsonify,
+                              colorlog,
+                              save_feedback,
+                              feedback_file,
+                              receive_commands,
+                              command_routing=command_routing,
+                              pipeline_step_timeout=pipeline_step_timeout,
+                              feedback_writer=feedback_writer,
+                              min_clients=min_clients,
+                              registration_deadline=registration_deadline,
+                              late_join_pipelines=late_join_pipelines,
+                              wire_format=wire_format,
+                              qos=qos,
+                              command_retry_interval=command_retry_interval,
+                              command_max_retries=command_max_retries,
+                              command_completion_timeout=command_completion_timeout,
+                              trace_commands=trace_commands,
+                              metrics=metrics,
+                              groups=groups,
+                              pipeline_journal=pipeline_journal,
+                              resume_pipelines=resume_pipelines,
+                              **options)
+    metrics_server = MetricsServer(metrics, metrics_host, metrics_port) if metrics and metrics_port else None
+    stats_dumper = StatsDumper(metrics, metrics_dump_interval) if metrics and metrics_dump_interval else None
+    if metrics_server is not None:
+        metrics_server.start()
+    if stats_dumper is not None:
+        stats_dumper.start()
+    try:
+        operator.run()
+    finally:
+        if stats_dumper is not None:
+            stats_dumper.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
@@ -0,0 +1,206 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from threading import Thread, Condition, Lock
+import color_log
+
+# Append-only record of the pipeline steps sent to and finished by every client, so an operator restarted with
+# resume_pipelines continues a sweep instead of starting it over. After a file header the journal is a sequence of
+# records: crc32 of the rest of the record, kind, client id length, flattened step index, command id, client id.
+JOURNAL_MAGIC = b'GVPJ'
+JOURNAL_VERSION = 1
+_HEADER = struct.Struct('<4sBI')
+_CRC = struct.Struct('<I')
+_RECORD = struct.Struct('<BHI16s')
+# Seconds between attempts to write records after a failed write
+RETRY_DELAY = 1.0
+
+DISPATCHED = 1
+COMPLETED = 2
+TIMED_OUT = 3
+
+
+def plan_fingerprint(steps) -> int:
+    # A journal only resumes the pipelines it was written for
+    return zlib.crc32(json.dumps(steps).encode())
+
+
+class ResumedClient:
+    __slots__ = ('done', 'in_flight', 'command_id')
+
+    def __init__(self):
+        # Index of the last finished or timed out step, and the step sent but not finished when the operator stopped
+        self.done = -1
+        self.in_flight = None
+        self.command_id = None
+
+
+class PipelineJournal:
+    def __init__(self, file_path: str, fsync_interval: float = 1.0, fsync_size: int = 1000):
+        # Records are buffered and written with one fsync per batch; fsync_interval = 0 syncs every record, and a
+        # dispatched record before the step is sent
+        self._file_path = file_path
+        self._fsync_interval = fsync_interval
+        self._fsync_size = fsync_size if fsync_interval > 0 else 1
+        self._condition = Condition()
+        self._buffer = []
+        # Sequence numbers of the last record appended and of the last one written, for callers waiting on a sync
+        self._appended = 0
+        self._written = 0
+        self._closed = False
+        self._file = None
+        # Offset after the last record written, a failed write is cut back to it
+        self._end = 0
+        self._thread = None
+        self._stats_lock = Lock()
+        self._records = 0
+        self._syncs = 0
+        self._bytes = 0
+
+    def open(self, steps, resume: bool = False) -> dict:
+        # Returns client_id -> ResumedClient read back from the journal, empty unless resuming
+        fingerprint = plan_fingerprint(steps)
+        clients = {}
+        if resume and os.path.exists(self._file_path):
+            clients, end = self._load(fingerprint)
+            # Unbuffered, so a failed write leaves nothing behind to be flushed later
+            self._file = open(self._file_path, 'r+b', buffering=0)
+            # Drops a record torn by a crash in the middle of a write
+            self._file.truncate(end)
+            self._file.seek(end)
+            self._end = end
+            color_log.log_info("Resuming pipelines of %d clients from %s", len(clients), self._file_path)
+        else:
+            if os.path.exists(self._file_path):
+                # Starting without resume by mistake must not wipe the only record of an unfinished sweep
+                os.replace(self._file_path, self._file_path + '.prev')
+                color_log.log_warning("Starting a new pipeline journal, the previous one was moved to %s.prev",
+                                      self._file_path)
+            self._file = open(self._file_path, 'wb', buffering=0)
+            self._write_all(_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, fingerprint))
+            os.fsync(self._file.fileno())
+            self._end = _HEADER.size
+        self._thread = Thread(target=self._run, name='pipeline-journal', daemon=True)
+        self._thread.start()
+        return clients
+
+    def dispatched(self, client_id: str, step: int, command_id: str):
+        # Only with fsync_interval = 0 does the caller wait, otherwise a crash within the interval loses the record
+        self._append(DISPATCHED, client_id, step, command_id, wait=self._fsync_interval <= 0)
+
+    def completed(self, client_id: str, step: int, command_id: str):
+        self._append(COMPLETED, client_id, step, command_id)
+
+    def timed_out(self, client_id: str, step: int, command_id: str):
+        self._append(TIMED_OUT, client_id, step, command_id)
+
+    def close(self):
+        if self._thread is None:
+            return
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        self._file = None
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {"records": self._records, "syncs": self._syncs, "bytes": self._bytes}
+
+    def _append(self, kind, client_id, step, command_id, wait=False):
+        # Called on the dispatch path, so it only encodes the record and hands it to the journal thread
+        client = client_id.encode()
+        body = _RECORD.pack(kind, len(client), step, bytes.fromhex(command_id)) + client
+        with self._condition:
+            self._buffer.append(_CRC.pack(zlib.crc32(body)) + body)
+            self._appended += 1
+            sequence = self._appended
+            if len(self._buffer) >= self._fsync_size:
+                self._condition.notify_all()
+            if wait:
+                self._condition.wait_for(lambda: self._written >= sequence or self._closed)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or len(self._buffer) >= self._fsync_size,
+                                         self._fsync_interval or None)
+                records, self._buffer = self._buffer, []
+                closed = self._closed
+            if records:
+                if self._write(records):
+                    with self._condition:
+                        self._written += len(records)
+                        self._condition.notify_all()
+                elif not closed:
+                    # Retried ahead of newer records; a dispatch waiting for its record keeps waiting meanwhile
+                    with self._condition:
+                        self._buffer[:0] = records
+                        self._condition.wait_for(lambda: self._closed, RETRY_DELAY)
+                    continue
+            if closed:
+                return
+
+    def _write(self, records) -> bool:
+        data = b''.join(records)
+        try:
+            self._write_all(data)
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            color_log.log_error(f"Failed to write {len(records)} records to the pipeline journal "
+                                f"{self._file_path}: {e}")
+            try:
+                # A partly written batch would end the journal at the torn record when it is resumed
+                self._file.truncate(self._end)
+                self._file.seek(self._end)
+            except OSError:
+                pass
+            return False
+        self._end += len(data)
+        with self._stats_lock:
+            self._records += len(records)
+            self._syncs += 1
+            self._bytes += len(data)
+        return True
+
+    def _write_all(self, data):
+        # A raw file may write less than it was given
+        view = memoryview(data)
+        while view:
+            view = view[self._file.write(view):]
+
+    def _load(self, fingerprint):
+        clients = {}
+        with open(self._file_path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size < _HEADER.size:
+                raise ValueError(f"{self._file_path} is not a pipeline journal")
+            # The journal of a long sweep over a large fleet is read in place instead of into memory
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as journal:
+                magic, version, journal_fingerprint = _HEADER.unpack_from(journal, 0)
+                if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+                    raise ValueError(f"{self._file_path} is not a pipeline journal")
+                if journal_fingerprint != fingerprint:
+                    raise ValueError(f"{self._file_path} was written for different pipelines and cannot be resumed")
+                position = _HEADER.size
+                while position + _CRC.size + _RECORD.size <= size:
+                    start = position + _CRC.size
+                    kind, length, step, command_id = _RECORD.unpack_from(journal, start)
+                    end = start + _RECORD.size + length
+                    if end > size or zlib.crc32(journal[start:end]) != _CRC.unpack_from(journal, position)[0]:
+                        break
+                    client = clients.setdefault(journal[start + _RECORD.size:end].decode(), ResumedClient())
+                    if kind == DISPATCHED:
+                        client.in_flight = step
+                        client.command_id = command_id.hex()
+                    else:
+                        client.done = max(client.done, step)
+                        if client.in_flight == step:
+                            client.in_flight = None
+                            client.command_id = None
+                    position = end
+        return clients, position
@@ -0,0 +1,124 @@
+import time
+from threading import Condition
+import color_log
+from delivery import new_command_id
+from pipeline_journal import PipelineJournal
+
+
+class PipelineScheduler:
+    def __init__(self, pipelines: dict, send_command, step_timeout: float, journal: PipelineJournal = None,
+                 resume: bool = False):
+        # Every client walks the same flattened list of (pipeline, step, command) at its own pace
+        self._steps = []
+        for pipeline_name, pipeline_commands in pipelines.items():
+            commands = [command.strip() for command in pipeline_commands.split(';') if command.strip()]
+            for step, command in enumerate(commands):
+                self._steps.append((pipeline_name, step, command))
+        # send_command(client_id, command, metadata, command_id)
+        self._send_command = send_command
+        self._step_timeout = step_timeout
+        self._condition = Condition()
+        self._progress = {}
+        self._command_ids = {}
+        self._deadlines = {}
+        self._started = {}
+        self._finished = set()
+        self._journal = journal
+        self._resumed = journal.open(self._steps, resume) if journal is not None else {}
+
+    def add_client(self, client_id):
+        resent = False
+        with self._condition:
+            if client_id in self._progress:
+                return
+            self._started[client_id] = time.monotonic()
+            resumed = self._resumed.pop(client_id, None)
+            if resumed is not None and resumed.in_flight is not None:
+                # Sent again under the old command_id, a client that already ran it replays its feedback
+                self._progress[client_id] = resumed.in_flight
+                self._command_ids[client_id] = resumed.command_id
+                self._deadlines[client_id] = time.monotonic() + self._step_timeout
+                step, resent = (resumed.in_flight, resumed.command_id), True
+            else:
+                self._progress[client_id] = resumed.done if resumed is not None else -1
+                step = self._advance(client_id)
+            self._condition.notify_all()
+        self._dispatch(client_id, step, resent)
+
+    def on_feedback(self, client_id, command, pipeline=None, step=None, command_id=None):
+        with self._condition:
+            index = self._progress.get(client_id)
+            if index is None or client_id in self._finished:
+                return
+            pipeline_name, step_index, step_command = self._steps[index]
+            if command_id is not None:
+                # Late or repeated feedback of an earlier step with the same command text does not match
+                matches = command_id == self._command_ids.get(client_id)
+            elif pipeline is not None:
+                matches = pipeline == pipeline_name and step == step_index
+            else:
+                # Clients that echo neither the command_id nor the step are matched on the command text
+                matches = command == step_command
+            if not matches:
+                return
+            completed = (index, self._command_ids.get(client_id))
+            next_step = self._advance(client_id)
+            self._condition.notify_all()
+        if self._journal is not None:
+            self._journal.completed(client_id, *completed)
+        self._dispatch(client_id, next_step)
+
+    def run(self, client_ids):
+        start = time.monotonic()
+        # Clients of a resumed journal continue even if they did not register again yet
+        for client_id in list(client_ids) + list(self._resumed):
+            self.add_client(client_id)
+        while True:
+            with self._condition:
+                if len(self._finished) == len(self._progress):
+                    break
+                now = time.monotonic()
+                expired = [client_id for client_id, deadline in self._deadlines.items() if deadline <= now]
+                if not expired:
+                    timeout = min(self._deadlines.values()) - now if self._deadlines else None
+                    self._condition.wait(timeout)
+                    continue
+                dispatches = []
+                for client_id in expired:
+                    index = self._progress[client_id]
+                    pipeline_name, step_index, step_command = self._steps[index]
+                    color_log.log_error(f"Step {step_index} of {pipeline_name} timed out on {client_id} "
+                                        f"after {self._step_timeout}s: {step_command}")
+                    timed_out = (index, self._command_ids.get(client_id))
+                    dispatches.append((client_id, timed_out, self._advance(client_id)))
+            for client_id, timed_out, step in dispatches:
+                if self._journal is not None:
+                    self._journal.timed_out(client_id, *timed_out)
+                self._dispatch(client_id, step)
+        color_log.log_info(f"Pipelines finished on {len(self._finished)} clients in {time.monotonic() - start:.1f}s")
+
+    def _advance(self, client_id):
+        # Must be called with the condition held; returns the index and command_id of the next step, if any
+        index = self._progress[client_id] + 1
+        self._progress[client_id] = index
+        if index >= len(self._steps):
+            self._deadlines.pop(client_id, None)
+            self._command_ids.pop(client_id, None)
+            self._finished.add(client_id)
+            color_log.log_info(f"Pipelines finished on {client_id} in "
+                               f"{time.monotonic() - self._started[client_id]:.1f}s")
+            return None
+        self._deadlines[client_id] = time.monotonic() + self._step_timeout
+        command_id = self._command_ids[client_id] = new_command_id()
+        return index, command_id
+
+    def _dispatch(self, client_id, step, resent=False):
+        if step is None:
+            return
+        index, command_id = step
+        # Recorded before sending, but on disk before the publish only with journal_fsync_interval = 0; otherwise a
+        # crash within the interval loses the record and the resumed step goes out again under a new command_id
+        if self._journal is not None and not resent:
+            self._journal.dispatched(client_id, index, command_id)
+        pipeline_name, step_index, command = self._steps[index]
+        self._send_command(client_id, command, {"pipeline": pipeline_name, "step": step_index}, command_id)
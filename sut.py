@@ -1,14 +1,372 @@
 import argparse
-import paho.mqtt.client as mqtt
+import asyncio
 import configparser
 import subprocess
 import os
+import random
 import time
-import json
-from queue import Queue, Empty
-from threading import Thread, Event
+import codecs
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Thread, Event, BoundedSemaphore, Lock
 from datetime import datetime
 import color_log
+import codec
+import topics
+from telemetry import TelemetrySampler, system_tags
+from delivery import ReplayCache, FEATURE_RECEIPTS
+from feedback_stream import FEEDBACK_CHUNK, FEEDBACK_FINAL, FEEDBACK_RECEIVED
+from async_core import MQTTClient, shared_loop, backoff_delays, run_shell
+
+
+# Command message fields that are echoed back in the feedback; the trace gains the SUT's hops on the way
+ECHO_FIELDS = ('pipeline', 'step', 'stream', 'command_id', 'trace')
+
+LANE_SERIAL = 'serial'
+LANE_PARALLEL = 'parallel'
+
+# threads runs commands with subprocess on lane threads, asyncio runs them as tasks on the shared event loop
+EXECUTOR_THREADS = 'threads'
+EXECUTOR_ASYNCIO = 'asyncio'
+EXECUTORS = (EXECUTOR_THREADS, EXECUTOR_ASYNCIO)
+
+# Bytes read from a command's output pipes at a time when the output is captured with limits
+OUTPUT_READ_SIZE = 65536
+
+# Registrations are repeated until acknowledged, backing off while no operator answers
+REGISTRATION_RETRY_INITIAL = 5
+REGISTRATION_RETRY_MAX = 60
+REGISTRATION_JITTER = 0.5
+# A restarted operator hears from the fleet within this many seconds, spread out so it is not flooded at once
+REREGISTRATION_SPREAD = 2.0
+
+
+def command_name(command: str) -> str:
+    words = command.split()
+    while words and words[0] == 'sudo':
+        words = words[1:]
+    return os.path.basename(words[0]) if words else ''
+
+
+def choose_lane(command, metadata, lane=None, parallel_prefixes=()):
+    if 'pipeline' in metadata:
+        return LANE_SERIAL
+    if lane in (LANE_SERIAL, LANE_PARALLEL):
+        return lane
+    if parallel_prefixes and command.startswith(parallel_prefixes):
+        return LANE_PARALLEL
+    return LANE_SERIAL
+
+
+class CommandEngine:
+    def __init__(self,
+                 execute,
+                 max_workers: int,
+                 parallel_prefixes=(),
+                 command_limits: dict = None):
+        # Commands run on one ordered serial lane (pipeline steps, anything not marked otherwise)
+        # or on a pool of parallel workers (quick probes and telemetry reads)
+        self._execute = execute
+        self._parallel_prefixes = tuple(parallel_prefixes)
+        self._limits = {name: BoundedSemaphore(limit) for name, limit in (command_limits or {}).items()}
+        self._serial_queue = Queue()
+        self._serial_thread = Thread(target=self._run_serial_lane)
+        self._serial_thread.start()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sut-parallel')
+
+    def choose_lane(self, command, metadata, lane=None):
+        return choose_lane(command, metadata, lane, self._parallel_prefixes)
+
+    def submit(self, command, metadata, lane=None):
+        lane = self.choose_lane(command, metadata, lane)
+        queued_at = time.monotonic()
+        if lane == LANE_PARALLEL:
+            self._pool.submit(self._run, command, metadata, queued_at)
+        else:
+            self._serial_queue.put((command, metadata, queued_at))
+        return lane
+
+    def _run(self, command, metadata, queued_at):
+        limit = self._limits.get(command_name(command))
+        try:
+            if limit is None:
+                self._execute(command, metadata, time.monotonic() - queued_at)
+            else:
+                with limit:
+                    self._execute(command, metadata, time.monotonic() - queued_at)
+        except Exception as e:
+            color_log.log_error(f"Command engine failed to run '{command}': {e}")
+
+    def _run_serial_lane(self):
+        while True:
+            item = self._serial_queue.get()
+            if item is None:
+                break
+            self._run(*item)
+
+    def stop(self):
+        self._serial_queue.put(None)
+        self._serial_thread.join()
+        self._pool.shutdown(wait=True)
+
+
+class AsyncCommandEngine:
+    def __init__(self,
+                 execute,
+                 max_workers: int,
+                 parallel_prefixes=(),
+                 command_limits: dict = None,
+                 runner=None):
+        # The lanes of CommandEngine as tasks on an event loop; execute is a coroutine function and up to
+        # max_workers parallel commands run at once without a thread each
+        self._execute = execute
+        self._parallel_prefixes = tuple(parallel_prefixes)
+        self._runner = runner or shared_loop()
+        self._tasks = set()
+        self._runner.run(self._start(max_workers, command_limits or {}))
+
+    async def _start(self, max_workers, command_limits):
+        self._workers = asyncio.Semaphore(max_workers)
+        self._limits = {name: asyncio.Semaphore(limit) for name, limit in command_limits.items()}
+        self._serial_queue = asyncio.Queue()
+        self._serial_task = asyncio.ensure_future(self._run_serial_lane())
+
+    def choose_lane(self, command, metadata, lane=None):
+        return choose_lane(command, metadata, lane, self._parallel_prefixes)
+
+    def submit(self, command, metadata, lane=None):
+        lane = self.choose_lane(command, metadata, lane)
+        item = (command, metadata, time.monotonic())
+        if lane == LANE_PARALLEL:
+            self._runner.call_soon(self._spawn, item)
+        else:
+            self._runner.call_soon(self._serial_queue.put_nowait, item)
+        return lane
+
+    def _spawn(self, item):
+        task = asyncio.ensure_future(self._run_parallel(*item))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_parallel(self, command, metadata, queued_at):
+        async with self._workers:
+            await self._run(command, metadata, queued_at)
+
+    async def _run(self, command, metadata, queued_at):
+        limit = self._limits.get(command_name(command))
+        try:
+            if limit is None:
+                await self._execute(command, metadata, time.monotonic() - queued_at)
+            else:
+                async with limit:
+                    await self._execute(command, metadata, time.monotonic() - queued_at)
+        except Exception as e:
+            color_log.log_error(f"Command engine failed to run '{command}': {e}")
+
+    async def _run_serial_lane(self):
+        while True:
+            item = await self._serial_queue.get()
+            if item is None:
+                break
+            await self._run(*item)
+
+    async def _stop(self):
+        self._serial_queue.put_nowait(None)
+        await self._serial_task
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stop(self):
+        self._runner.run(self._stop())
+
+
+class OutputStreamer:
+    def __init__(self, publish_chunk, chunk_size: int, interval: float):
+        # Output is published as soon as a stream buffers chunk_size characters or interval seconds pass
+        self._publish_chunk = publish_chunk
+        self._chunk_size = chunk_size
+        self._interval = interval
+        self._buffers = {'stdout': '', 'stderr': ''}
+        self._lock = Lock()
+        self._seq = 0
+
+    def run(self, process) -> int:
+        readers = [Thread(target=self._read, args=('stdout', process.stdout)),
+                   Thread(target=self._read, args=('stderr', process.stderr))]
+        for reader in readers:
+            reader.start()
+        done = Event()
+        flusher = Thread(target=self._flush_periodically, args=(done,))
+        flusher.start()
+        for reader in readers:
+            reader.join()
+        done.set()
+        flusher.join()
+        process.wait()
+        for name in self._buffers:
+            self._flush(name)
+        return self._seq
+
+    async def run_async(self, process) -> int:
+        # The same for a process started with asyncio.create_subprocess_*, without any threads
+        flusher = asyncio.ensure_future(self._flush_periodically_async())
+        try:
+            await asyncio.gather(self._read_async('stdout', process.stdout), self._read_async('stderr', process.stderr))
+        finally:
+            flusher.cancel()
+        await process.wait()
+        for name in self._buffers:
+            self._flush(name)
+        return self._seq
+
+    def _read(self, name, pipe):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            data = os.read(pipe.fileno(), self._chunk_size)
+            self._append(name, decoder.decode(data, final=not data))
+            if not data:
+                break
+        pipe.close()
+
+    async def _read_async(self, name, stream):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            data = await stream.read(self._chunk_size)
+            self._append(name, decoder.decode(data, final=not data))
+            if not data:
+                break
+
+    def _append(self, name, text):
+        with self._lock:
+            self._buffers[name] += text
+            if len(self._buffers[name]) >= self._chunk_size:
+                self._flush_locked(name)
+
+    def _flush_periodically(self, done):
+        while not done.wait(self._interval):
+            for name in self._buffers:
+                self._flush(name)
+
+    async def _flush_periodically_async(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            for name in self._buffers:
+                self._flush(name)
+
+    def _flush(self, name):
+        with self._lock:
+            self._flush_locked(name)
+
+    def _flush_locked(self, name):
+        data = self._buffers[name]
+        self._buffers[name] = ''
+        for start in range(0, len(data), self._chunk_size):
+            self._publish_chunk(name, self._seq, data[start:start + self._chunk_size])
+            self._seq += 1
+
+
+class OutputCapture:
+    # One output stream of a command, of which only the first head_bytes and the last tail_bytes stay in memory.
+    # With a spill_path the complete stream goes to that file once it outgrows the limits.
+    def __init__(self, head_bytes: int, tail_bytes: int, spill_path: str = None):
+        self._head_bytes = head_bytes
+        self._tail_bytes = tail_bytes
+        self._spill_path = spill_path
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._size = 0
+        self._digest = hashlib.sha256()
+        self._spill = None
+        self._spill_error = None
+
+    def write(self, data: bytes):
+        self._size += len(data)
+        self._digest.update(data)
+        if self._spill is not None:
+            try:
+                self._spill.write(data)
+            except OSError as e:
+                self._give_up_spill(e)
+        room = self._head_bytes - len(self._head)
+        if room > 0:
+            self._head += data[:room]
+            data = data[room:]
+        self._tail += data
+        if len(self._tail) > self._tail_bytes:
+            if self._spill is None and self._spill_path is not None and self._spill_error is None:
+                # Everything so far is still in memory, the file starts with it
+                try:
+                    os.makedirs(os.path.dirname(self._spill_path) or '.', exist_ok=True)
+                    self._spill = open(self._spill_path, 'wb')
+                    self._spill.write(self._head)
+                    self._spill.write(self._tail)
+                except OSError as e:
+                    self._give_up_spill(e)
+            del self._tail[:len(self._tail) - self._tail_bytes]
+
+    def _give_up_spill(self, error):
+        # The pipe is still drained and its head and tail kept, only the complete copy is lost
+        color_log.log_error(f"Failed to spill output to {self._spill_path}: {error}")
+        self._spill_error = str(error)
+        spill, self._spill = self._spill, None
+        try:
+            if spill is not None:
+                spill.close()
+        except OSError:
+            pass
+        try:
+            os.remove(self._spill_path)
+        except OSError:
+            pass
+
+    def close(self):
+        # Returns the retained text and, if output was left out, a description of the complete stream
+        if self._spill is not None:
+            try:
+                self._spill.close()
+            except OSError as e:
+                self._give_up_spill(e)
+        omitted = self._size - len(self._head) - len(self._tail)
+        if not omitted:
+            return (self._head + self._tail).decode(errors='replace'), None
+        text = f"{self._head.decode(errors='replace')}\n[... {omitted} bytes omitted ...]\n" \
+               f"{self._tail.decode(errors='replace')}"
+        spill = {"bytes": self._size, "omitted": omitted, "sha256": self._digest.hexdigest()}
+        if self._spill is not None:
+            spill["path"] = os.path.abspath(self._spill_path)
+        elif self._spill_error is not None:
+            spill["error"] = self._spill_error
+        return text, spill
+
+
+class CapturedOutput:
+    # Result of a command run with output limits, shaped like subprocess.CompletedProcess
+    def __init__(self, returncode: int, captures: dict):
+        self.returncode = returncode
+        self.stdout, stdout_spill = captures['stdout'].close()
+        self.stderr, stderr_spill = captures['stderr'].close()
+        self.spills = {name: spill for name, spill in (('stdout', stdout_spill), ('stderr', stderr_spill)) if spill}
+
+
+def _capture_pipe(pipe, capture: OutputCapture):
+    try:
+        while True:
+            data = os.read(pipe.fileno(), OUTPUT_READ_SIZE)
+            if not data:
+                break
+            capture.write(data)
+    finally:
+        pipe.close()
+
+
+async def _capture_stream(stream, capture: OutputCapture):
+    while True:
+        data = await stream.read(OUTPUT_READ_SIZE)
+        if not data:
+            break
+        capture.write(data)
 
 
 class SUT:
@@ -21,6 +379,33 @@ class SUT:
                  ack_topic: str,
                  jsonify: bool,
                  colorlog: bool,
+                 command_routing: str = topics.ROUTING_PER_CLIENT,
+                 max_workers: int = 4,
+                 parallel_commands=(),
+                 command_limits: dict = None,
+                 stream_output: bool = False,
+                 stream_chunk_size: int = 4096,
+                 stream_interval: float = 1.0,
+                 wire_format: str = None,
+                 compress_threshold: int = 0,
+                 telemetry: bool = False,
+                 telemetry_interval: float = 0.5,
+                 telemetry_capacity: int = 4096,
+                 telemetry_series: bool = False,
+                 qos: int = 0,
+                 delivery_receipts: bool = False,
+                 replay_capacity: int = 256,
+                 executor: str = EXECUTOR_THREADS,
+                 tags: dict = None,
+                 advertise_capabilities: bool = False,
+                 output_head_bytes: int = 0,
+                 output_tail_bytes: int = 0,
+                 output_spill_dir: str = None,
+                 output_spill_keep: int = 100,
+                 compression: str = codec.COMPRESSION_ZLIB,
+                 persistent_session: bool = False,
+                 reconnect_min: float = 1,
+                 reconnect_max: float = 60,
                  *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._client_id = client_id
@@ -28,132 +413,433 @@ class SUT:
         self._port = port
         self._command_topic = command_topic
         self._response_topic = response_topic
+        # A sharded operator may direct the feedback to a sub-topic of the response topic
+        self._feedback_topic = response_topic
         self._registration_topic = registration_topic
+        self._hello_topic = topics.hello_topic(registration_topic)
         self._ack_topic = ack_topic
+        self._client_ack_topic = topics.client_ack_topic(ack_topic, client_id)
         self._jsonify = jsonify
+        self._wire_format = codec.validate_format(wire_format or codec.default_format(jsonify))
+        # Until the operator confirms otherwise, feedback uses the format older operators understand
+        self._feedback_format = codec.default_format(jsonify)
+        if self._wire_format != codec.FORMAT_BINARY:
+            self._feedback_format = self._wire_format
+        self._compress_threshold = compress_threshold
+        self._compression = codec.validate_compression(compression)
+        # zstd is used once the operator's acknowledgment says it can decode it
+        self._feedback_compression = codec.COMPRESSION_ZLIB
+        # 0 for both keeps the complete output of buffered commands in memory
+        self._output_head_bytes = output_head_bytes
+        self._output_tail_bytes = output_tail_bytes
+        self._output_spill_dir = output_spill_dir
+        # 0 keeps every spill file
+        self._output_spill_keep = output_spill_keep
+        self._spill_lock = Lock()
         self._colorlog = colorlog
+        # A SUT listens on one layout only; 'both' is an operator-side setting for mixed fleets
+        self._command_routing = topics.validate_routing(command_routing)
+        if self._command_routing == topics.ROUTING_BOTH:
+            self._command_routing = topics.ROUTING_PER_CLIENT
+        if self._command_routing == topics.ROUTING_PER_CLIENT:
+            topics.validate_client_id(client_id)
+        self._stream_output = stream_output
+        self._stream_chunk_size = stream_chunk_size
+        self._stream_interval = stream_interval
+        self._run_ids = itertools.count()
+        self._qos = qos
+        self._delivery_receipts = delivery_receipts
+        # Announced at registration, the operator resolves selectors such as 'arch=arm64,cores>=8' against them
+        self._tags = {**(system_tags() if advertise_capabilities else {}), **(tags or {})}
+        self._replay = ReplayCache(replay_capacity)
+        self._sampler = None
+        if telemetry:
+            self._sampler = TelemetrySampler(telemetry_interval, telemetry_capacity, telemetry_series)
         color_log.enable_color_logging(self._colorlog)
-        self._client = mqtt.Client(client_id=client_id)
+        if self._stream_output and self._wire_format == codec.FORMAT_TEXT:
+            color_log.log_warning("Streaming output requires the json or binary wire format, "
+                                  "command output will be buffered")
+        # A persistent session keeps the commands sent while the client is reconnecting queued on the broker
+        self._client = MQTTClient(client_id=client_id, clean_session=not persistent_session,
+                                  reconnect_min=reconnect_min, reconnect_max=reconnect_max)
         self._client.on_connect = self.on_connect
         self._client.on_message = self.on_message
-        self._command_queue = Queue()
-        self._stop_event = Event()
         self._ack_received = Event()
+        self._registration = None
+        # Set once the ongoing registration has published, an operator starting after that has not seen it
+        self._registration_sent = False
+        self._operator_epoch = None
 
-        # Start the command processing thread
-        self._worker_thread = Thread(target=self._process_commands)
-        self._worker_thread.start()
-
-        # Start the registration thread
-        self._registration_thread = Thread(target=self._send_registration)
-        self._registration_thread.start()
+        # Start the command execution lanes
+        if executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor '{executor}', expected one of: {', '.join(EXECUTORS)}")
+        if executor == EXECUTOR_ASYNCIO:
+            self._engine = AsyncCommandEngine(self._execute_command_async, max_workers, parallel_commands,
+                                              command_limits)
+        else:
+            self._engine = CommandEngine(self._execute_command, max_workers, parallel_commands, command_limits)
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             color_log.log_info(f"Connected successfully to {self._broker}:{self._port}")
-            self._client.subscribe(self._command_topic)
-            self._client.subscribe(self._ack_topic)
+            if self._command_routing == topics.ROUTING_SHARED:
+                self._client.subscribe(self._command_topic, qos=self._qos)
+            else:
+                self._client.subscribe(topics.client_command_topic(self._command_topic, self._client_id), qos=self._qos)
+                self._client.subscribe(topics.broadcast_command_topic(self._command_topic), qos=self._qos)
+                self._client.subscribe(topics.batch_command_topic(self._command_topic), qos=self._qos)
+            # A JSON registration is acknowledged on the client's own topic, so acks do not fan out to the fleet
+            ack_topic = self._client_ack_topic if self._registers_with_json() else self._ack_topic
+            self._client.subscribe(ack_topic, qos=self._qos)
+            self._client.subscribe(self._hello_topic, qos=self._qos)
         else:
             color_log.log_error(f"Connection failed with code {rc}")
 
     def on_message(self, client, userdata, msg):
-        message = msg.payload.decode()
-        if msg.topic == self._ack_topic:
-            if message == self._client_id:
-                color_log.log_info(f"Received acknowledgment for {self._client_id}")
+        if msg.topic == self._ack_topic or msg.topic == self._client_ack_topic:
+            try:
+                ack = codec.decode_ack(msg.payload.decode())
+            except codec.CodecError as e:
+                color_log.log_error(str(e))
+                return
+            if ack.get('client_id') == self._client_id:
+                if ack.get('format') in codec.FORMATS:
+                    self._feedback_format = ack['format']
+                if self._compression in (ack.get('compression') or ()):
+                    self._feedback_compression = self._compression
+                response_topic = ack.get('response_topic')
+                if isinstance(response_topic, str) and response_topic.startswith(self._response_topic + '/'):
+                    self._feedback_topic = response_topic
+                else:
+                    self._feedback_topic = self._response_topic
+                color_log.log_info("Received acknowledgment for %s (%s)", self._client_id, self._feedback_format)
                 self._ack_received.set()
+        elif msg.topic == self._hello_topic:
+            self._on_hello(msg.payload.decode())
         else:
-            if self._jsonify:
-                try:
-                    data = json.loads(message)
-                    msg_client_id = data['client_id']
-                    command = data['command']
-                except json.JSONDecodeError as e:
-                    color_log.log_error(f"Failed to decode JSON message: {e}")
-                    return
-            else:
-                msg_client_id, command = message.split('|', 1)
+            try:
+                data = codec.decode_command(msg.payload)
+            except codec.CodecError as e:
+                color_log.log_error(f"Failed to decode command: {e}")
+                return
+            if isinstance(data.get('trace'), dict):
+                data['trace']['sut_receive'] = time.time()
+            targets = data.get('targets')
+            if targets is not None and self._client_id not in targets:
+                # A batched command for other clients
+                return
+            msg_client_id = data['client_id']
+            command = data['command']
+            metadata = {field: data[field] for field in ECHO_FIELDS if field in data}
 
-            if msg_client_id == self._client_id:
-                color_log.log_warning(f"Received command for {self._client_id}: {command}")
-                self._command_queue.put(command)
+            if msg_client_id == self._client_id or msg_client_id == topics.BROADCAST_ID:
+                command_id = data.get('command_id')
+                if command_id is not None:
+                    if self._delivery_receipts and self._feedback_format != codec.FORMAT_TEXT:
+                        self._publish_feedback({"type": FEEDBACK_RECEIVED, "client_id": self._client_id,
+                                                "command_id": command_id})
+                    if not self._replay.begin(command_id):
+                        self._replay_feedback(command_id, command)
+                        return
+                lane = self._engine.submit(command, metadata, data.get('lane'))
+                color_log.log_warning("Received command for %s (%s lane): %s", self._client_id, lane, command)
 
-    def _send_registration(self):
-        time.sleep(0.5)  # Wait for starting execution of other threads
-        while not self._ack_received.is_set():
-            self._client.publish(self._registration_topic, self._client_id)
-            color_log.log_info(f"Sent registration for {self._client_id}")
-            time.sleep(5)  # Wait before resending registration
+    def _replay_feedback(self, command_id, command):
+        # A repeated delivery never runs the command twice; finished commands resend their feedback
+        payloads = self._replay.payloads(command_id)
+        if payloads is None:
+            color_log.log_info("Command %s is already running: %s", command_id, command)
+            return
+        color_log.log_info("Replaying feedback of command %s: %s", command_id, command)
+        for payload in payloads:
+            self._client.publish(self._feedback_topic, payload, qos=self._qos)
 
-    def _process_commands(self):
-        while not self._stop_event.is_set():
-            try:
-                command = self._command_queue.get(timeout=1)  # Non-blocking get with timeout
-            except Empty:
-                continue  # Loop again if no command is received
-            if command is None:
-                break
-            color_log.log_info(f"Executing command: {command}")
+    def _registration_payload(self):
+        # Only clients that need to negotiate send a JSON registration, the others stay readable by older operators
+        if self._registers_with_json():
+            formats = [codec.FORMAT_BINARY, codec.default_format(self._jsonify)] \
+                if self._wire_format == codec.FORMAT_BINARY else None
+            features = [FEATURE_RECEIPTS] if self._delivery_receipts else []
+            if self._command_routing != topics.ROUTING_SHARED:
+                features.append(topics.FEATURE_BATCH)
+            return codec.encode_registration(self._client_id, formats, features, self._tags)
+        return self._client_id
+
+    def _registers_with_json(self) -> bool:
+        return self._wire_format == codec.FORMAT_BINARY or self._delivery_receipts or bool(self._tags)
+
+    def _on_hello(self, payload):
+        if not payload:
+            return
+        try:
+            epoch = codec.decode_hello(payload).get('epoch')
+        except codec.CodecError as e:
+            color_log.log_error(str(e))
+            return
+        if epoch is None:
+            return
+        known, self._operator_epoch = self._operator_epoch, epoch
+        if self._ack_received.is_set():
+            if epoch == known:
+                return
+            color_log.log_info("Operator restarted (epoch %s), registering %s again", epoch, self._client_id)
+            self._ack_received.clear()
+        elif not self._registration_sent:
+            # The registration about to go out already reaches this operator
+            return
+        else:
+            # Started before the operator, the unacknowledged registration would otherwise wait out its backoff
+            color_log.log_info("Operator started (epoch %s), registering %s again", epoch, self._client_id)
+        self._restart_registration(random.uniform(0, REREGISTRATION_SPREAD))
+
+    def _restart_registration(self, delay: float = 0.5):
+        if self._registration is not None:
+            self._registration.cancel()
+        self._registration_sent = False
+        self._registration = shared_loop().submit(self._send_registration(delay))
+
+    async def _send_registration(self, delay: float = 0.5):
+        await asyncio.sleep(delay)  # Give the connection a moment to come up
+        for delay in backoff_delays(REGISTRATION_RETRY_INITIAL, REGISTRATION_RETRY_MAX, jitter=REGISTRATION_JITTER):
+            if self._ack_received.is_set():
+                return
+            self._client.publish(self._registration_topic, self._registration_payload(), qos=self._qos)
+            self._registration_sent = True
+            color_log.log_info("Sent registration for %s", self._client_id)
+            await asyncio.sleep(delay)
+
+    def _publish_feedback(self, feedback: dict):
+        payload = codec.encode_feedback(self._feedback_format, feedback, self._compress_threshold,
+                                        self._feedback_compression)
+        self._client.publish(self._feedback_topic, payload, qos=self._qos)
+        return payload
+
+    def _execute_command(self, command, metadata, queue_wait):
+        trace = self._command_started(command, metadata)
+        if self._streams(metadata):
+            self._execute_streamed(command, metadata, queue_wait, trace)
+            return
+        marker = self._sampler.begin() if self._sampler is not None else None
+        start_unix = datetime.now().timestamp()
+        try:
+            feedback = self._command_feedback(command, start_unix, queue_wait, result=self._run_process(command))
+        except Exception as e:
+            feedback = self._command_feedback(command, start_unix, queue_wait, error=e)
+        self._finish_command(feedback, metadata, marker, trace)
+
+    async def _execute_command_async(self, command, metadata, queue_wait):
+        trace = self._command_started(command, metadata)
+        if self._streams(metadata):
+            await self._execute_streamed_async(command, metadata, queue_wait, trace)
+            return
+        marker = self._sampler.begin() if self._sampler is not None else None
+        start_unix = datetime.now().timestamp()
+        try:
+            result = await self._run_process_async(command)
+            feedback = self._command_feedback(command, start_unix, queue_wait, result=result)
+        except Exception as e:
+            feedback = self._command_feedback(command, start_unix, queue_wait, error=e)
+        self._finish_command(feedback, metadata, marker, trace)
+
+    def _run_process(self, command):
+        # Runs a buffered command; returns an object with stdout and stderr, like subprocess.run
+        if not self._limits_output():
+            return subprocess.run(command, shell=True, capture_output=True, text=True)
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            captures = self._output_captures()
+            reader = Thread(target=_capture_pipe, args=(process.stderr, captures['stderr']), daemon=True)
+            reader.start()
+            _capture_pipe(process.stdout, captures['stdout'])
+            reader.join()
+            result = CapturedOutput(process.wait(), captures)
+        finally:
+            # Nothing reads the pipes any more if capturing failed, the command would block on a full pipe
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        if result.spills:
+            self._prune_output_spills()
+        return result
+
+    async def _run_process_async(self, command):
+        if not self._limits_output():
+            return await run_shell(command)
+        process = await asyncio.create_subprocess_shell(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            captures = self._output_captures()
+            await asyncio.gather(_capture_stream(process.stdout, captures['stdout']),
+                                 _capture_stream(process.stderr, captures['stderr']))
+            result = CapturedOutput(await process.wait(), captures)
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        if result.spills:
+            await asyncio.get_running_loop().run_in_executor(None, self._prune_output_spills)
+        return result
+
+    def _prune_output_spills(self):
+        # Keeps the newest output_spill_keep spill files, a long sweep would otherwise fill the disk
+        if not self._output_spill_dir or not self._output_spill_keep:
+            return
+        with self._spill_lock:
             try:
-                start_time = datetime.now()
-                start_unix = start_time.timestamp()
-                result = subprocess.run(command, shell=True, capture_output=True, text=True)
-                end_time = datetime.now()
-                end_unix = end_time.timestamp()
-                output = result.stdout
-                error = result.stderr
-                feedback = {
-                    "client_id": self._client_id,
-                    "command": command,
-                    "start_time": f"{start_unix}",
-                    "end_time": f"{end_unix}",
-                    "output": output,
-                    "error": error if error else 'None'
-                } if self._jsonify else (
-                    f"Client: {self._client_id}\n"
-                    f"Command: {command}\n"
-                    f"Start Time: {start_unix}\n"
-                    f"End Time: {end_unix}\n"
-                    f"Output: {output}\n"
-                    f"Error: {error if error else 'None'}"
-                )
-                self._client.publish(self._response_topic, json.dumps(feedback) if self._jsonify else feedback)
-            except Exception as e:
-                end_time = datetime.now()
-                end_unix = end_time.timestamp()
-                error_feedback = {
-                    "client_id": self._client_id,
-                    "command": command,
-                    "start_time": f"{start_unix}",
-                    "end_time": f"{end_unix}",
-                    "error": f"Failed to execute command: {e}"
-                } if self._jsonify else (
-                    f"Client: {self._client_id}\n"
-                    f"Command: {command}\n"
-                    f"Start Time: {start_unix}\n"
-                    f"End Time: {end_unix}\n"
-                    f"Error: Failed to execute command: {e}"
-                )
-                self._client.publish(self._response_topic,
-                                     json.dumps(error_feedback) if self._jsonify else error_feedback)
-            self._command_queue.task_done()
+                spills = [(entry.stat().st_mtime, entry.path) for entry in os.scandir(self._output_spill_dir)
+                          if entry.name.endswith(('.stdout', '.stderr'))]
+            except OSError as e:
+                color_log.log_error(f"Failed to list output spills in {self._output_spill_dir}: {e}")
+                return
+            spills.sort()
+            for _, path in spills[:max(len(spills) - self._output_spill_keep, 0)]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _limits_output(self) -> bool:
+        return bool(self._output_head_bytes or self._output_tail_bytes)
+
+    def _output_captures(self) -> dict:
+        run_id = f"{self._client_id}-{os.getpid()}-{next(self._run_ids)}"
+        return {name: OutputCapture(self._output_head_bytes, self._output_tail_bytes,
+                                    os.path.join(self._output_spill_dir, f"{run_id}.{name}")
+                                    if self._output_spill_dir else None)
+                for name in ('stdout', 'stderr')}
+
+    def _command_started(self, command, metadata):
+        trace = metadata.get('trace')
+        if trace is not None:
+            trace['sut_dequeue'] = time.time()
+        color_log.log_info("Executing command: %s", command)
+        return trace
+
+    def _streams(self, metadata) -> bool:
+        return self._feedback_format != codec.FORMAT_TEXT and metadata.get('stream', self._stream_output)
+
+    def _command_feedback(self, command, start_unix, queue_wait, result=None, error=None) -> dict:
+        feedback = {
+            "client_id": self._client_id,
+            "command": command,
+            "start_time": start_unix,
+            "end_time": datetime.now().timestamp(),
+            "queue_wait": queue_wait
+        }
+        if error is None:
+            feedback["output"] = result.stdout
+            feedback["error"] = result.stderr if result.stderr else 'None'
+            spills = getattr(result, 'spills', None)
+            if spills:
+                feedback["output_spill"] = spills
+        else:
+            feedback["error"] = f"Failed to execute command: {error}"
+        return feedback
+
+    def _finish_command(self, feedback, metadata, marker, trace):
+        if marker is not None:
+            feedback["telemetry"] = self._sampler.end(marker)
+        feedback.update(metadata)
+        if trace is not None:
+            trace.update(process_start=feedback['start_time'], process_end=feedback['end_time'],
+                         feedback_publish=time.time())
+        payload = self._publish_feedback(feedback)
+        if 'command_id' in metadata:
+            self._replay.complete(metadata['command_id'], [payload])
+
+    def _execute_streamed(self, command, metadata, queue_wait, trace=None):
+        run = _StreamedRun(self, command)
+        try:
+            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            run.chunks = OutputStreamer(run.publish_chunk, self._stream_chunk_size, self._stream_interval).run(process)
+            run.exit_code = process.returncode
+        except Exception as e:
+            run.error = f"Failed to execute command: {e}"
+        run.finish(metadata, queue_wait, trace)
+
+    async def _execute_streamed_async(self, command, metadata, queue_wait, trace=None):
+        run = _StreamedRun(self, command)
+        try:
+            process = await asyncio.create_subprocess_shell(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            streamer = OutputStreamer(run.publish_chunk, self._stream_chunk_size, self._stream_interval)
+            run.chunks = await streamer.run_async(process)
+            run.exit_code = process.returncode
+        except Exception as e:
+            run.error = f"Failed to execute command: {e}"
+        run.finish(metadata, queue_wait, trace)
 
     def run(self):
         color_log.log_info(f"Attempting to connect to broker at {self._broker}:{self._port}")
         try:
             self._client.connect(self._broker, self._port, 60)
         except Exception as e:
-            color_log.log_error(f"Connection to broker failed: {e}")
+            color_log.log_error(f"Connection to broker failed: {e}, retrying in the background")
         self._client.loop_start()
+        self._restart_registration()
 
     def stop(self):
-        self._stop_event.set()
-        self._command_queue.put(None)
-        self._worker_thread.join()
-        self._registration_thread.join()
+        if self._registration is not None:
+            self._registration.cancel()
+        self._engine.stop()
+        if self._sampler is not None:
+            self._sampler.stop()
         self._client.loop_stop()
 
 
+class _StreamedRun:
+    def __init__(self, sut: SUT, command: str):
+        # Chunks and the final message of one streamed command; the payloads are kept for replays
+        self._sut = sut
+        self._command = command
+        self._run_id = f"{sut._client_id}-{os.getpid()}-{next(sut._run_ids)}"
+        self._payloads = []
+        # With output limits, chunks beyond them are published but not kept for replays
+        self._retain = sut._output_head_bytes + sut._output_tail_bytes if sut._limits_output() else None
+        self._marker = sut._sampler.begin() if sut._sampler is not None else None
+        self._start_unix = datetime.now().timestamp()
+        self.exit_code = None
+        self.chunks = 0
+        self.error = 'None'
+
+    def publish_chunk(self, channel, seq, data):
+        chunk = {
+            "type": FEEDBACK_CHUNK,
+            "run_id": self._run_id,
+            "client_id": self._sut._client_id,
+            "command": self._command,
+            "channel": channel,
+            "seq": seq,
+            "data": data
+        }
+        payload = self._sut._publish_feedback(chunk)
+        if self._retain is None or self._retain > 0:
+            self._payloads.append(payload)
+            if self._retain is not None:
+                self._retain -= len(data)
+
+    def finish(self, metadata, queue_wait, trace):
+        end_unix = datetime.now().timestamp()
+        final = {
+            "type": FEEDBACK_FINAL,
+            "run_id": self._run_id,
+            "client_id": self._sut._client_id,
+            "command": self._command,
+            "start_time": self._start_unix,
+            "end_time": end_unix,
+            "queue_wait": queue_wait,
+            "exit_code": self.exit_code,
+            "chunks": self.chunks,
+            "error": self.error,
+            **metadata
+        }
+        if self._marker is not None:
+            final["telemetry"] = self._sut._sampler.end(self._marker)
+        if trace is not None:
+            trace.update(process_start=self._start_unix, process_end=end_unix, feedback_publish=time.time())
+        self._payloads.append(self._sut._publish_feedback(final))
+        if 'command_id' in metadata:
+            self._sut._replay.complete(metadata['command_id'], self._payloads)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="System Under Test (SUT) for processing commands.")
     parser.add_argument('--config', type=str, default='config.ini', help='Path to the configuration file.')
@@ -167,11 +853,81 @@ if __name__ == '__main__':
     response_topic = config['mqtt']['response_topic']
     registration_topic = config['mqtt']['registration_topic']
     ack_topic = config['mqtt']['ack_topic']
+    command_routing = config.get('mqtt', 'command_routing', fallback=topics.ROUTING_PER_CLIENT)
     jsonify = config.getboolean('operator', 'jsonify')
     colorlog = config.getboolean('operator', 'colorlog')
+    color_log.configure(log_level=config.get('logging', 'level', fallback='info'),
+                        json_output=config.getboolean('logging', 'json', fallback=False),
+                        truncate=config.getint('logging', 'max_length', fallback=4096),
+                        queue_size=config.getint('logging', 'queue_size', fallback=10000))
+    max_workers = config.getint('sut', 'max_workers', fallback=4)
+    parallel_commands = [prefix.strip() for prefix in config.get('sut', 'parallel_commands', fallback='').split(',')
+                         if prefix.strip()]
+    command_limits = {}
+    for limit in config.get('sut', 'command_limits', fallback='').split(','):
+        if limit.strip():
+            name, count = limit.split(':')
+            command_limits[name.strip()] = int(count)
+    stream_output = config.getboolean('sut', 'stream_output', fallback=False)
+    stream_chunk_size = config.getint('sut', 'stream_chunk_size', fallback=4096)
+    stream_interval = config.getfloat('sut', 'stream_interval', fallback=1.0)
+    wire_format = config.get('sut', 'wire_format', fallback=None)
+    compress_threshold = config.getint('sut', 'compress_threshold', fallback=0)
+    telemetry = config.getboolean('sut', 'telemetry', fallback=False)
+    telemetry_interval = config.getfloat('sut', 'telemetry_interval', fallback=0.5)
+    telemetry_capacity = config.getint('sut', 'telemetry_capacity', fallback=4096)
+    telemetry_series = config.getboolean('sut', 'telemetry_series', fallback=False)
+    qos = config.getint('mqtt', 'qos', fallback=0)
+    delivery_receipts = config.getboolean('sut', 'delivery_receipts', fallback=False)
+    replay_capacity = config.getint('sut', 'replay_capacity', fallback=256)
+    executor = config.get('sut', 'executor', fallback=EXECUTOR_THREADS)
+    tags = {}
+    for tag in config.get('sut', 'tags', fallback='').split(','):
+        if tag.strip():
+            key, separator, value = tag.partition('=')
+            if not separator or not key.strip():
+                raise ValueError(f"Invalid tag '{tag.strip()}' in [sut] tags, expected key=value")
+            tags[key.strip()] = value.strip()
+    advertise_capabilities = config.getboolean('sut', 'advertise_capabilities', fallback=False)
+    output_head_bytes = config.getint('sut', 'output_head_bytes', fallback=0)
+    output_tail_bytes = config.getint('sut', 'output_tail_bytes', fallback=0)
+    output_spill_dir = config.get('sut', 'output_spill_dir', fallback='') or None
+    output_spill_keep = config.getint('sut', 'output_spill_keep', fallback=100)
+    compression = config.get('sut', 'compression', fallback=codec.COMPRESSION_ZLIB)
+    persistent_session = config.getboolean('sut', 'persistent_session', fallback=False)
+    reconnect_min = config.getfloat('sut', 'reconnect_min', fallback=1)
+    reconnect_max = config.getfloat('sut', 'reconnect_max', fallback=60)
     client_id = os.getenv('CLIENT_ID') or 'client1'  # Default to 'client1' if CLIENT_ID not set
-    sut = SUT(client_id, broker, port, command_topic, response_topic, registration_topic, ack_topic, jsonify, colorlog)
+    sut = SUT(client_id, broker, port, command_topic, response_topic, registration_topic, ack_topic, jsonify, colorlog,
+              command_routing=command_routing,
+              max_workers=max_workers,
+              parallel_commands=parallel_commands,
+              command_limits=command_limits,
+              stream_output=stream_output,
+              stream_chunk_size=stream_chunk_size,
+              stream_interval=stream_interval,
+              wire_format=wire_format,
+              compress_threshold=compress_threshold,
+              telemetry=telemetry,
+              telemetry_interval=telemetry_interval,
+              telemetry_capacity=telemetry_capacity,
+              telemetry_series=telemetry_series,
+              qos=qos,
+              delivery_receipts=delivery_receipts,
+              replay_capacity=replay_capacity,
+              executor=executor,
+              tags=tags,
+              advertise_capabilities=advertise_capabilities,
+              output_head_bytes=output_head_bytes,
+              output_tail_bytes=output_tail_bytes,
+              output_spill_dir=output_spill_dir,
+              output_spill_keep=output_spill_keep,
+              compression=compression,
+              persistent_session=persistent_session,
+              reconnect_min=reconnect_min,
+              reconnect_max=reconnect_max)
     try:
         sut.run()
+        Event().wait()  # The connection and the asyncio executor run on daemon threads
     except KeyboardInterrupt:
         sut.stop()
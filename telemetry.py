@@ -0,0 +1,213 @@
+import glob
+import itertools
+import math
+import os
+import platform
+import re
+import time
+from array import array
+from threading import Thread, Condition
+
+PROC_STAT = '/proc/stat'
+PROC_MEMINFO = '/proc/meminfo'
+CPUFREQ_GLOB = '/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq'
+THERMAL_GLOB = '/sys/class/thermal/thermal_zone*/temp'
+CPUFREQ_GOVERNORS = '/sys/devices/system/cpu/cpu0/cpufreq/scaling_available_governors'
+CPUFREQ_MAX = '/sys/devices/system/cpu/cpu0/cpufreq/cpuinfo_max_freq'
+
+# platform.machine() names the same architecture differently per OS, e.g. aarch64 on Linux and arm64 on macOS
+ARCH_ALIASES = {'aarch64': 'arm64', 'amd64': 'x86_64', 'x64': 'x86_64'}
+
+# Column order of the ring buffers and of the telemetry attached to feedback
+METRICS = ('cpu_util', 'freq_mhz', 'temp_c', 'mem_used_mb')
+
+# Parsed straight from the read buffers, which the patterns accept without a copy
+_NUMBER = re.compile(rb'\d+')
+_MEM_TOTAL = re.compile(rb'MemTotal:\s*(\d+)')
+_MEM_AVAILABLE = re.compile(rb'MemAvailable:\s*(\d+)')
+
+
+def system_tags() -> dict:
+    # Capabilities a client advertises at registration so commands can target e.g. arch=arm64,cores>=8
+    arch = platform.machine().lower()
+    tags = {"arch": ARCH_ALIASES.get(arch, arch), "cores": os.cpu_count() or 1}
+    try:
+        with open(CPUFREQ_GOVERNORS) as file:
+            tags["governors"] = file.read().split()
+        with open(CPUFREQ_MAX) as file:
+            tags["max_freq_mhz"] = int(file.read()) // 1000
+    except (OSError, ValueError):
+        pass
+    return tags
+
+
+class _Source:
+    # A sysfs/procfs file kept open and re-read from the start into a fixed buffer
+    def __init__(self, path: str, size: int = 64):
+        self._file = open(path, 'rb', buffering=0)
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    def read(self) -> memoryview:
+        # A view of the buffer, only valid until the next read
+        self._file.seek(0)
+        length = self._file.readinto(self._buffer)
+        return self._view[:length]
+
+    def close(self):
+        self._file.close()
+
+
+def _open_sources(paths, size=64) -> list:
+    sources = []
+    for path in paths:
+        try:
+            sources.append(_Source(path, size))
+        except OSError:
+            continue
+    return sources
+
+
+class TelemetrySampler:
+    def __init__(self, interval: float = 0.5, capacity: int = 4096, series: bool = False):
+        self._interval = interval
+        self._capacity = capacity
+        self._series = series
+        # One preallocated ring per metric plus the sample times, indexed by sample count modulo capacity
+        self._times = array('d', bytes(8 * capacity))
+        self._rings = [array('d', bytes(8 * capacity)) for _ in METRICS]
+        self._count = 0
+        self._next_sample = 0
+        self._condition = Condition()
+        self._active = 0
+        self._stopped = False
+        self._last_busy = None
+        self._last_total = None
+        self._stat = _open_sources([PROC_STAT], 256)
+        self._meminfo = _open_sources([PROC_MEMINFO], 512)
+        self._frequencies = _open_sources(sorted(glob.glob(CPUFREQ_GLOB)))
+        self._zones = _open_sources(sorted(glob.glob(THERMAL_GLOB)))
+        self._thread = Thread(target=self._run, name='telemetry-sampler', daemon=True)
+        self._thread.start()
+
+    def begin(self) -> int:
+        # Marks the start of a command; samples are only taken while at least one command runs
+        with self._condition:
+            self._active += 1
+            self._sample()
+            self._condition.notify_all()
+            return self._count - 1
+
+    def end(self, marker: int) -> dict:
+        with self._condition:
+            self._active -= 1
+            self._sample()
+            first = max(marker, self._count - self._capacity)
+            return self._describe(first, self._count, marker)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+        for source in self._stat + self._meminfo + self._frequencies + self._zones:
+            source.close()
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                if not self._active:
+                    # Drop the CPU baseline so the first sample after an idle period is not averaged over it
+                    self._last_total = None
+                    self._condition.wait()
+                    continue
+                # begin() and end() sample too, so the next periodic sample is due one interval after the latest
+                delay = self._next_sample - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                self._sample()
+
+    def _sample(self):
+        slot = self._count % self._capacity
+        self._times[slot] = time.time()
+        # A failed read, e.g. of a cpufreq file while its core goes offline, leaves that metric out of the sample
+        # instead of failing the command's feedback or stopping the sampler thread
+        try:
+            self._rings[0][slot] = self._cpu_util()
+        except (OSError, ValueError):
+            self._last_total = None
+            self._rings[0][slot] = math.nan
+        self._rings[1][slot] = self._mean(self._frequencies, 1000.0)
+        self._rings[2][slot] = self._max(self._zones, 1000.0)
+        try:
+            self._rings[3][slot] = self._mem_used()
+        except (OSError, ValueError):
+            self._rings[3][slot] = math.nan
+        self._count += 1
+        self._next_sample = time.monotonic() + self._interval
+
+    def _cpu_util(self) -> float:
+        if not self._stat:
+            return math.nan
+        # "cpu  user nice system idle iowait irq softirq steal ...", the first line holds ten counters
+        fields = [int(match.group()) for match in itertools.islice(_NUMBER.finditer(self._stat[0].read()), 8)]
+        if len(fields) < 8:
+            raise ValueError(f"Unexpected format of {PROC_STAT}")
+        total = sum(fields)
+        busy = total - fields[3] - fields[4]
+        last_busy, last_total = self._last_busy, self._last_total
+        self._last_busy, self._last_total = busy, total
+        if last_total is None or total == last_total:
+            return math.nan
+        return 100.0 * (busy - last_busy) / (total - last_total)
+
+    def _mem_used(self) -> float:
+        if not self._meminfo:
+            return math.nan
+        data = self._meminfo[0].read()
+        total = _MEM_TOTAL.search(data)
+        available = _MEM_AVAILABLE.search(data)
+        if total is None or available is None:
+            return math.nan
+        return (int(total.group(1)) - int(available.group(1))) / 1024.0
+
+    @staticmethod
+    def _mean(sources, scale) -> float:
+        values = _read_values(sources)
+        return sum(values) / len(values) / scale if values else math.nan
+
+    @staticmethod
+    def _max(sources, scale) -> float:
+        values = _read_values(sources)
+        return max(values) / scale if values else math.nan
+
+    def _describe(self, first, last, marker) -> dict:
+        slots = [index % self._capacity for index in range(first, last)]
+        telemetry = {"samples": len(slots), "interval": self._interval}
+        if first > marker:
+            telemetry["dropped_samples"] = first - marker
+        start = self._times[slots[0]]
+        series = {"time": [round(self._times[slot] - start, 3) for slot in slots]} if self._series else None
+        for name, ring in zip(METRICS, self._rings):
+            values = [ring[slot] for slot in slots if not math.isnan(ring[slot])]
+            if not values:
+                continue
+            telemetry[name] = {"min": round(min(values), 2), "mean": round(sum(values) / len(values), 2),
+                               "max": round(max(values), 2)}
+            if series is not None:
+                series[name] = [None if math.isnan(ring[slot]) else round(ring[slot], 2) for slot in slots]
+        if series is not None:
+            telemetry["series"] = series
+        return telemetry
+
+
+def _read_values(sources) -> list:
+    # Sources that fail to read are skipped, the others still count
+    values = []
+    for source in sources:
+        try:
+            values.append(int(source.read()))
+        except (OSError, ValueError):
+            continue
+    return values
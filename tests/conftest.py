@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+# Appended rather than prepended: the repository's operator.py must not shadow the standard library module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def operator_module():
+    from benchmark import load_operator_module
+    return load_operator_module()
+
+
+@pytest.fixture
+def broker():
+    from mini_broker import MiniBroker
+    broker = MiniBroker(port=0)
+    broker.start()
+    yield broker
+    broker.stop()
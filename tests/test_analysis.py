@@ -0,0 +1,82 @@
+import csv
+import json
+import pytest
+import analysis
+
+
+def _metrics_line(stressor, bogo_ops_s, prefix='info'):
+    return f"stress-ng: {prefix}:  [1234] {stressor}  123456  60.00  239.90  0.05  {bogo_ops_s}  {bogo_ops_s / 4}"
+
+
+def _run(client_id, start, *lines, duration=60):
+    return {"client_id": client_id, "command": "stress-ng --cpu 4 --metrics-brief -t 60", "start_time": str(start),
+            "end_time": str(start + duration), "output": "", "error": '\n'.join(lines)}
+
+
+def _frequency(client_id, start, frequency):
+    return {"client_id": client_id, "command": f"cpufreq-set -c 0 -f {frequency}", "start_time": str(start),
+            "end_time": str(start), "output": ""}
+
+
+def test_runs_take_the_last_frequency_set_on_their_client():
+    entries = [
+        _run('client1', 5, _metrics_line('cpu', 100.0)),
+        _frequency('client1', 10, 2000000),
+        _frequency('client2', 15, 1200000),
+        _run('client1', 20, _metrics_line('cpu', 200.0)),
+        _frequency('client1', 30, 2400000),
+        _run('client1', 30, _metrics_line('cpu', 300.0)),
+        _run('client2', 40, _metrics_line('cpu', 400.0)),
+    ]
+    metrics = analysis.extract_metrics(entries)
+    assert metrics["bogo_ops_s"].tolist() == [100.0, 200.0, 300.0, 400.0]
+    frequency = metrics["frequency"].tolist()
+    assert frequency[1:] == [2000000.0, 2400000.0, 1200000.0]
+    assert frequency[0] != frequency[0]
+
+
+def test_metrics_rows_accept_newer_stress_ng_output():
+    metrics = analysis.extract_metrics([_run('client1', 0, _metrics_line('cpu', 10.0),
+                                             _metrics_line('vm', 20.0, prefix='metrc') + '  1.5  2.5',
+                                             'stress-ng: info:  [1234] successful run completed')])
+    assert list(metrics["stressor_names"]) == ['cpu', 'vm']
+    assert metrics["bogo_ops_s_cpu"].tolist() == [2.5, 5.0]
+    assert metrics["duration"].tolist() == [60.0, 60.0]
+
+
+def test_summary_groups_by_frequency_client_and_stressor():
+    entries = [_frequency('client1', 0, 2000000), _frequency('client2', 0, 2000000)]
+    entries += [_run('client1', 10 + index, _metrics_line('cpu', value)) for index, value in enumerate((10.0, 20.0))]
+    entries.append(_run('client2', 20, _metrics_line('cpu', 60.0), duration=30))
+    rows = analysis.summarize(analysis.extract_metrics(entries))
+    assert [(row['client_id'], row['runs']) for row in rows] == [('client1', 2), ('client2', 1)]
+    assert rows[0]['frequency'] == 2000000
+    assert rows[0]['bogo_ops_s_mean'] == pytest.approx(15.0)
+    assert rows[0]['bogo_ops_s_var'] == pytest.approx(25.0)
+    totals = analysis.summarize(analysis.extract_metrics(entries), per_client=False)
+    assert len(totals) == 1 and totals[0]['client_id'] == analysis.ALL_CLIENTS
+    assert totals[0]['runs'] == 3 and totals[0]['bogo_ops_s_mean'] == pytest.approx(30.0)
+    assert totals[0]['duration_mean'] == pytest.approx(50.0)
+
+
+def test_unusable_entries_are_skipped():
+    assert analysis.summarize(analysis.extract_metrics([])) == []
+    metrics = analysis.extract_metrics([{"client_id": 'client1', "command": "stress-ng --cpu 1", "start_time": None},
+                                        _run('client1', 0, 'no metrics here'),
+                                        {"client_id": 'client1', "command": "echo", "start_time": "0",
+                                         "end_time": "1", "output": _metrics_line('cpu', 1.0)}])
+    assert len(metrics["bogo_ops_s"]) == 0
+
+
+def test_summary_round_trips_through_the_feedback_and_csv_files(tmp_path):
+    feedback_path = tmp_path / 'feedback.txt'
+    entries = [_frequency('client1', 0, 1800000), _run('client1', 5, _metrics_line('cpu', 42.0))]
+    lines = [json.dumps(entry) for entry in entries] + ['{"command": "stress-ng broken', json.dumps({"command": "ls"})]
+    feedback_path.write_text('\n'.join(lines) + '\n')
+    rows = analysis.summarize(analysis.extract_metrics(analysis.load_entries(str(feedback_path))))
+    csv_path = tmp_path / 'summary.csv'
+    analysis.write_csv(rows, str(csv_path))
+    with open(csv_path, newline='') as f:
+        written = list(csv.DictReader(f))
+    assert len(written) == 1
+    assert written[0]['frequency'] == '1800000' and float(written[0]['bogo_ops_s_mean']) == 42.0
@@ -0,0 +1,124 @@
+import asyncio
+import subprocess
+import threading
+import time
+import pytest
+from async_core import AsyncMQTTClient, EventLoopThread, MQTTClient, backoff_delays, run_shell
+
+
+@pytest.fixture
+def runner():
+    return EventLoopThread(name='test-loop')
+
+
+def _wait_for(messages, count, timeout=5):
+    deadline = time.time() + timeout
+    while len(messages) < count and time.time() < deadline:
+        time.sleep(0.01)
+    return messages
+
+
+def test_backoff_delays_grow_to_the_maximum_within_the_jitter():
+    delays = backoff_delays(1, 8)
+    assert [next(delays) for _ in range(6)] == [1, 2, 4, 8, 8, 8]
+    jittered = backoff_delays(4, 4, jitter=0.5)
+    assert all(2 <= next(jittered) <= 4 for _ in range(100))
+
+
+def test_event_loop_thread_runs_work_on_one_thread(runner):
+    async def thread_name():
+        return threading.current_thread().name
+
+    assert runner.run(thread_name()) == 'test-loop'
+    assert runner.submit(thread_name()).result(5) == 'test-loop'
+    called = threading.Event()
+    names = []
+    runner.call_soon(lambda: (names.append(threading.current_thread().name), called.set()))
+    assert called.wait(5) and names == ['test-loop']
+    assert not runner.in_loop()
+
+
+def test_blocking_run_on_its_own_loop_raises(runner):
+    async def nested():
+        return runner.in_loop(), runner.run(asyncio.sleep(0))
+
+    with pytest.raises(RuntimeError):
+        runner.run(nested())
+
+
+def test_call_soon_on_the_loop_runs_immediately(runner):
+    async def inline():
+        calls = []
+        runner.call_soon(calls.append, 1)
+        return calls
+
+    assert runner.run(inline()) == [1]
+
+
+def test_run_shell_captures_output_and_times_out(runner):
+    result = runner.run(run_shell('echo out; echo err >&2; exit 3'))
+    assert (result.returncode, result.stdout, result.stderr) == (3, 'out\n', 'err\n')
+    started = time.time()
+    with pytest.raises(subprocess.TimeoutExpired):
+        runner.run(run_shell('sleep 10', timeout=0.2))
+    assert time.time() - started < 5
+
+
+def test_mqtt_client_round_trip(broker, runner):
+    messages = []
+    client = MQTTClient(client_id='roundtrip', runner=runner)
+    client.on_message = lambda client, userdata, msg: messages.append((msg.topic, msg.payload))
+    client.on_connect = lambda client, userdata, flags, rc: messages.append(('connected', rc))
+    client.connect('127.0.0.1', broker.port)
+    assert client.wait_connected(5)
+    client.subscribe('test/#')
+    time.sleep(0.2)
+    client.publish('test/a', b'1')
+    client.publish('other', b'2')
+    client.publish('test/b', b'3')
+    _wait_for(messages, 3)
+    client.disconnect()
+    assert messages == [('connected', 0), ('test/a', b'1'), ('test/b', b'3')]
+
+
+def test_async_clients_share_one_loop(broker, runner):
+    received = []
+
+    async def exchange():
+        publisher = AsyncMQTTClient('publisher')
+        subscriber = AsyncMQTTClient('subscriber')
+        subscriber.on_message = lambda client, userdata, msg: received.append(msg.payload)
+        await publisher.connect('127.0.0.1', broker.port)
+        await subscriber.connect('127.0.0.1', broker.port)
+        assert await publisher.wait_connected(5) and await subscriber.wait_connected(5)
+        subscriber.subscribe('fleet')
+        await asyncio.sleep(0.2)
+        for index in range(10):
+            publisher.publish('fleet', str(index).encode())
+        for _ in range(500):
+            if len(received) == 10:
+                break
+            await asyncio.sleep(0.01)
+        await publisher.disconnect()
+        await subscriber.disconnect()
+
+    runner.run(exchange(), timeout=10)
+    assert received == [str(index).encode() for index in range(10)]
+
+
+def test_publishes_from_other_threads_keep_their_order(broker, runner):
+    received = []
+    subscriber = MQTTClient(client_id='ordered-sub', runner=runner)
+    subscriber.on_message = lambda client, userdata, msg: received.append(int(msg.payload))
+    publisher = MQTTClient(client_id='ordered-pub', runner=runner)
+    subscriber.connect('127.0.0.1', broker.port)
+    publisher.connect('127.0.0.1', broker.port)
+    assert subscriber.wait_connected(5) and publisher.wait_connected(5)
+    subscriber.subscribe('ordered')
+    time.sleep(0.2)
+    for index in range(200):
+        publisher.publish('ordered', str(index).encode())
+    _wait_for(received, 200)
+    publisher.disconnect()
+    subscriber.disconnect()
+    assert received == list(range(200))
@@ -0,0 +1,92 @@
+import json
+import time
+import pytest
+import color_log
+import topics
+from async_core import MQTTClient
+from sut import SUT
+
+CLIENTS = ('rack1-a', 'rack1-b', 'rack2-a')
+
+
+class CountingSUT(SUT):
+    def __init__(self, *args, **kwargs):
+        self.runs = []
+        super().__init__(*args, **kwargs)
+
+    def _run_process(self, command):
+        self.runs.append(command)
+        return super()._run_process(command)
+
+
+@pytest.fixture
+def fleet(operator_module, broker):
+    color_log.configure(log_level='error')
+    operator = operator_module.Operator('127.0.0.1', broker.port, 't/commands', 't/responses', 't/registration',
+                                        't/ack', 't/loader', 1, {}, False, False, True, False, False,
+                                        'feedback.txt', False, qos=1, groups={'rack2': ['rack2-*']})
+    operator._start()
+    # Receipts make a client register with JSON and announce its features, batch among them
+    suts = {client_id: CountingSUT(client_id, '127.0.0.1', broker.port, 't/commands', 't/responses',
+                                   't/registration', 't/ack', True, False, qos=1, delivery_receipts=True)
+            for client_id in CLIENTS}
+    # Registers with its bare client ID, like clients that predate batching
+    suts['legacy'] = CountingSUT('legacy', '127.0.0.1', broker.port, 't/commands', 't/responses',
+                                 't/registration', 't/ack', False, False, qos=1)
+    published = []
+    observer = MQTTClient(client_id='observer')
+    observer.on_message = lambda client, userdata, msg: published.append((msg.topic, msg.payload))
+    observer.connect('127.0.0.1', broker.port)
+    assert observer.wait_connected(5)
+    observer.subscribe('t/commands/#', qos=1)
+    try:
+        for sut in suts.values():
+            sut.run()
+        assert sorted(operator._registry.wait_for_clients(0.5, len(suts), 10)) == sorted(suts)
+        yield operator, suts, published
+    finally:
+        observer.disconnect()
+        for sut in suts.values():
+            sut.stop()
+        operator._stop()
+
+
+def _wait_for_runs(suts, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while sum(len(sut.runs) for sut in suts.values()) < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+    # Long enough for a stray copy to arrive as well
+    time.sleep(0.5)
+
+
+def test_batch_clients_share_one_publish(fleet):
+    operator, suts, published = fleet
+    assert operator._registry.info('rack1-a')['batch'] and not operator._registry.info('legacy')['batch']
+    operator.send_command_to_clients(['rack1-*', 'legacy'], 'echo batched')
+    _wait_for_runs(suts, 3)
+    assert {client_id: sut.runs for client_id, sut in suts.items()} == {
+        'rack1-a': ['echo batched'], 'rack1-b': ['echo batched'], 'rack2-a': [], 'legacy': ['echo batched']}
+    batches = [payload for topic, payload in published if topic == topics.batch_command_topic('t/commands')]
+    assert len(batches) == 1
+    assert json.loads(batches[0])['targets'] == ['rack1-a', 'rack1-b']
+    # The legacy client gets a copy of its own, without targets
+    copies = [json.loads(payload) for topic, payload in published if topic == 't/commands/legacy']
+    assert len(copies) == 1 and copies[0]['client_id'] == 'legacy' and 'targets' not in copies[0]
+    assert not [topic for topic, payload in published if topic.startswith('t/commands/rack')]
+
+
+def test_groups_select_their_members(fleet):
+    operator, suts, published = fleet
+    operator.send_command_to_clients(['group:rack2'], 'echo group')
+    _wait_for_runs(suts, 1)
+    assert [client_id for client_id, sut in suts.items() if sut.runs] == ['rack2-a']
+    with pytest.raises(ValueError):
+        operator.send_command_to_clients(['group:missing'], 'echo nobody')
+
+
+def test_batch_deliveries_are_tracked_per_client(fleet):
+    operator, suts, published = fleet
+    operator.send_command_to_clients(CLIENTS, 'echo receipts')
+    _wait_for_runs(suts, 3)
+    stats = operator._tracker.stats()
+    assert stats['completed'] == 3 and stats['retried'] == 0
@@ -0,0 +1,78 @@
+import time
+from threading import Thread
+import pytest
+from client_registry import ClientRegistry, parse_group
+
+
+@pytest.fixture
+def registry():
+    registry = ClientRegistry()
+    registry.register('pi-1', {"tags": {"arch": "arm64", "cores": 4}})
+    registry.register('jetson1', {"tags": {"arch": "arm64", "cores": 8}})
+    registry.register('x86-7', {"tags": {"arch": "x86_64", "cores": 16}})
+    return registry
+
+
+def test_group_selector_keeps_its_conditions_together(registry):
+    groups = {"big_arm": parse_group('arch=arm64,cores>=8')}
+    assert registry.select(['group:big_arm'], groups) == ['jetson1']
+
+
+def test_group_mixes_selectors_and_patterns(registry):
+    groups = {"mixed": parse_group('cores>=16; pi-*, jetson1')}
+    assert sorted(registry.select(['group:mixed'], groups)) == ['jetson1', 'pi-1', 'x86-7']
+
+
+def test_group_of_patterns_is_comma_separated():
+    assert parse_group('pi-*, jetson1') == ['pi-*', 'jetson1']
+
+
+def test_group_rejects_pattern_inside_selector():
+    with pytest.raises(ValueError, match="';'"):
+        parse_group('pi-*, cores>=8')
+
+
+def _register_later(registry, delays):
+    def run():
+        for index, delay in enumerate(delays):
+            time.sleep(delay)
+            registry.register(f'late{index}')
+    thread = Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_wait_returns_after_the_quiet_period():
+    registry = ClientRegistry()
+    thread = _register_later(registry, [0.05, 0.05, 0.05])
+    start = time.monotonic()
+    clients = registry.wait_for_clients(0.3)
+    thread.join()
+    assert clients == ['late0', 'late1', 'late2']
+    assert time.monotonic() - start >= 0.45
+
+
+def test_wait_holds_out_for_min_clients():
+    registry = ClientRegistry()
+    thread = _register_later(registry, [0.05, 0.3])
+    clients = registry.wait_for_clients(0.1, min_clients=2)
+    thread.join()
+    assert clients == ['late0', 'late1']
+
+
+def test_wait_gives_up_at_the_deadline():
+    registry = ClientRegistry()
+    registry.register('client1')
+    start = time.monotonic()
+    assert registry.wait_for_clients(0.1, min_clients=5, deadline=0.3) == ['client1']
+    assert 0.3 <= time.monotonic() - start < 1
+
+
+def test_registration_listeners_see_new_clients_only():
+    registry = ClientRegistry()
+    seen = []
+    registry.add_listener(seen.append)
+    assert registry.register('client1')
+    assert not registry.register('client1', {"tags": {"cores": 4}})
+    assert seen == ['client1']
+    assert registry.select(['cores>=4']) == ['client1']
@@ -0,0 +1,107 @@
+import pytest
+import codec
+
+FEEDBACK = {"client_id": "client1", "command": "stress-ng --cpu 0", "start_time": 1700000000.25,
+            "end_time": 1700000060.5, "queue_wait": 0.001, "output": "x" * 5000, "error": "None",
+            "pipeline": "pipeline1", "step": 2, "command_id": "ab" * 16, "stream": False,
+            "telemetry": {"samples": 3, "cpu_util": {"min": 1.5, "max": 99.0}}, "unknown_key": [1, None, b"\x00"]}
+
+
+@pytest.mark.parametrize('compress_threshold', [0, 1])
+def test_binary_round_trip(compress_threshold):
+    payload = codec.encode_feedback(codec.FORMAT_BINARY, FEEDBACK, compress_threshold)
+    assert codec.detect_format(payload) == codec.FORMAT_BINARY
+    assert codec.decode_feedback(payload) == FEEDBACK
+
+
+def test_compressed_frame_is_smaller():
+    plain = codec.encode_feedback(codec.FORMAT_BINARY, FEEDBACK)
+    compressed = codec.encode_feedback(codec.FORMAT_BINARY, FEEDBACK, compress_threshold=1)
+    assert len(compressed) < len(plain)
+
+
+def test_json_round_trip_keeps_timestamps_as_strings():
+    message = {key: value for key, value in FEEDBACK.items() if key != 'unknown_key'}
+    feedback = codec.decode_feedback(codec.encode_feedback(codec.FORMAT_JSON, message).encode())
+    assert feedback['start_time'] == '1700000000.25'
+    assert feedback['output'] == FEEDBACK['output']
+
+
+def test_command_round_trip():
+    message = {"client_id": "client1", "command": "echo hi", "command_id": "cd" * 16, "lane": "parallel"}
+    for wire_format in (codec.FORMAT_BINARY, codec.FORMAT_JSON):
+        assert codec.decode_command(codec.encode_command(wire_format, message)) == message
+
+
+def test_text_format_carries_command_id():
+    payload = codec.encode_command(codec.FORMAT_TEXT, {"client_id": "client1", "command": "echo hi",
+                                                       "command_id": "cd" * 16})
+    assert payload == f"client1|echo hi #command_id={'cd' * 16}"
+    assert codec.decode_command(payload) == {"client_id": "client1", "command": "echo hi", "command_id": "cd" * 16}
+    feedback = codec.decode_feedback(codec.encode_feedback(codec.FORMAT_TEXT, {
+        "client_id": "client1", "command": "echo hi", "command_id": "cd" * 16, "output": "hi"}).encode())
+    assert feedback['command'] == 'echo hi'
+    assert feedback['command_id'] == 'cd' * 16
+
+
+def test_text_command_without_tag():
+    assert codec.decode_command('client1|echo a # comment') == {"client_id": "client1", "command": "echo a # comment"}
+
+
+@pytest.mark.parametrize('value', [2 ** 63, -2 ** 63 - 1, 10 ** 30])
+def test_out_of_range_int_is_sent_as_digits(value):
+    assert codec.decode_binary(codec.encode_binary({"output": value})) == {"output": str(value)}
+
+
+def test_int64_limits_stay_ints():
+    message = {"seq": 2 ** 63 - 1, "step": -2 ** 63}
+    assert codec.decode_binary(codec.encode_binary(message)) == message
+
+
+def test_truncated_frames_raise_codec_error():
+    payload = codec.encode_feedback(codec.FORMAT_BINARY, FEEDBACK)
+    for end in range(codec.FRAME_HEADER.size + 1, len(payload), 97):
+        with pytest.raises(codec.CodecError):
+            codec.decode_feedback(payload[:end])
+
+
+def test_string_longer_than_frame_raises_codec_error():
+    payload = bytearray(codec.encode_binary({"output": "abcdef"}))
+    # Key count, key id and type byte precede the length of the string
+    length_at = codec.FRAME_HEADER.size + 1 + 4 + 1 + 1
+    payload[length_at:length_at + 4] = (1000).to_bytes(4, 'little')
+    with pytest.raises(codec.CodecError, match='truncated'):
+        codec.decode_feedback(bytes(payload))
+
+
+def test_unknown_value_type_raises_codec_error():
+    payload = codec.encode_binary({"output": None})
+    with pytest.raises(codec.CodecError):
+        codec.decode_feedback(payload[:-1] + b'\x7f')
+
+
+@pytest.mark.parametrize('message', [{"command": "echo hi"}, {"client_id": "client1"}, {"client_id": 7, "command": "x"},
+                                     {"client_id": ["a", 1], "command": "x"}, {"client_id": "a", "command": ["x"]}])
+@pytest.mark.parametrize('wire_format', [codec.FORMAT_BINARY, codec.FORMAT_JSON])
+def test_malformed_command_raises_codec_error(message, wire_format):
+    with pytest.raises(codec.CodecError):
+        codec.decode_command(codec.encode_command(wire_format, message))
+
+
+@pytest.mark.parametrize('feedback', [
+    {"output": "no client"},
+    {"client_id": 7},
+    {"client_id": "client1", "type": "chunk", "seq": 0, "channel": "stdout", "data": "x"},
+    {"client_id": "client1", "type": "received"},
+    {"client_id": "client1", "type": "final", "run_id": 5},
+])
+@pytest.mark.parametrize('wire_format', [codec.FORMAT_BINARY, codec.FORMAT_JSON])
+def test_malformed_feedback_raises_codec_error(feedback, wire_format):
+    payload = codec.encode_feedback(wire_format, feedback)
+    with pytest.raises(codec.CodecError):
+        codec.decode_feedback(payload if isinstance(payload, bytes) else payload.encode())
+
+
+def test_text_feedback_without_client_raises_codec_error():
+    with pytest.raises(codec.CodecError):
+        codec.decode_feedback(b'Output: something\nError: None')
@@ -0,0 +1,51 @@
+import io
+import re
+from threading import Thread
+import color_log
+
+
+class _LevelCount:
+    def __init__(self):
+        self.calls = 0
+
+    def __str__(self):
+        self.calls += 1
+        return 'formatted'
+
+
+def test_every_record_is_written_or_counted_as_dropped():
+    output = io.StringIO()
+    color_log.configure(log_level='info', color=False, json_output=False, queue_size=8, output=output)
+    try:
+        def log():
+            for i in range(2000):
+                color_log.log_info("record %d", i)
+        threads = [Thread(target=log) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        color_log.flush()
+        # A last record makes the writer report drops counted after its previous batch
+        color_log.log_info("done")
+        color_log.flush()
+        text = output.getvalue()
+        written = len(re.findall(r'^record \d+$', text, re.MULTILINE))
+        dropped = sum(int(count) for count in re.findall(r'^(\d+) log messages dropped', text, re.MULTILINE))
+        assert written + dropped == 8 * 2000
+    finally:
+        color_log.configure(log_level='info', queue_size=10000, output=None)
+
+
+def test_filtered_records_are_not_formatted():
+    output = io.StringIO()
+    color_log.configure(log_level='warning', output=output)
+    try:
+        value = _LevelCount()
+        color_log.log_info("feedback %s", value)
+        color_log.log_warning("warning %s", value)
+        color_log.flush()
+        assert value.calls == 1
+        assert 'feedback' not in output.getvalue()
+    finally:
+        color_log.configure(log_level='info', output=None)
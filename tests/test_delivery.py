@@ -0,0 +1,144 @@
+import time
+from types import SimpleNamespace
+import color_log
+import codec
+from delivery import InFlightTracker
+from sut import SUT
+
+
+class CountingSUT(SUT):
+    def __init__(self, *args, **kwargs):
+        self.runs = []
+        super().__init__(*args, **kwargs)
+
+    def _run_process(self, command):
+        self.runs.append(command)
+        return super()._run_process(command)
+
+
+def _start(operator_module, broker, jsonify, wire_format=None):
+    color_log.configure(log_level='error')
+    operator = operator_module.Operator('127.0.0.1', broker.port, 't/commands', 't/responses', 't/registration',
+                                        't/ack', 't/loader', 1, {}, False, False, jsonify, False, False,
+                                        'feedback.txt', False, qos=1, command_retry_interval=0.5,
+                                        command_max_retries=3)
+    operator._start()
+    sut = CountingSUT('client1', '127.0.0.1', broker.port, 't/commands', 't/responses', 't/registration', 't/ack',
+                      jsonify, False, qos=1, delivery_receipts=True, wire_format=wire_format)
+    sut.run()
+    assert operator._registry.wait_for_clients(0.5, 1, 10) == ['client1']
+    return operator, sut
+
+
+def _wait_for_runs(sut, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while len(sut.runs) < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def test_text_client_announcing_receipts_runs_command_once(operator_module, broker):
+    operator, sut = _start(operator_module, broker, jsonify=False)
+    try:
+        assert operator._registry.info('client1') == {"format": codec.FORMAT_TEXT, "receipts": False,
+                                                      "batch": True}
+        operator.send_command_to_client('client1', 'echo once')
+        _wait_for_runs(sut, 1)
+        # Several retry intervals, a tracked command would have been sent again by now
+        time.sleep(2)
+        assert sut.runs == ['echo once']
+        assert operator._tracker.stats()['retried'] == 0
+    finally:
+        sut.stop()
+        operator._stop()
+
+
+def test_json_client_confirms_receipt(operator_module, broker):
+    operator, sut = _start(operator_module, broker, jsonify=True)
+    try:
+        assert operator._registry.info('client1')['receipts']
+        operator.send_command_to_client('client1', 'echo once')
+        _wait_for_runs(sut, 1)
+        time.sleep(1.5)
+        assert sut.runs == ['echo once']
+        stats = operator._tracker.stats()
+        assert stats['retried'] == 0 and stats['completed'] == 1
+    finally:
+        sut.stop()
+        operator._stop()
+
+
+class DroppingSUT(CountingSUT):
+    # Loses the first command it is sent, as if the delivery had failed
+    def __init__(self, *args, **kwargs):
+        self.dropped = False
+        super().__init__(*args, **kwargs)
+
+    def on_message(self, client, userdata, msg):
+        if msg.topic.startswith('t/commands') and not self.dropped:
+            self.dropped = True
+            return
+        super().on_message(client, userdata, msg)
+
+
+def test_broadcast_retry_reaches_per_client_sut_with_both_routings(operator_module, broker):
+    color_log.configure(log_level='error')
+    operator = operator_module.Operator('127.0.0.1', broker.port, 't/commands', 't/responses', 't/registration',
+                                        't/ack', 't/loader', 1, {}, False, False, True, False, False,
+                                        'feedback.txt', False, qos=1, command_retry_interval=0.5,
+                                        command_max_retries=3, command_routing='both')
+    operator._start()
+    sut = DroppingSUT('client1', '127.0.0.1', broker.port, 't/commands', 't/responses', 't/registration', 't/ack',
+                      True, False, qos=1, delivery_receipts=True)
+    sut.run()
+    try:
+        assert operator._registry.wait_for_clients(0.5, 1, 10) == ['client1']
+        operator.send_command_to_all_clients('echo once')
+        _wait_for_runs(sut, 1)
+        time.sleep(0.5)
+        assert sut.runs == ['echo once']
+        stats = operator._tracker.stats()
+        assert stats['sent'] == 1 and stats['completed'] == 1
+    finally:
+        sut.stop()
+        operator._stop()
+
+
+def test_broadcast_is_retried_only_to_unconfirmed_clients():
+    published = []
+    tracker = InFlightTracker(lambda topic, payload: published.append(topic), retry_interval=0.1, max_retries=1)
+    tracker.track('cmd', ['a', 'b', 'c'], [('commands/all', b'x')],
+                  lambda client_id: [(f'commands/{client_id}', b'x')])
+    tracker.acknowledge('cmd', 'a')
+    tracker.acknowledge('cmd', 'b')
+    tracker.start()
+    try:
+        time.sleep(0.5)
+    finally:
+        tracker.stop()
+    assert published == ['commands/c']
+
+
+def test_confirmed_command_without_feedback_is_lost():
+    tracker = InFlightTracker(lambda topic, payload: None, retry_interval=0.1, completion_timeout=0.2)
+    tracker.track('cmd', ['a'], [('commands/a', b'x')])
+    tracker.acknowledge('cmd', 'a')
+    tracker.start()
+    try:
+        time.sleep(0.5)
+        stats = tracker.stats()
+        assert stats['lost'] == 1 and stats['in_flight'] == 0
+        # Feedback arriving after all is still recognised
+        assert tracker.complete('cmd', 'a') is not None
+    finally:
+        tracker.stop()
+
+
+def test_sut_drops_binary_command_without_client_id():
+    sut = CountingSUT('client1', '127.0.0.1', 1, 't/commands', 't/responses', 't/registration', 't/ack', True, False)
+    try:
+        sut.on_message(None, None, SimpleNamespace(topic='t/commands/client1',
+                                                   payload=codec.encode_binary({"command": "echo hi"})))
+        time.sleep(0.2)
+        assert sut.runs == []
+    finally:
+        sut.stop()
@@ -0,0 +1,70 @@
+import json
+import os
+from feedback_store import FeedbackStore
+
+
+def _entry(client_id, command, start, pipeline=None):
+    entry = {"client_id": client_id, "command": command, "start_time": str(start), "end_time": str(start + 2),
+             "output": "x"}
+    if pipeline is not None:
+        entry["pipeline"] = pipeline
+    return json.dumps(entry) + '\n'
+
+
+def _write(path, lines, mode='a'):
+    with open(path, mode) as file:
+        file.write(''.join(lines))
+
+
+def test_queries_by_client_command_pipeline_and_time(tmp_path):
+    path = str(tmp_path / 'feedback.txt')
+    _write(path, [_entry('client1', 'echo a', 100, 'p1'), _entry('client2', 'echo a', 110),
+                  _entry('client1', 'stress-ng --cpu 0', 120, 'p1'), 'not json\n'])
+    store = FeedbackStore(path)
+    assert store.update() == 3
+    assert [entry['start_time'] for entry in store.query(client_id='client1')] == ['100', '120']
+    assert [entry['client_id'] for entry in store.query(command='echo a')] == ['client1', 'client2']
+    assert len(list(store.query(command_contains='stress'))) == 1
+    assert len(list(store.query(pipeline='p1', since=110))) == 1
+    assert len(list(store.query(client_id='nobody'))) == 0
+    assert store.numeric(client_id='client2')['duration'].tolist() == [2.0]
+    store.close()
+
+
+def test_update_indexes_only_appended_and_complete_lines(tmp_path):
+    path = str(tmp_path / 'feedback.txt')
+    _write(path, [_entry('client1', 'echo a', 100)])
+    store = FeedbackStore(path)
+    assert store.update() == 1
+    partial = _entry('client1', 'echo b', 110)
+    _write(path, [_entry('client2', 'echo a', 105), partial[:20]])
+    assert store.update() == 1
+    _write(path, [partial[20:]])
+    assert store.update() == 1
+    assert len(store) == 3
+    store.close()
+
+
+def test_index_is_reused_by_a_new_store(tmp_path):
+    path = str(tmp_path / 'feedback.txt')
+    _write(path, [_entry('client1', 'echo a', 100), _entry('client2', 'echo b', 110)])
+    store = FeedbackStore(path)
+    store.update()
+    store.close()
+    assert os.path.exists(path + '.idx')
+    reopened = FeedbackStore(path)
+    assert reopened.update() == 0
+    assert len(reopened) == 2 and reopened.clients() == ['client1', 'client2']
+    reopened.close()
+
+
+def test_rotated_file_larger_than_the_index_is_reindexed(tmp_path):
+    path = str(tmp_path / 'feedback.txt')
+    _write(path, [_entry('client1', 'echo a', 100)])
+    store = FeedbackStore(path)
+    store.update()
+    os.replace(path, path + '.1')
+    _write(path, [_entry('client9', 'echo z', 200 + index) for index in range(3)], mode='w')
+    assert store.update() == 3
+    assert store.clients() == ['client9']
+    store.close()
@@ -0,0 +1,54 @@
+import time
+import pytest
+from feedback_writer import FeedbackWriter
+
+
+def test_lines_are_written_in_order(tmp_path):
+    path = tmp_path / 'feedback.txt'
+    writer = FeedbackWriter(str(path), flush_size=3)
+    writer.start()
+    for index in range(10):
+        writer.write(f"line {index}")
+    writer.close()
+    assert path.read_text().splitlines() == [f"line {index}" for index in range(10)]
+    assert writer.stats()['written'] == 10
+
+
+def test_batch_is_flushed_after_the_interval(tmp_path):
+    path = tmp_path / 'feedback.txt'
+    writer = FeedbackWriter(str(path), flush_interval=0.1)
+    writer.start()
+    try:
+        writer.write('first\n')
+        time.sleep(0.5)
+        assert path.read_text() == 'first\n'
+    finally:
+        writer.close()
+
+
+def test_full_queue_drops_and_counts(tmp_path):
+    writer = FeedbackWriter(str(tmp_path / 'feedback.txt'), queue_size=2)
+    # Not started, so nothing drains the queue
+    assert writer.write('a') and writer.write('b')
+    assert not writer.write('c')
+    assert writer.stats()['dropped'] == 1
+
+
+def test_rotation_keeps_the_configured_backups(tmp_path):
+    path = tmp_path / 'feedback.txt'
+    writer = FeedbackWriter(str(path), flush_size=1, max_bytes=10, backups=2)
+    writer.start()
+    for index in range(5):
+        writer.write(f"line {index:04}")
+        time.sleep(0.05)
+    writer.close()
+    assert sorted(file.name for file in tmp_path.iterdir()) == ['feedback.txt', 'feedback.txt.1', 'feedback.txt.2']
+    assert path.read_text() == 'line 0004\n'
+    assert (tmp_path / 'feedback.txt.1').read_text() == 'line 0003\n'
+    assert writer.stats()['rotations'] == 4
+
+
+@pytest.mark.parametrize('option', [{"fsync_policy": "always"}, {"overflow": "wait"}])
+def test_unknown_policy_raises(tmp_path, option):
+    with pytest.raises(ValueError):
+        FeedbackWriter(str(tmp_path / 'feedback.txt'), **option)
@@ -0,0 +1,19 @@
+from metrics import LatencyMetrics
+
+
+def test_take_hands_over_and_merge_sums():
+    shard, coordinator = LatencyMetrics(), LatencyMetrics()
+    for seconds in (0.001, 0.002, 0.5):
+        shard.observe('total', 'client1', seconds)
+    coordinator.observe('total', 'client1', 0.003)
+    coordinator.merge(shard.take())
+    assert coordinator.stage_summary()['total']['count'] == 4
+    assert shard.stage_summary() == {}
+
+
+def test_add_stats_replaces_prefix():
+    metrics = LatencyMetrics()
+    metrics.add_stats('governor_delivery', lambda: {"sent": 1})
+    metrics.add_stats('governor_delivery', lambda: {"sent": 5})
+    assert [line for line in metrics.render().splitlines() if 'sent' in line] == [
+        '# TYPE governor_delivery_sent gauge', 'governor_delivery_sent 5']
@@ -0,0 +1,48 @@
+import asyncio
+import os
+import pytest
+from sut import SUT
+
+# 5 MB on each stream, far beyond the pipe buffers, so a reader that stops draining blocks the command
+COMMAND = "head -c 5000000 /dev/zero; head -c 5000000 /dev/zero >&2"
+
+
+@pytest.fixture
+def make_sut():
+    suts = []
+
+    def make(**kwargs):
+        sut = SUT('client1', '127.0.0.1', 1, 't/commands', 't/responses', 't/registration', 't/ack', True, False,
+                  output_head_bytes=1024, output_tail_bytes=1024, **kwargs)
+        suts.append(sut)
+        return sut
+    yield make
+    for sut in suts:
+        sut.stop()
+
+
+def _check_unwritable(result):
+    assert result.returncode == 0
+    for name in ('stdout', 'stderr'):
+        assert result.spills[name]['bytes'] == 5000000
+        assert 'path' not in result.spills[name]
+        assert result.spills[name]['error']
+
+
+def test_unwritable_spill_dir_keeps_draining(make_sut):
+    sut = make_sut(output_spill_dir='/proc/no_such_dir')
+    _check_unwritable(sut._run_process(COMMAND))
+
+
+def test_unwritable_spill_dir_keeps_draining_async(make_sut):
+    sut = make_sut(output_spill_dir='/proc/no_such_dir')
+    _check_unwritable(asyncio.run(asyncio.wait_for(sut._run_process_async(COMMAND), 30)))
+
+
+def test_oldest_spills_are_removed(make_sut, tmp_path):
+    sut = make_sut(output_spill_dir=str(tmp_path), output_spill_keep=3)
+    for _ in range(3):
+        result = sut._run_process(COMMAND)
+    kept = os.listdir(tmp_path)
+    assert len(kept) == 3
+    assert {os.path.basename(spill['path']) for spill in result.spills.values()} <= set(kept)
@@ -0,0 +1,61 @@
+import time
+import pipeline_journal
+from pipeline_journal import PipelineJournal
+
+STEPS = [["pipeline1", 1, "echo a"], ["pipeline1", 2, "echo b"]]
+COMMAND_ID = "ab" * 16
+
+
+def test_dispatched_record_is_on_disk_before_returning(tmp_path):
+    path = str(tmp_path / 'journal.bin')
+    journal = PipelineJournal(path, fsync_interval=0)
+    journal.open(STEPS)
+    journal.dispatched('client1', 0, COMMAND_ID)
+    # Read back while the journal is still open, as after a crash right after the publish
+    reader = PipelineJournal(path)
+    clients = reader.open(STEPS, resume=True)
+    reader.close()
+    journal.close()
+    assert clients['client1'].in_flight == 0
+    assert clients['client1'].command_id == COMMAND_ID
+
+
+def test_new_journal_keeps_the_previous_one(tmp_path):
+    path = str(tmp_path / 'journal.bin')
+    journal = PipelineJournal(path, fsync_interval=0)
+    journal.open(STEPS)
+    journal.completed('client1', 0, COMMAND_ID)
+    journal.close()
+    journal = PipelineJournal(path)
+    journal.open(STEPS)
+    journal.close()
+    previous = PipelineJournal(path + '.prev')
+    assert previous.open(STEPS, resume=True)['client1'].done == 0
+    previous.close()
+    assert (tmp_path / 'journal.bin').stat().st_size < (tmp_path / 'journal.bin.prev').stat().st_size
+
+
+def test_failed_write_is_retried_before_dispatch_returns(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline_journal, 'RETRY_DELAY', 0.3)
+    path = str(tmp_path / 'journal.bin')
+    journal = PipelineJournal(path, fsync_interval=0)
+    journal.open(STEPS)
+    write_all = journal._write_all
+    failures = []
+
+    def fail_halfway_once(data):
+        if not failures:
+            failures.append(data)
+            write_all(data[:len(data) // 2])
+            raise OSError(28, 'No space left on device')
+        write_all(data)
+
+    journal._write_all = fail_halfway_once
+    start = time.monotonic()
+    journal.dispatched('client1', 0, COMMAND_ID)
+    assert time.monotonic() - start >= 0.3
+    journal.close()
+    reader = PipelineJournal(path)
+    assert reader.open(STEPS, resume=True)['client1'].command_id == COMMAND_ID
+    reader.close()
+    assert journal.stats()['records'] == 1
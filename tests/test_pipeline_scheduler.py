@@ -0,0 +1,96 @@
+import time
+from threading import Thread
+import pytest
+import color_log
+from pipeline_journal import PipelineJournal
+from pipeline_scheduler import PipelineScheduler
+
+PIPELINES = {"pipeline1": "echo a; echo b", "pipeline2": "echo c"}
+
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    color_log.configure(log_level='error')
+
+
+class Recorder:
+    def __init__(self):
+        self.sent = []
+
+    def __call__(self, client_id, command, metadata, command_id):
+        self.sent.append((client_id, command, metadata, command_id))
+
+    def last(self, client_id):
+        return [sent for sent in self.sent if sent[0] == client_id][-1]
+
+
+def _complete(scheduler, recorder, client_id):
+    _, command, metadata, command_id = recorder.last(client_id)
+    scheduler.on_feedback(client_id, command, metadata['pipeline'], metadata['step'], command_id)
+
+
+def test_clients_walk_every_step_in_order():
+    recorder = Recorder()
+    scheduler = PipelineScheduler(PIPELINES, recorder, step_timeout=10)
+    runner = Thread(target=scheduler.run, args=(['client1', 'client2'],))
+    runner.start()
+    for _ in range(3):
+        time.sleep(0.05)
+        for client_id in ('client1', 'client2'):
+            _complete(scheduler, recorder, client_id)
+    runner.join(5)
+    assert not runner.is_alive()
+    assert [command for client_id, command, _, _ in recorder.sent if client_id == 'client1'] == \
+        ['echo a', 'echo b', 'echo c']
+    assert recorder.last('client2')[2] == {"pipeline": "pipeline2", "step": 0}
+
+
+def test_stale_feedback_does_not_advance():
+    recorder = Recorder()
+    scheduler = PipelineScheduler(PIPELINES, recorder, step_timeout=10)
+    scheduler.add_client('client1')
+    first = recorder.last('client1')
+    _complete(scheduler, recorder, 'client1')
+    # The first step's feedback replayed after a retry carries its old command_id
+    scheduler.on_feedback('client1', first[1], first[2]['pipeline'], first[2]['step'], first[3])
+    scheduler.on_feedback('client1', 'echo b', command_id='0' * 32)
+    assert [sent[1] for sent in recorder.sent] == ['echo a', 'echo b']
+
+
+def test_text_feedback_is_matched_on_the_command():
+    recorder = Recorder()
+    scheduler = PipelineScheduler(PIPELINES, recorder, step_timeout=10)
+    scheduler.add_client('client1')
+    scheduler.on_feedback('client1', 'echo b')
+    scheduler.on_feedback('client1', 'echo a')
+    assert [sent[1] for sent in recorder.sent] == ['echo a', 'echo b']
+
+
+def test_timed_out_step_moves_on():
+    recorder = Recorder()
+    scheduler = PipelineScheduler({"pipeline1": "sleep 60; echo done"}, recorder, step_timeout=0.2)
+    runner = Thread(target=scheduler.run, args=(['client1'],))
+    runner.start()
+    time.sleep(0.4)
+    assert [sent[1] for sent in recorder.sent] == ['sleep 60', 'echo done']
+    _complete(scheduler, recorder, 'client1')
+    runner.join(5)
+    assert not runner.is_alive()
+
+
+def test_resumed_step_is_resent_under_its_command_id(tmp_path):
+    path = str(tmp_path / 'journal.bin')
+    recorder = Recorder()
+    journal = PipelineJournal(path, fsync_interval=0)
+    scheduler = PipelineScheduler(PIPELINES, recorder, step_timeout=10, journal=journal)
+    scheduler.add_client('client1')
+    _complete(scheduler, recorder, 'client1')
+    in_flight = recorder.last('client1')
+    journal.close()
+
+    resumed = Recorder()
+    journal = PipelineJournal(path, fsync_interval=0)
+    scheduler = PipelineScheduler(PIPELINES, resumed, step_timeout=10, journal=journal, resume=True)
+    scheduler.add_client('client1')
+    journal.close()
+    assert resumed.sent == [in_flight]
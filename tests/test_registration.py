@@ -0,0 +1,50 @@
+import time
+import color_log
+import sut as sut_module
+from sut import SUT
+
+
+def _operator(operator_module, broker):
+    return operator_module.Operator('127.0.0.1', broker.port, 't/commands', 't/responses', 't/registration', 't/ack',
+                                    't/loader', 1, {}, False, False, True, False, False, 'feedback.txt', False, qos=1)
+
+
+def _wait_registered(operator, timeout):
+    return operator._registry.wait_for_clients(0.1, 1, timeout) == ['client1']
+
+
+def test_client_started_before_operator_registers_on_hello(operator_module, broker, monkeypatch):
+    color_log.configure(log_level='error')
+    # Without the hello the second registration would only go out after a minute
+    monkeypatch.setattr(sut_module, 'REGISTRATION_RETRY_INITIAL', 60)
+    client = SUT('client1', '127.0.0.1', broker.port, 't/commands', 't/responses', 't/registration', 't/ack', True,
+                 False, qos=1)
+    client.run()
+    operator = None
+    try:
+        time.sleep(1.5)
+        operator = _operator(operator_module, broker)
+        operator._start()
+        assert _wait_registered(operator, sut_module.REREGISTRATION_SPREAD + 2)
+    finally:
+        client.stop()
+        if operator is not None:
+            operator._stop()
+
+
+def test_client_registers_again_with_restarted_operator(operator_module, broker):
+    color_log.configure(log_level='error')
+    operator = _operator(operator_module, broker)
+    operator._start()
+    client = SUT('client1', '127.0.0.1', broker.port, 't/commands', 't/responses', 't/registration', 't/ack', True,
+                 False, qos=1)
+    client.run()
+    try:
+        assert _wait_registered(operator, 5)
+        operator._stop()
+        operator = _operator(operator_module, broker)
+        operator._start()
+        assert _wait_registered(operator, sut_module.REREGISTRATION_SPREAD + 2)
+    finally:
+        client.stop()
+        operator._stop()
@@ -0,0 +1,52 @@
+import json
+import queue
+import time
+import codec
+from async_core import shared_loop
+from feedback_stream import FEEDBACK_CHUNK, FEEDBACK_FINAL
+
+
+def _worker(operator_module, tmp_path):
+    class RecordingWorker(operator_module.ShardWorker):
+        def __init__(self, *args, **kwargs):
+            self.saved = []
+            super().__init__(*args, **kwargs)
+
+        def save_feedback_to_file(self, feedback):
+            self.saved.append(json.loads(feedback))
+
+    return RecordingWorker(0, 1, queue.Queue(), queue.Queue(), '127.0.0.1', 1, 't/commands', 't/responses',
+                           't/registration', 't/ack', 't/loader', 1, {}, False, False, True, False, True,
+                           str(tmp_path / 'feedback.txt'), False)
+
+
+def _chunk(seq, data):
+    return codec.encode_feedback(codec.FORMAT_JSON, {"type": FEEDBACK_CHUNK, "client_id": "client1", "run_id": "r1",
+                                                     "seq": seq, "channel": "stdout", "data": data}).encode()
+
+
+FINAL = codec.encode_feedback(codec.FORMAT_JSON, {"type": FEEDBACK_FINAL, "client_id": "client1", "run_id": "r1",
+                                                  "chunks": 2, "command": "echo ab", "exit_code": 0}).encode()
+
+
+async def _feed(worker, *payloads):
+    # Feedback is handled on the loop thread, as the MQTT callbacks and forwarded feedback are
+    for payload in payloads:
+        worker.handle_feedback(payload)
+
+
+def test_final_overtaking_forwarded_chunk_waits_for_it(operator_module, tmp_path):
+    worker = _worker(operator_module, tmp_path)
+    shared_loop().run(_feed(worker, _chunk(0, 'a'), FINAL))
+    assert worker.saved == []
+    shared_loop().run(_feed(worker, _chunk(1, 'b')))
+    assert [feedback['output'] for feedback in worker.saved] == ['ab']
+    assert worker._assembler.pending_runs() == 0
+
+
+def test_final_is_released_without_lost_chunks(operator_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(operator_module, 'SHARD_FINAL_GRACE', 0.1)
+    worker = _worker(operator_module, tmp_path)
+    shared_loop().run(_feed(worker, _chunk(0, 'a'), FINAL))
+    time.sleep(0.3)
+    assert [(feedback['output'], feedback['missing_chunks']) for feedback in worker.saved] == [('a', [1])]
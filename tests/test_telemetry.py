@@ -0,0 +1,44 @@
+import math
+import telemetry
+
+
+class _FailingSource:
+    def read(self):
+        raise OSError("No such device")
+
+    def close(self):
+        pass
+
+
+def test_sample_survives_failing_sources():
+    sampler = telemetry.TelemetrySampler(interval=0.01)
+    try:
+        sampler._stat = [_FailingSource()]
+        sampler._meminfo = [_FailingSource()]
+        sampler._zones = [_FailingSource()]
+        marker = sampler.begin()
+        result = sampler.end(marker)
+        assert result["samples"] == 2
+        assert "cpu_util" not in result and "mem_used_mb" not in result and "temp_c" not in result
+        assert sampler._thread.is_alive()
+    finally:
+        sampler._stat = sampler._meminfo = sampler._zones = []
+        sampler.stop()
+
+
+def test_failed_source_is_left_out_of_the_mean(tmp_path):
+    path = tmp_path / 'scaling_cur_freq'
+    path.write_text('1200000\n')
+    sources = telemetry._open_sources([str(path)]) + [_FailingSource()]
+    assert telemetry.TelemetrySampler._mean(sources, 1000.0) == 1200.0
+    assert math.isnan(telemetry.TelemetrySampler._max([_FailingSource()], 1000.0))
+
+
+def test_reads_proc_files():
+    sampler = telemetry.TelemetrySampler(interval=0.01)
+    try:
+        marker = sampler.begin()
+        result = sampler.end(marker)
+        assert result["mem_used_mb"]["max"] > 0
+    finally:
+        sampler.stop()
@@ -0,0 +1,73 @@
+import zlib
+
+BROADCAST_ID = 'all'
+# Sharded operators share the subscriptions on the response topic under this group
+SHARE_GROUP = 'governor'
+
+# Command routing modes:
+#   per_client - every SUT listens on <command_topic>/<client_id> and <command_topic>/all
+#   shared     - legacy layout, every SUT listens on <command_topic> and filters by client_id
+#   both       - publish to both layouts, for fleets mixing old and new SUTs
+ROUTING_PER_CLIENT = 'per_client'
+ROUTING_SHARED = 'shared'
+ROUTING_BOTH = 'both'
+ROUTING_MODES = (ROUTING_PER_CLIENT, ROUTING_SHARED, ROUTING_BOTH)
+
+# Registration feature announced by clients that read targeted commands from the batch topic
+FEATURE_BATCH = 'batch'
+
+
+def client_command_topic(command_topic: str, client_id: str) -> str:
+    return f"{command_topic}/{client_id}"
+
+
+def client_ack_topic(ack_topic: str, client_id: str) -> str:
+    # Clients registering with JSON get their acknowledgment here instead of on the topic every client reads
+    return f"{ack_topic}/{client_id}"
+
+
+def hello_topic(registration_topic: str) -> str:
+    # Retained announcement of the running operator's epoch, a new epoch asks every client to register again
+    return f"{registration_topic}/hello"
+
+
+def broadcast_command_topic(command_topic: str) -> str:
+    return f"{command_topic}/{BROADCAST_ID}"
+
+
+def batch_command_topic(command_topic: str) -> str:
+    # One command for a set of clients, each client runs it only if it is listed in the message's targets;
+    # below the broadcast topic so it cannot clash with a client's own topic
+    return f"{command_topic}/{BROADCAST_ID}/batch"
+
+
+def shard_of(client_id: str, shards: int) -> int:
+    # Stable across processes and restarts, unlike hash() with string hash randomisation
+    return zlib.crc32(client_id.encode()) % shards
+
+
+def shard_response_topic(response_topic: str, shard: int) -> str:
+    return f"{response_topic}/shard{shard}"
+
+
+def response_topics(response_topic: str) -> str:
+    # The response topic and the shard topics below it, '#' also matches the level it follows
+    return f"{response_topic}/#"
+
+
+def shared_subscription(topic: str, group: str = SHARE_GROUP) -> str:
+    return f"$share/{group}/{topic}"
+
+
+def validate_routing(routing: str) -> str:
+    routing = routing.strip().lower()
+    if routing not in ROUTING_MODES:
+        raise ValueError(f"Unknown command routing '{routing}', expected one of: {', '.join(ROUTING_MODES)}")
+    return routing
+
+
+def validate_client_id(client_id: str):
+    if not client_id or '+' in client_id or '#' in client_id:
+        raise ValueError(f"Client ID '{client_id}' cannot be empty or contain MQTT wildcards")
+    if client_id.lower() == BROADCAST_ID:
+        raise ValueError(f"Client ID '{client_id}' is reserved for broadcasts")